@@ -0,0 +1,94 @@
+import argparse
+import os
+import random
+import tempfile
+from statistics import quantiles
+from time import perf_counter
+
+from data_store import DataStore, FileRecord, DataQuery, INDEX_DEF, PRAGMA_PROFILES
+
+SESSIONS = 10
+BATCH_ROWS = 100_000
+
+
+def fill(ds: DataStore, rows: int):
+    # every 5th size is shared by 2 files with the same hash, so there are duplicates to find
+    for begin in range(0, rows, BATCH_ROWS):
+        ds.insert_files(
+            FileRecord(
+                f"session-{i % SESSIONS}",
+                f"/data/dir{i // 1000}/file{i}.bin",
+                (i // 2) if i % 5 == 0 else i,
+                "20240101120000.00000",
+                ((i // 2) if i % 5 == 0 else i).to_bytes(16, "big"),
+                hash_algo="md5",
+            )
+            for i in range(begin, min(rows, begin + BATCH_ROWS))
+        )
+
+
+def timed(func, samples: int):
+    latencies = []
+    for _ in range(samples):
+        begin = perf_counter()
+        func()
+        latencies.append((perf_counter() - begin) * 1000)
+    if len(latencies) < 2:
+        return latencies[0], latencies[0]
+    percentiles = quantiles(latencies, n=100)
+    return percentiles[49], percentiles[98]
+
+
+def run(args):
+    database_name = args.database or os.path.join(tempfile.mkdtemp(), "bench.db")
+    ds = DataStore(database_name, args.profile)
+    if not args.index:
+        for index_name in INDEX_DEF["file_entries"]:
+            ds.db.execute(f"DROP INDEX IF EXISTS {index_name}")
+
+    count = ds.exec_query(DataQuery("COUNT(*)", "files"))[0][0]
+    if count < args.rows:
+        begin = perf_counter()
+        fill(ds, args.rows)
+        print(f"Inserted {args.rows} rows in {perf_counter() - begin:.1f}s")
+    ds.db.execute("ANALYZE")
+
+    def check_file_exists():
+        i = random.randrange(args.rows)
+        ds.check_file_exists(
+            FileRecord(f"session-{i % SESSIONS}", "", i, "", i.to_bytes(16, "big"), hash_algo="md5")
+        )
+
+    def by_size_and_hash():
+        i = random.randrange(args.rows)
+        ds.exec_query(DataQuery("file_name", "files", ["file_size == ?", "file_hash == ?"], params=[i, i.to_bytes(16, "big")]))
+
+    def by_file_name():
+        i = random.randrange(args.rows)
+        list(ds.get_records("files", file_name=f"/data/dir{i // 1000}/file{i}.bin"))
+
+    print(f"{args.rows} rows, profile {args.profile}, indexes {'on' if args.index else 'off'} ({database_name})")
+    for name, func in [
+        ("check_file_exists", check_file_exists),
+        ("file_size and file_hash", by_size_and_hash),
+        ("file_name", by_file_name),
+    ]:
+        p50, p99 = timed(func, args.lookups)
+        print(f"  {name:<24} p50 {p50:10.3f} ms   p99 {p99:10.3f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="bench_data_store",
+        description="Lookup latency of the files table at scale",
+    )
+    parser.add_argument("-r", "--rows", action="store", type=int, dest="rows", default=10_000_000)
+    parser.add_argument("-l", "--lookups", action="store", type=int, dest="lookups", default=1000)
+    parser.add_argument("-d", "--database", action="store", dest="database", default=None,
+                        help="Reuse this database between runs instead of filling a new one")
+    parser.add_argument("-p", "--profile", action="store", choices=list(PRAGMA_PROFILES), dest="profile", default="fast")
+    parser.add_argument("--no-index", action="store_false", dest="index",
+                        help="Drop the secondary indexes to compare against full table scans")
+    args = parser.parse_args()
+
+    run(args)
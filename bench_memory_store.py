@@ -0,0 +1,155 @@
+import argparse
+import gc
+import hashlib
+import os
+import random
+import shutil
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+import reports
+from data_store import DataQuery, DataStore, FileRecord, MemoryDataStore
+
+SESSION_ID = "bench"
+TIMESTAMP = "20240101120000.00000"
+
+
+class DictMemoryDataStore:
+    """MemoryDataStore as it was before the compact index, the baseline: a str key
+    and a dict per file, with the hex digests scan used to store."""
+
+    def __init__(self):
+        self.files = {}
+
+    def check_and_insert_file(self, file: FileRecord) -> str:
+        key = f"{file.session_id}#{file.file_size}#{file.hash_algo}#{file.file_hash.hex()}"
+        if key in self.files:
+            return self.files[key]["file_name"]
+        self.files[key] = {
+            "file_name": file.file_name,
+            "timestamp": file.timestamp,
+        }
+        return None
+
+
+def records(rows: int):
+    # 1000 files per directory, like the tree of a photo library
+    for i in range(rows):
+        yield FileRecord(
+            SESSION_ID,
+            f"/data/photos/{2000 + i // 100_000}/dir{i // 1000}/IMG_{i:08d}.jpg",
+            100_000 + i,
+            TIMESTAMP,
+            hashlib.md5(i.to_bytes(8, "little")).digest(),
+            hash_algo="md5",
+        )
+
+
+def fill(store_class, rows: int):
+    ds = store_class()
+    for file_record in records(rows):
+        ds.check_and_insert_file(file_record)
+    return ds
+
+
+def measure(store_class, rows: int):
+    """(bytes per file, seconds) of indexing rows files in a new store_class.
+
+    Timed on its own run, tracemalloc slows every allocation down.
+    """
+    begin = perf_counter()
+    fill(store_class, rows)
+    elapsed = perf_counter() - begin
+    gc.collect()
+    tracemalloc.start()
+    ds = fill(store_class, rows)
+    gc.collect()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del ds
+    return size / rows, elapsed
+
+
+def measure_snapshot(rows: int, lookups: int):
+    """Seconds to save a MemoryDataStore of rows files and to load it back, and ms per lookup after the load."""
+    ds = fill(MemoryDataStore, rows)
+    snapshot = os.path.join(tempfile.mkdtemp(), "index.bin")
+    begin = perf_counter()
+    ds.save(snapshot)
+    saved = perf_counter() - begin
+    del ds
+    begin = perf_counter()
+    loaded = MemoryDataStore.load(snapshot)
+    load = perf_counter() - begin
+    files = list(records(rows))
+    begin = perf_counter()
+    for file_record in random.sample(files, min(lookups, rows)):
+        assert loaded.check_file_exists(file_record) == file_record.file_name
+    lookup = (perf_counter() - begin) * 1000 / min(lookups, rows)
+    size = os.path.getsize(snapshot)
+    os.remove(snapshot)
+    return saved, load, lookup, size
+
+
+def report_records(rows: int):
+    """records(rows) as a first session, and a second one with a copy of every tenth file."""
+    yield from records(rows)
+    for file_record in records(rows // 10):
+        file_record.session_id = f"{SESSION_ID}-copy"
+        file_record.file_name = file_record.file_name.replace("/data/", "/backup/")
+        yield file_record
+
+
+def measure_reports(rows: int):
+    """Seconds of the sessions, duplicated and files reports on a DataStore and on a loaded MemoryDataStore snapshot."""
+    folder = tempfile.mkdtemp()
+    sql = DataStore(os.path.join(folder, "datastore.db"), "fast")
+    sql.insert_files(report_records(rows))
+    memory = MemoryDataStore()
+    memory.insert_files(report_records(rows))
+    memory.save(os.path.join(folder, "index.bin"))
+    timings = {}
+    for name, build in [
+        ("sessions", lambda: reports.list_sessions(DataQuery())),
+        ("duplicated", lambda: reports.list_duplicated(DataQuery(), [])),
+        ("files", lambda: reports.list_files(DataQuery(), [SESSION_ID])),
+    ]:
+        for store in ["sql", "memory"]:
+            begin = perf_counter()
+            # every report loads the snapshot again, like a data.py run
+            ds = sql if store == "sql" else MemoryDataStore.load(os.path.join(folder, "index.bin"))
+            results = ds.exec_query(build())
+            timings[name, store] = (perf_counter() - begin, len(results))
+    shutil.rmtree(folder)
+    return timings
+
+
+def run(args):
+    print(f"{args.rows} files, md5 digests")
+    for name, store_class in [("dict per file", DictMemoryDataStore), ("MemoryDataStore", MemoryDataStore)]:
+        per_file, elapsed = measure(store_class, args.rows)
+        print(f"  {name:<16} {per_file:8.1f} bytes/file   {args.rows / elapsed:12.0f} files/s")
+    saved, load, lookup, size = measure_snapshot(args.rows, args.lookups)
+    print(
+        f"  snapshot         {size / args.rows:8.1f} bytes/file   save {saved:.2f}s   load {load:.3f}s"
+        f"   lookup after load {lookup:.3f} ms"
+    )
+    print(f"reports, {args.rows} files and a session with {args.rows // 10} copies")
+    timings = measure_reports(args.rows)
+    for name in ["sessions", "duplicated", "files"]:
+        (sql, sql_rows), (memory, memory_rows) = timings[name, "sql"], timings[name, "memory"]
+        assert sql_rows == memory_rows, (name, sql_rows, memory_rows)
+        print(f"  {name:<16} SQLite {sql:7.3f}s   MemoryDataStore {memory:7.3f}s   {sql_rows} rows")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="bench_memory_store",
+        description="Memory per file of the in-memory duplicate index, and its snapshots",
+    )
+    parser.add_argument("-r", "--rows", action="store", type=int, dest="rows", default=1_000_000)
+    parser.add_argument("-l", "--lookups", action="store", type=int, dest="lookups", default=1000)
+    args = parser.parse_args()
+
+    run(args)
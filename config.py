@@ -1,6 +1,6 @@
 import os
+from typing import List
 from dataclasses import dataclass
-import hashlib
 from datetime import datetime
 import logging
 
@@ -22,6 +22,11 @@ class MergeConfig():
     DO_SHALLOW: bool
     DO_IGNORE: bool
     IGNORE_PATH: str
+    EXCLUDE: List[str]
+    PREFLIGHT: bool
+    WORKERS: int
+    ROTATIONAL_WORKERS: int
+    QUEUE_SIZE: int
     
     LOG_FILE_NOT_FOUND_ERRORS: bool
     AUDIT_LOG_FILE: str
@@ -41,7 +46,12 @@ class MergeConfig():
         self.DO_SHALLOW = False
         self.DO_IGNORE = False
         
-        self.IGNORE_PATH = ""
+        self.IGNORE_PATH = ""  # files whose path contains it aren't copied, but are deleted with the rest
+        self.EXCLUDE = []  # rules.Rules patterns, left in the source untouched
+        self.PREFLIGHT = True  # size the job during the SECURITY_TIMEOUT countdown
+        self.WORKERS = 1  # copies at once per SSD, 1 means copy serially on the walking thread
+        self.ROTATIONAL_WORKERS = 1  # copies at once touching a spinning disk
+        self.QUEUE_SIZE = 1024  # bound on files waiting for a copier
         
         self.LOG_FILE_NOT_FOUND_ERRORS = False
         self.AUDIT_LOG_FILE= f'{os.getcwd()}/AUDIT_LOG_FILE.log' 
@@ -54,10 +64,12 @@ We will execute with the following options:
 * Copy source files to destination: {self.DO_COPY}
 * Compare files before copying: {self.DO_COMPARE}
   * Do a shallow comparison (compare only metadata): {self.DO_SHALLOW}
+* Copy workers per device: {self.WORKERS} ({self.ROTATIONAL_WORKERS} on spinning disks)
 * Create subdirectories in target if they don't exist: {self.DO_MKDIR}
 * Delete source files after processing: {self.DO_DELETE}
 * Delete subdirectories on source after processing: {self.DO_CLEANUP_SOURCE}
 * Ignore ._* files (special MAC files): {self.IGNORE_DOT_UNDERSCORE_FILES}
+* Exclude: {", ".join(self.EXCLUDE) or None}
 * Log Files not found: {self.LOG_FILE_NOT_FOUND_ERRORS}
   * Continue even with unknown file handling exceptions: {self.DO_SUPRESS_UNKNOWN_EXCEPTIONS}"
   * Log File: {self.AUDIT_LOG_FILE}
@@ -65,6 +77,7 @@ We will execute with the following options:
 * Show Stats: {self.DO_STATS}
 
 * Wait {self.SECURITY_TIMEOUT} seconds before continuining for safety reasons
+  * and size the job meanwhile: {self.PREFLIGHT}
 """
         return config_formatted
     
@@ -74,6 +87,7 @@ class ScanConfig():
     DO_STATS: bool 
     SECURITY_TIMEOUT: int
     DATASTORE:str
+    DATASTORE_PROFILE: str
     SESSION_ID: str
 
     LOG_FILE_NOT_FOUND_ERRORS: bool
@@ -82,10 +96,33 @@ class ScanConfig():
 
     BUF_SIZE: int
     SIZE_THRESHOLD: int
-    HASH_FUNCTION: callable
+    HASH_ALGO: str
+    READ_STRATEGY: str
+    MMAP_MIN_SIZE: int
+    FADVISE: bool
     TIMESTAMP: str
     UNDER_THRESHOLD_TEXT: str
     PHYSICAL_DELETE: bool
+    WORKERS: int
+    ROTATIONAL_WORKERS: int
+    QUEUE_SIZE: int
+    PHYSICAL_ORDER: bool
+    ORDER_BATCH: int
+    EXCLUDE: List[str]
+    COMMIT_ROWS: int
+    COMMIT_INTERVAL_MS: int
+    HASH_BACKEND: str
+    HASH_BATCH_SIZE: int
+    INCREMENTAL_FROM: str
+    RESUME: bool
+    CHECKPOINT: bool
+    INDEX_FILE: str
+    PREFLIGHT: bool
+    SIZE_PREPASS: bool
+    UNIQUE_SIZE_TEXT: str
+    PARTIAL_HASH: bool
+    PARTIAL_HASH_SIZE: int
+    UNIQUE_PARTIAL_TEXT: str
     
     # init with safe values
     def __init__(self):
@@ -98,43 +135,84 @@ class ScanConfig():
         self.DO_SUPRESS_UNKNOWN_EXCEPTIONS = False
         self.BUF_SIZE = 65536  # lets read stuff in 64kb chunks!
         self.SIZE_THRESHOLD = 65536  # read stuff in 64kb chunks!
-        self.HASH_FUNCTION = hashlib.md5
+        self.HASH_ALGO = "md5"  # one of hashing.HASH_ALGORITHMS
+        self.READ_STRATEGY = "readinto"  # one of hashing.READ_STRATEGIES
+        self.MMAP_MIN_SIZE = 64 * 1024 * 1024  # smaller files are read with readinto even with mmap
+        self.FADVISE = True  # keep scanned files from evicting the page cache of other processes
         self.DATASTORE = 'datastore.db'
+        self.DATASTORE_PROFILE = 'fast'  # one of data_store.PRAGMA_PROFILES
         self.TIMESTAMP = datetime.now().isoformat(timespec='microseconds')
         self.SESSION_ID = ''
         self.UNDER_THRESHOLD_TEXT = "UNDER THRESHOLD"
         self.PHYSICAL_DELETE = False
+        self.WORKERS = 1  # hashing threads per SSD, 1 per device means hash serially
+        self.ROTATIONAL_WORKERS = 1  # hashing threads per spinning disk, more only adds seeks
+        self.QUEUE_SIZE = 1024  # bound on pending paths / records between walker, hashers and writer
+        self.PHYSICAL_ORDER = False  # hash in on-disk order (FIEMAP extent, else inode), for spinning disks
+        self.ORDER_BATCH = 4096  # files sorted at a time for PHYSICAL_ORDER
+        self.EXCLUDE = []  # rules.Rules patterns, pruned from the walk
+        self.COMMIT_ROWS = 1000  # records per DataStore transaction
+        self.COMMIT_INTERVAL_MS = 1000  # or commit earlier once this long went by
+        self.HASH_BACKEND = "thread"  # thread | process, process helps once digests are CPU-bound
+        self.HASH_BATCH_SIZE = 64  # files sent to a worker process at once
+        self.INCREMENTAL_FROM = ''  # session whose hashes are reused for unchanged files
+        self.RESUME = False  # SESSION_ID stopped before the end, continue it
+        self.CHECKPOINT = False  # delete_duplicates: index in DATASTORE instead of memory, so it can resume
+        self.INDEX_FILE = ''  # delete_duplicates: MemoryDataStore snapshot loaded before the run and saved after it
+        self.PREFLIGHT = True  # size the job during the SECURITY_TIMEOUT countdown
+        self.SIZE_PREPASS = False
+        self.UNIQUE_SIZE_TEXT = "UNIQUE SIZE"
+        self.PARTIAL_HASH = False  # implies SIZE_PREPASS
+        self.PARTIAL_HASH_SIZE = 16384  # bytes hashed from the head and from the tail
+        self.UNIQUE_PARTIAL_TEXT = "UNIQUE PARTIAL"
 
     def show_config(self):
         config_formatted = f"""
 We will execute with the following options:
 * Run quietly: {self.DO_QUIET}
 * Ignore ._* files (special MAC files): {self.IGNORE_DOT_UNDERSCORE_FILES}
+* Exclude: {", ".join(self.EXCLUDE) or None}
 * Delete files physically (false means just report): {self.PHYSICAL_DELETE}
+* Hash algorithm: {self.HASH_ALGO}
+  * Read strategy: {self.READ_STRATEGY}
+* Hashing workers per device: {self.WORKERS} ({self.ROTATIONAL_WORKERS} on spinning disks)
+  * Hashing backend: {self.HASH_BACKEND}
+  * Hash in on-disk order, {self.ORDER_BATCH} files at a time: {self.PHYSICAL_ORDER}
+* Reuse hashes of unchanged files from session: {self.INCREMENTAL_FROM or None}
+* Resume session {self.SESSION_ID}: {self.RESUME}
+* Index snapshot: {self.INDEX_FILE or None}
+* Only hash files whose size is shared with another file: {self.SIZE_PREPASS}
+  * and whose first and last {self.PARTIAL_HASH_SIZE} bytes match another file: {self.PARTIAL_HASH}
 * Log Files not found: {self.LOG_FILE_NOT_FOUND_ERRORS}
   * Continue even with unknown file handling exceptions: {self.DO_SUPRESS_UNKNOWN_EXCEPTIONS}"
   * Log File: {self.AUDIT_LOG_FILE}
 
 * Show Stats: {self.DO_STATS}
+* Commit to {self.DATASTORE} every {self.COMMIT_ROWS} files or {self.COMMIT_INTERVAL_MS} ms
+  * Datastore profile: {self.DATASTORE_PROFILE}
 
 * Wait {self.SECURITY_TIMEOUT} seconds before continuining for safety reasons
+  * and size the job meanwhile: {self.PREFLIGHT}
 """
         return config_formatted
 
 class DataConfig():
     DATASTORE:str
-    UNDER_THRESHOLD_TEXT: str
+    DATASTORE_PROFILE: str
+    INDEX_FILE: str
     DRY_RUN: bool
     
     # init with safe values
     def __init__(self):
         self.DATASTORE = 'datastore.db'
-        self.UNDER_THRESHOLD_TEXT = "UNDER THRESHOLD"
+        self.DATASTORE_PROFILE = 'fast'  # one of data_store.PRAGMA_PROFILES
+        self.INDEX_FILE = ''  # MemoryDataStore snapshot to report on instead of DATASTORE
         self.DRY_RUN = True
 
     def show_config(self):
         config_formatted = f"""
         DRY_RUN: {self.DRY_RUN}
-        DataStore: {self.DATASTORE}
+        DataStore: {self.DATASTORE} ({self.DATASTORE_PROFILE})
+        Index snapshot: {self.INDEX_FILE or None}
         """
         return config_formatted
\ No newline at end of file
@@ -10,7 +10,9 @@ logger.setLevel(os.getenv('MERGELOGGING', 'INFO'))
 import pandas as pd
 
 from config import DataConfig
-from data_store import DataStore, FileRecord, ErrorRecord, DataQuery
+from data_store import DataStore, MemoryDataStore, FileRecord, ErrorRecord, DataQuery, PRAGMA_PROFILES
+from reports import list_sessions, list_duplicated, list_duplicatedpaths, list_hardlinks, list_files, count_sessions, count_files
+from rules import Rules, load_patterns, substring_patterns
 
 config = DataConfig()
 
@@ -22,60 +24,9 @@ def print_or_quiet(*args, **kwargs):
     if config.DRY_RUN:
         print(*args, **kwargs)
 
-def list_sessions(query: DataQuery):
-    query.select_clause = 'session_id, count(*)'
-    query.from_clause = 'files'
-    query.group_clause = 'session_id'
-    return query
-
-def list_duplicated(query: DataQuery, session_ids):
-    query_inner = DataQuery()
-    query_inner.select_clause = 'file_hash as file_hash, file_size as file_size, COUNT(*) as cnt'
-    query_inner.from_clause = 'files'
-    if len(session_ids) > 0:
-        query_inner.where_clause = [f'{query_inner.format_query_in_clause('session_id', session_ids)}']
-    else:
-        query_inner.where_clause = []
-    query_inner.where_clause.append(f'file_hash != "{config.UNDER_THRESHOLD_TEXT}"')
-    query_inner.group_clause = 'file_size, file_hash'
-    query_inner.having_clause = 'cnt > 1'
-
-    query.select_clause = 'f.file_hash, f.file_size, f.file_name'
-    query.from_clause = f'''files AS f INNER JOIN ({query_inner.format_query()}) AS q ON f.file_hash == q.file_hash AND f.file_size == q.file_size'''
-    query.order_clause = 'f.file_hash, f.file_size'
-    return query
-
-def list_duplicatedpaths(query: DataQuery, session_ids):
-    query.select_clause = 'file_name, COUNT(*) as cnt'
-    query.from_clause = 'files'
-    if len(session_ids) > 0:
-        query.where_clause = f'{query.format_query_in_clause('session_id', session_ids)}'
-    else:
-        query.where_clause = None
-    query.group_clause = 'file_size, file_hash'
-    query.having_clause = 'cnt > 1'
-    return query
-
-def list_files(query: DataQuery, session_ids):
-    query.select_clause = '*'
-    query.from_clause = 'files'
-    if len(session_ids) > 0:
-        query.where_clause = [f'{query.format_query_in_clause('session_id', session_ids)}']
-    else:
-        query.where_clause = []
-    query.where_clause.append(f'file_hash != "{config.UNDER_THRESHOLD_TEXT}"')
-    return query
-
-def count_sessions(query: DataQuery):
-    query.select_clause = 'COUNT(DISTINCT session_id)'
-    query.from_clause = 'files'
-    return query
-
-def count_files(query: DataQuery, session_ids):
-    query.select_clause = '*'
-    query.from_clause = 'files'
-    query.where_clause = [f'{query.format_query_in_clause('session_id', session_ids)}']
-    return query
+# digests are stored as raw bytes, they only become hex here to be shown
+def to_display(row):
+    return tuple(value.hex() if isinstance(value, bytes) else value for value in row)
 
 # it filters all records for which there is only 1 combination of the same file_size, file_hash
 def delete_non_duplicated(df: pd.DataFrame):
@@ -90,14 +41,14 @@ def delete_non_duplicated(df: pd.DataFrame):
     print(result_df.count(), df.count())
     return result_df
 
-# it filters all records which the file_name contains some of the texts in the exclusion list
-def filter_df(df_orig, include_list, exclude_list):
+# it filters all records whose file_name, or one of its directories, is excluded by the rules
+def filter_df(df_orig, rules: Rules):
     assert type(df_orig) == pd.DataFrame
-    df = df_orig
-    for i in exclude_list:
-        print_or_quiet(f"Excluding: {i}")
-        df = df[~df['file_name'].str.contains(i.strip())]
-    return df
+    if not rules:
+        return df_orig
+    for rule in rules.rules:
+        print_or_quiet(f"Excluding: {rule.pattern}")
+    return df_orig[~df_orig['file_name'].map(rules.excluded_path)]
 
 # depending on the DRY_RUN setting this will create a list of files that are duplicated 
 # For each combination of file_hash, file_size, it will mark the first file_name (lexicographically ordered) as duplicated = False
@@ -105,7 +56,7 @@ def filter_df(df_orig, include_list, exclude_list):
 # file_size and hash as title and then all the files that are part of it below this title.
 # If DRY_RUN is false, it will output a series of unix commands, with rm {file_name} when duplicated == True, 
 # and echo {file_name} when False
-def show_duplicated(results: List[Any], ds:DataStore, include_list: List= None, exclude_list: List= None):
+def show_duplicated(results: List[Any], ds:DataStore, rules: Rules = None):
     def print_duplicates(df):
         last_file_size = None
         last_file_hash = None
@@ -124,8 +75,8 @@ def show_duplicated(results: List[Any], ds:DataStore, include_list: List= None,
                 else:
                     print (f'echo \"{r['file_name']}\"')
     
-    df = pd.DataFrame.from_records(results, columns=ds.headers())
-    df = filter_df(df, include_list, exclude_list)
+    df = pd.DataFrame.from_records(map(to_display, results), columns=ds.headers())
+    df = filter_df(df, rules or Rules())
     df = df.sort_values(['file_hash', 'file_size', 'file_name'])
     non_duplicated_df = delete_non_duplicated(df)
     non_duplicated_df['duplicated'] = non_duplicated_df.duplicated(subset=['file_hash', 'file_size'], keep='first')
@@ -140,8 +91,7 @@ def run(args):
     target = args.target
     session_ids = args.sessions
 
-    include_list= []
-    exclude_list= []
+    rules = Rules()
     # if args.include:
     #     try:
     #         with open(args.include) as f:
@@ -153,17 +103,19 @@ def run(args):
     #         return
     if args.exclude:
         try:
-            with open(args.exclude) as f:
-                lines = f.readlines()
-                for i in lines:
-                    exclude_list.append(i)
+            # plain lines are substrings of the file_name, as they always were
+            rules = Rules(substring_patterns(load_patterns(args.exclude)))
         except Exception as e:
             print(e)
             return
 
     print_or_quiet(config.show_config())
 
-    ds = DataStore(config.DATASTORE)
+    if config.INDEX_FILE:
+        # the index of a delete_duplicates --index-file run, reported on without SQLite
+        ds = MemoryDataStore.load(config.INDEX_FILE)
+    else:
+        ds = DataStore(config.DATASTORE, config.DATASTORE_PROFILE)
     query = DataQuery()
     if task == 'list':
         if target == 'sessions':
@@ -174,6 +126,8 @@ def run(args):
             query = list_duplicated(query, session_ids)
         if target == 'files':
             query = list_files(query, session_ids)
+        if target == 'hardlinks':
+            query = list_hardlinks(query, session_ids)
     if task == 'count':
         if target == 'sessions':
             query = count_sessions(query)
@@ -186,16 +140,16 @@ def run(args):
             results = ds.exec_query(query)
             if task == 'list':
                 if target == 'duplicated':
-                    show_duplicated(results, ds, include_list, exclude_list)
+                    show_duplicated(results, ds, rules)
                     # df = pd.DataFrame.from_records(results, columns=ds.headers())
-                    # df = filter_df(df, include_list, exclude_list)
+                    # df = filter_df(df, rules)
                     # df = df.sort_values(['file_hash', 'file_size', 'file_name'])
                     # delete_non_duplicated(df)
                     return     
             for i in results:
-                print_or_quiet(i)
+                print_or_quiet(to_display(i))
         except Exception as e:
-            print(query)
+            print(query, query.params)
             raise e
     else:
         print("Nothing to show")
@@ -211,12 +165,16 @@ if __name__ == "__main__":
     parser.add_argument("target")
     parser.add_argument("-s", "--session", action= 'append', dest='sessions', default=[])
     # parser.add_argument("-i", "--include", action= 'store', dest='include', default=None) # TODO: Solve how to manage include tasks
-    parser.add_argument("-x", "--exclude", action= 'store', dest='exclude', default=None)
+    parser.add_argument("-x", "--exclude", action= 'store', dest='exclude', default=None, help="File of texts, or re:REGEX lines, found in the paths to leave out of the report")
     parser.add_argument("-p", "--prefer", action= 'store', dest='prefer', default=None)
+    parser.add_argument("--datastore-profile", action= 'store', choices=list(PRAGMA_PROFILES), dest='datastore_profile', default='fast', help="SQLite settings: safe fsyncs every commit, fast uses WAL, a bigger cache and mmap")
+    parser.add_argument("--index-file", action= 'store', dest='index_file', default='', metavar='FILE', help="Report on the MemoryDataStore snapshot that delete_duplicates --index-file saved, in memory, instead of the SQLite datastore")
     parser.add_argument("--no-dry-run", action= 'store_false', dest='dry_run', default=True, help="In dry-run mode (default) the program will show the list of hashes, sizes and then the files. In no-dry-run mode, the system will generate the rm commands")
     args = parser.parse_args()
     # print(args.task, args.target, args)
 
     config.DRY_RUN = args.dry_run
+    config.DATASTORE_PROFILE = args.datastore_profile
+    config.INDEX_FILE = args.index_file
     
     run(args)
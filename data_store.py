@@ -1,6 +1,15 @@
+import heapq
+import json
+import mmap
 import sqlite3
-from dataclasses import dataclass
-from typing import List
+import struct
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from dataclasses import astuple, dataclass, field
+from time import monotonic
+from typing import Iterable, List
 import logging
 import os
 
@@ -28,7 +37,18 @@ class FileRecord:
     file_name: str
     file_size: str
     timestamp: str
-    file_hash: str
+    # raw digest bytes, or one of SKIP_REASONS when the content wasn't read
+    file_hash: bytes | str
+    # stat fingerprint, lets a later session reuse file_hash if the file didn't change
+    st_mtime_ns: int = None
+    st_ino: int = None
+    st_dev: int = None
+    # digest of the first and last few KB, the cheap stage before file_hash
+    partial_hash: bytes = None
+    # hashing.HASH_ALGORITHMS name both digests were computed with
+    hash_algo: str = None
+    # first file_name of the run with the same (st_dev, st_ino), for hardlinks
+    link_of: str = None
 
 
 @dataclass
@@ -49,16 +69,175 @@ CREATE_DEF = {
         exception_msg TEXT, 
         receoverable INT DEFAULT 0
     )""",
-    "files": """(
-        session_id TEXT NOT NULL, 
-        file_name TEXT NOT NULL, 
-        file_size INTEGER NOT NULL, 
-        timestamp TEXT, 
-        file_hash TEXT
-        PRIMARY KEY (session_id, file_size, file_hash, file_name)
+    # one row per directory, path ends with its separator so path || base_name
+    # is the file_name; parent_id makes rollups over a subtree cheap
+    "dirs": """(
+        dir_id INTEGER PRIMARY KEY,
+        parent_id INTEGER REFERENCES dirs (dir_id),
+        name TEXT NOT NULL,
+        path TEXT NOT NULL UNIQUE
     )""",
+    # the files, each directory stored once in dirs; read them through the files view
+    "file_entries": """(
+        session_id TEXT NOT NULL,
+        dir_id INTEGER NOT NULL REFERENCES dirs (dir_id),
+        base_name TEXT NOT NULL,
+        file_size INTEGER NOT NULL,
+        timestamp TEXT,
+        file_hash BLOB,
+        st_mtime_ns INTEGER,
+        st_ino INTEGER,
+        st_dev INTEGER,
+        partial_hash BLOB,
+        hash_algo TEXT,
+        link_of TEXT,
+        skip_reason INTEGER,
+        PRIMARY KEY (session_id, file_size, file_hash, dir_id, base_name)
+    )""",
+    # directories whose files are all in files, so a resumed session can skip them
+    "walk_progress": """(
+        session_id TEXT NOT NULL,
+        dir_name TEXT NOT NULL,
+        PRIMARY KEY (session_id, dir_name)
+    )""",
+}
+
+# columns added after a table was first released, so existing databases get upgraded.
+# files is only a table in databases from before dirs, upgraded before it's migrated
+UPGRADE_DEF = {
+    "files": {
+        "st_mtime_ns": "INTEGER",
+        "st_ino": "INTEGER",
+        "st_dev": "INTEGER",
+        "partial_hash": "TEXT",
+        # every digest stored before the column existed was md5
+        "hash_algo": "TEXT DEFAULT 'md5'",
+        "link_of": "TEXT",
+    },
+    # the only column added to file_entries so far, it came with BLOB digests
+    "file_entries": {
+        "skip_reason": "INTEGER",
+    },
+}
+
+# texts the runs use as file_hash of the files whose content wasn't read.
+# Stored as a skip_reason code and a NULL file_hash, so file_hash only holds
+# digests; the files view shows the text again
+SKIP_REASONS = {
+    "UNDER THRESHOLD": 1,
+    "UNIQUE SIZE": 2,
+    "UNIQUE PARTIAL": 3,
+}
+
+# secondary indexes, created with the table or on the first open of an existing database
+INDEX_DEF = {
+    "file_entries": {
+        # list_duplicated groups and joins on these, check_file_exists filters on them
+        "files_size_hash": "(file_size, file_hash, hash_algo)",
+        "files_session": "(session_id)",
+        "files_name": "(dir_id, base_name)",
+    },
+    "dirs": {
+        "dirs_parent": "(parent_id)",
+    },
 }
 
+# FILE_COLUMNS of file_entries with the full file_name back, one dirs lookup
+# by primary key per row, and the text of skip_reason
+SKIP_REASON_CASE = " ".join(f"WHEN {code} THEN '{text}'" for text, code in SKIP_REASONS.items())
+FILES_SELECT = f"""SELECT f.session_id, d.path || f.base_name AS file_name, f.file_size, f.timestamp,
+        f.file_hash, f.st_mtime_ns, f.st_ino, f.st_dev, f.partial_hash, f.hash_algo, f.link_of,
+        CASE f.skip_reason {SKIP_REASON_CASE} END AS skip_reason
+        FROM file_entries AS f INNER JOIN dirs AS d ON d.dir_id == f.dir_id"""
+
+# what data.py and the rest of the queries read, files as it was before dirs
+VIEW_DEF = {
+    "files": FILES_SELECT,
+}
+
+# PRAGMAs set on the connection, picked by name with DATASTORE_PROFILE
+PRAGMA_PROFILES = {
+    # rollback journal and a fsync on every commit, the sqlite defaults
+    "safe": {
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+    },
+    # readers don't block the writer and commits don't fsync, a crash can lose
+    # the last transactions but never corrupts the database
+    "fast": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,  # negative means KiB, so 64MiB of page cache
+        "temp_store": "MEMORY",
+    },
+}
+
+
+# FileRecord fields, in the order of the dataclass
+FILE_COLUMNS = (
+    "session_id",
+    "file_name",
+    "file_size",
+    "timestamp",
+    "file_hash",
+    "st_mtime_ns",
+    "st_ino",
+    "st_dev",
+    "partial_hash",
+    "hash_algo",
+    "link_of",
+)
+# FILE_COLUMNS with file_name split in its directory (dir_id) and base_name
+ENTRY_COLUMNS = ("session_id", "dir_id", "base_name") + FILE_COLUMNS[2:] + ("skip_reason",)
+INSERT_FILE_STMT = f"""INSERT INTO file_entries ({", ".join(ENTRY_COLUMNS)}) VALUES ({", ".join("?" * len(ENTRY_COLUMNS))})"""
+INSERT_DIR_STMT = """INSERT OR IGNORE INTO dirs (parent_id, name, path) VALUES (?, ?, ?)"""
+SELECT_DIR_STMT = """SELECT dir_id FROM dirs WHERE path == ?"""
+# by file_name through the dirs index, the view can't use one on d.path || f.base_name
+SELECT_FILE_STMT = f"""{FILES_SELECT}
+        WHERE d.path == ? AND f.base_name == ?"""
+
+# rows copied at a time when a files table from before dirs is migrated
+MIGRATE_ROWS = 10_000
+
+SEPARATORS = os.sep + (os.altsep or "")
+
+
+def stored_hash(file_hash: bytes | str) -> tuple:
+    """(file_hash, skip_reason) columns of a FileRecord.file_hash."""
+    if isinstance(file_hash, str) and file_hash in SKIP_REASONS:
+        return None, SKIP_REASONS[file_hash]
+    return file_hash, None
+
+
+def from_hex(value):
+    """bytes of a hex digest from before BLOB digests, anything else as it is."""
+    try:
+        return bytes.fromhex(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def split_file_name(file_name: str) -> tuple:
+    """(directory, base name) of file_name, the directory keeps its trailing
+    separator so both concatenated give file_name back as it was."""
+    base_name = os.path.basename(file_name)
+    return file_name[: len(file_name) - len(base_name)], base_name
+
+
+def split_dir_path(path: str) -> tuple:
+    """(parent, name) of a dirs path, parent None for a root: "/", "C:\\", or "" for relative names."""
+    parent, name = split_file_name(path.rstrip(SEPARATORS))
+    if not name:
+        return None, path
+    return parent, name
+
+
+# hash_algo IS, not ==, so rows of databases that predate the column (NULL) still match NULL;
+# file_hash and skip_reason IS too, files that weren't read match on their skip_reason
+CHECK_FILE_STMT = """SELECT file_name FROM files
+        WHERE session_id == ? AND file_size == ? AND file_hash IS ? AND skip_reason IS ? AND hash_algo IS ?"""
+
 
 @dataclass
 class DataQuery:
@@ -70,15 +249,27 @@ class DataQuery:
     having_clause: str | List = None
     order_clause: str = None
     limit_clause: int = None
+    # values bound to the ? placeholders, in the order they appear in the statement
+    params: List = field(default_factory=list)
+    # the reports.py builder the query comes from and its sessions, what a MemoryDataStore runs instead of the SQL
+    report: str = None
+    session_ids: List = field(default_factory=list)
 
     def format_query_in_clause(self, column_name, item_list: List) -> str:
         query = ""
         if len(item_list) > 0:
-            t = ", ".join([f"'{item}'" for item in item_list])
+            t = ", ".join("?" * len(item_list))
             item_list_clause = f"({t})"
             query = f"""{column_name} in {item_list_clause}"""
+            self.params.extend(item_list)
         return query
 
+    def add_where(self, clause: str, *params):
+        if self.where_clause is None:
+            self.where_clause = []
+        self.where_clause.append(clause)
+        self.params.extend(params)
+
     def format_query(self) -> str:
         # assert type(select_clause) == str and len(select_clause) > 0, select_clause
         # assert type(from_clause) == str and len(from_clause) > 0, from_clause
@@ -127,35 +318,48 @@ class DataStore:
     def set_audit_handler(self, func):
         self.audit = func
 
-    def __init__(self, database_name: str = DATABASE_NAME):
+    def __init__(self, database_name: str = DATABASE_NAME, profile: str = None):
         self.database_name = database_name
-        self.db = sqlite3.connect(database_name)
+        # every statement binds its values, so its text is constant and sqlite3's
+        # statement cache only has to prepare it once per connection
+        # the connection may be handed over to a pipeline writer thread, which is
+        # then its only user (see pipeline.Pipeline)
+        self.db = sqlite3.connect(database_name, check_same_thread=False)
         self.cur = self.db.cursor()
         self.audit = audit
+        self.dir_ids = {}  # dirs path -> dir_id, so every directory is looked up once
+        if profile:
+            self.apply_profile(profile)
         self.create_schema_if_needed()
 
     def get_observability(self):
         return metrics
 
-    def _execute_query(self, stmt: str):
+    def apply_profile(self, profile: str):
+        if profile not in PRAGMA_PROFILES:
+            raise ValueError(f"Unknown datastore profile {profile}, expected one of {list(PRAGMA_PROFILES)}")
+        for pragma, value in PRAGMA_PROFILES[profile].items():
+            self._execute_query(f"""PRAGMA {pragma}={value}""").fetchall()
+
+    def _execute_query(self, stmt: str, params: Iterable = ()):
         try:
-            audit(stmt)
-            res = self.cur.execute(stmt)
+            audit(stmt, params)
+            res = self.cur.execute(stmt, params)
             # log should go here
         except Exception as e:
             raise e
 
         try:
-            if not stmt.upper().startswith("select"):
+            if not stmt.lstrip().upper().startswith("SELECT"):
                 self.db.commit()
             # log / metrics should go here
         except Exception as e:
             raise e
         return res
 
-    def detect_table(self, table_name: str):
-        stmt = f'''SELECT COUNT(*) FROM main.sqlite_schema WHERE tbl_name == "{table_name}"'''
-        data = self._execute_query(stmt).fetchone()
+    def detect_table(self, table_name: str, kind: str = "table"):
+        stmt = """SELECT COUNT(*) FROM main.sqlite_schema WHERE type == ? AND tbl_name == ?"""
+        data = self._execute_query(stmt, (kind, table_name)).fetchone()
         if data and data[0] == 1:
             return True
         else:
@@ -165,40 +369,161 @@ class DataStore:
         stmt = f"""CREATE TABLE {table_name} {CREATE_DEF[table_name]}"""
         return self._execute_query(stmt)
 
+    def view_is_current(self, view_name: str) -> bool:
+        stmt = """SELECT sql FROM main.sqlite_schema WHERE type == 'view' AND tbl_name == ?"""
+        data = self._execute_query(stmt, (view_name,)).fetchone()
+        return data is not None and data[0] == f"""CREATE VIEW {view_name} AS {VIEW_DEF[view_name]}"""
+
+    def create_view(self, view_name: str):
+        """(Re)creates view_name, views hold no data so an old definition is just replaced."""
+        self._execute_query(f"""DROP VIEW IF EXISTS {view_name}""")
+        stmt = f"""CREATE VIEW {view_name} AS {VIEW_DEF[view_name]}"""
+        return self._execute_query(stmt)
+
+    def upgrade_table(self, table_name: str) -> int:
+        stmt = f"""PRAGMA table_info({table_name})"""
+        existing_columns = [r[1] for r in self._execute_query(stmt).fetchall()]
+        count = 0
+        for column_name, column_def in UPGRADE_DEF.get(table_name, {}).items():
+            if column_name not in existing_columns:
+                self._execute_query(
+                    f"""ALTER TABLE {table_name} ADD COLUMN {column_name} {column_def}"""
+                )
+                count += 1
+        return count
+
+    def create_indexes(self, table_name: str):
+        for index_name, index_def in INDEX_DEF.get(table_name, {}).items():
+            self._execute_query(f"""CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} {index_def}""")
+
+    def migrate_files(self) -> int:
+        """Moves the rows of a files table from before dirs into file_entries and drops it.
+
+        All in one transaction, a failure leaves the old table as it was. The
+        digests are copied as they were, hex text, for convert_digests.
+        """
+        columns = ", ".join(FILE_COLUMNS)
+        res = self.db.execute(f"""SELECT {columns} FROM files""")
+        count = 0
+        try:
+            with self.db:
+                while rows := res.fetchmany(MIGRATE_ROWS):
+                    self.cur.executemany(INSERT_FILE_STMT, [self.file_row(row) for row in rows])
+                    count += len(rows)
+                res.close()
+                self.cur.execute("""DROP TABLE files""")
+        except Exception:
+            self.dir_ids.clear()
+            raise
+        logger.info(f"Migrated {count} files of {self.database_name} to dirs and file_entries")
+        return count
+
+    def convert_digests(self):
+        """Hex text digests and SKIP_REASONS texts of databases from before BLOB digests
+        to raw bytes and skip_reason codes, in one transaction."""
+        self.db.create_function("from_hex", 1, from_hex, deterministic=True)
+        with self.db:
+            for text, code in SKIP_REASONS.items():
+                self.cur.execute(
+                    """UPDATE file_entries SET file_hash = NULL, skip_reason = ? WHERE file_hash == ?""",
+                    (code, text),
+                )
+            for column_name in ("file_hash", "partial_hash"):
+                self.cur.execute(
+                    f"""UPDATE file_entries SET {column_name} = from_hex({column_name})
+                    WHERE typeof({column_name}) == 'text'"""
+                )
+        logger.info(f"Converted the digests of {self.database_name} to BLOB")
+
     def create_schema_if_needed(self) -> int:
         count = 0
-        if not self.detect_table("files"):
-            self.create_table("files")
+        for table_name in ("dirs", "file_entries"):
+            if not self.detect_table(table_name):
+                self.create_table(table_name)
+                count += 1
+        migrated = False
+        if self.detect_table("files"):
+            self.upgrade_table("files")
+            self.migrate_files()
+            migrated = True
+        # without skip_reason, file_entries still has hex text digests
+        if self.upgrade_table("file_entries") > 0 or migrated:
+            self.convert_digests()
+            migrated = True
+        if migrated:
+            # the old values and indexes took most of the file, give that space back
+            self._execute_query("""VACUUM""")
+        # after the migration, the old table's indexes had the same names
+        self.create_indexes("dirs")
+        self.create_indexes("file_entries")
+        if not self.view_is_current("files"):
+            self.create_view("files")
             count += 1
         if not self.detect_table("errors"):
             self.create_table("errors")
             count += 1
+        if not self.detect_table("walk_progress"):
+            self.create_table("walk_progress")
+            count += 1
         return count
 
     def insert_error(self, error: ErrorRecord) -> bool:
-        stmt = f"""INSERT INTO errors VALUES
-        ("{error.session_id}", "{error.file_name}", "{error.timestamp}", "{error.exception_msg}", "{error.recoverable}")"""
-        return self._execute_query(stmt)
+        stmt = """INSERT INTO errors VALUES (?, ?, ?, ?, ?)"""
+        return self._execute_query(
+            stmt,
+            (error.session_id, error.file_name, error.timestamp, error.exception_msg, error.recoverable),
+        )
+
+    def dir_id(self, path: str) -> int:
+        """dir_id of the dirs path, inserted along with its parents the first time.
+
+        Inserts in the caller's transaction, which has to clear dir_ids if it
+        rolls back.
+        """
+        dir_id = self.dir_ids.get(path)
+        if dir_id is None:
+            parent, name = split_dir_path(path)
+            parent_id = self.dir_id(parent) if parent is not None else None
+            self.cur.execute(INSERT_DIR_STMT, (parent_id, name, path))
+            dir_id = self.cur.execute(SELECT_DIR_STMT, (path,)).fetchone()[0]
+            self.dir_ids[path] = dir_id
+        return dir_id
+
+    def file_row(self, row: tuple) -> tuple:
+        """FILE_COLUMNS values to ENTRY_COLUMNS ones."""
+        path, base_name = split_file_name(row[1])
+        file_hash, skip_reason = stored_hash(row[4])
+        return (row[0], self.dir_id(path), base_name, row[2], row[3], file_hash) + tuple(row[5:]) + (skip_reason,)
 
     @function_counter(metrics)
     @function_timer(metrics)
     def insert_file(self, file: FileRecord) -> bool:
-        stmt = f"""INSERT INTO files VALUES
-        ("{file.session_id}", "{file.file_name}", {file.file_size}, "{file.timestamp}", "{file.file_hash}")"""
-        return self._execute_query(stmt)
+        return self._execute_query(INSERT_FILE_STMT, self.file_row(astuple(file)))
 
     @function_counter(metrics)
     @function_timer(metrics)
-    def check_file_exists(self, file: FileRecord) -> str:
-        stmt = f"""SELECT file_name FROM files"""
-        stmt_where_clause = []
-        stmt_where_clause.append(f'session_id == "{file.session_id}"')
-        stmt_where_clause.append(f'file_size == "{file.file_size}"')
-        stmt_where_clause.append(f'file_hash == "{file.file_hash}"')
-        stmt_where = " AND ".join(stmt_where_clause)
-        stmt = f"{stmt} WHERE {stmt_where}"
+    def insert_files(self, files: Iterable[FileRecord]) -> int:
+        # one transaction, and so one commit, for the whole batch and its new dirs
+        try:
+            with self.db:
+                rows = [self.file_row(astuple(file)) for file in files]
+                audit(INSERT_FILE_STMT, len(rows))
+                self.cur.executemany(INSERT_FILE_STMT, rows)
+        except Exception:
+            self.dir_ids.clear()
+            raise
+        return len(rows)
 
-        res = self._execute_query(stmt)
+    @function_counter(metrics)
+    @function_timer(metrics)
+    def check_file_exists(self, file: FileRecord) -> str:
+        file_hash, skip_reason = stored_hash(file.file_hash)
+        # the view shows skip_reason as its text
+        skip_text = file.file_hash if skip_reason is not None else None
+        res = self._execute_query(
+            CHECK_FILE_STMT,
+            (file.session_id, file.file_size, file_hash, skip_text, file.hash_algo),
+        )
         res_list = res.fetchall()
         if len(res_list) > 1:
             raise Exception(
@@ -217,41 +542,85 @@ class DataStore:
         else:
             return res
 
+    def find_file_stmt(self, file_name: str, session_id: str = None):
+        """Statement and params selecting files by file_name, using the dirs and file_entries indexes."""
+        stmt = SELECT_FILE_STMT
+        params = list(split_file_name(file_name))
+        if session_id:
+            stmt = f"{stmt} AND f.session_id == ?"
+            params.append(session_id)
+        return stmt, params
+
     def update_count(self, file: FileRecord):
-        stmt = f'''SELECT * FROM files  
-        WHERE session_id = "{file.session_id}" and file_name = "{file.file_name}"'''
-        return self._execute_query(stmt)
+        return self._execute_query(*self.find_file_stmt(file.file_name, file.session_id))
 
     def create_query_stmt(self, table_name: str, **kwargs):
         stmt = f"""SELECT * FROM {table_name}"""
         stmt_where_clause = []
+        params = []
         for k, v in kwargs.items():
-            stmt_where_clause.append(f'{k} == "{v}"')
+            stmt_where_clause.append(f"{k} == ?")
+            params.append(v)
 
         if len(stmt_where_clause) > 0:
             stmt_where = " AND ".join(stmt_where_clause)
             stmt = f"{stmt} WHERE {stmt_where}"
 
-        return stmt
+        return stmt, params
 
     def get_records(
         self, table_name: str, session_id: str = None, file_name: str = None
     ):
-        stmt = f"""SELECT * FROM {table_name}"""
-        stmt_where_clause = []
+        kwargs = {}
         if session_id:
-            stmt_where_clause.append(f'session_id == "{session_id}"')
+            kwargs["session_id"] = session_id
         if file_name:
-            stmt_where_clause.append(f'file_name == "{file_name}"')
+            kwargs["file_name"] = file_name
+        if table_name == "files" and file_name:
+            stmt, params = self.find_file_stmt(file_name, session_id)
+        else:
+            stmt, params = self.create_query_stmt(table_name, **kwargs)
 
-        if len(stmt_where_clause) > 0:
-            stmt_where = " AND ".join(stmt_where_clause)
-            stmt = f"{stmt} WHERE {stmt_where}"
+        res = self._execute_query(stmt, params)
+        for r in res.fetchall():
+            yield r
 
-        res = self._execute_query(stmt)
+    def get_file_records(self, session_id: str) -> Iterable[FileRecord]:
+        """FileRecords of the files of session_id, with the text of skip_reason as file_hash."""
+        for row in self.get_records("files", session_id):
+            file_record = FileRecord(*row[: len(FILE_COLUMNS)])
+            if row[-1] is not None:
+                file_record.file_hash = row[-1]
+            yield file_record
+
+    def get_fingerprints(self, session_id: str):
+        stmt = """SELECT file_name, file_size, st_mtime_ns, st_ino, st_dev, file_hash, partial_hash, hash_algo FROM files
+        WHERE session_id == ? AND st_mtime_ns IS NOT NULL"""
+        res = self._execute_query(stmt, (session_id,))
         for r in res.fetchall():
             yield r
 
+    def insert_progress(self, session_id: str, dir_names: Iterable[str]) -> int:
+        rows = [(session_id, dir_name) for dir_name in dir_names]
+        stmt = """INSERT OR IGNORE INTO walk_progress VALUES (?, ?)"""
+        audit(stmt, len(rows))
+        with self.db:
+            self.cur.executemany(stmt, rows)
+        return len(rows)
+
+    def get_checkpoint(self, session_id: str):
+        """Returns (completed directories, files recorded outside of them) for session_id."""
+        stmt = """SELECT dir_name FROM walk_progress WHERE session_id == ?"""
+        completed_dirs = {r[0] for r in self._execute_query(stmt, (session_id,)).fetchall()}
+        # only the directories that were in flight when the session stopped are left
+        stmt = """SELECT file_name FROM files WHERE session_id == ?"""
+        recorded_files = {
+            file_name
+            for (file_name,) in self._execute_query(stmt, (session_id,))
+            if os.path.dirname(file_name) not in completed_dirs
+        }
+        return completed_dirs, recorded_files
+
     def format_content_table(self, table_name):
         stmt = f"""SELECT * FROM {table_name}"""
         res = self._execute_query(stmt)
@@ -259,7 +628,7 @@ class DataStore:
             yield r
 
     def exec_query(self, dq: DataQuery):
-        res = self._execute_query(dq.format_query())
+        res = self._execute_query(dq.format_query(), dq.params)
         self.header_description = list(map(lambda x: x[0], self.cur.description))
         return res.fetchall()
 
@@ -267,8 +636,463 @@ class DataStore:
         return self.header_description
 
 
+class WalkProgress:
+    """Tracks which directories of a walk have all their files written.
+
+    The walker calls walked() with the number of files of a directory before
+    sending them, and the writer calls written() for every record it stores.
+    A directory is complete once all its files were written, and
+    take_completed() hands the complete directories over, to be saved to
+    walk_progress only after their files are committed. Both sides can run
+    on different threads.
+    """
+
+    session_id: str
+    remaining: dict
+    completed: List[str]
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.remaining = {}
+        self.completed = []
+        self.lock = threading.Lock()
+
+    def walked(self, dir_name: str, count: int):
+        with self.lock:
+            if count == 0:
+                self.completed.append(dir_name)
+            else:
+                self.remaining[dir_name] = self.remaining.get(dir_name, 0) + count
+
+    def written(self, file_name: str):
+        dir_name = os.path.dirname(file_name)
+        with self.lock:
+            if dir_name not in self.remaining:
+                return
+            self.remaining[dir_name] -= 1
+            if self.remaining[dir_name] == 0:
+                del self.remaining[dir_name]
+                self.completed.append(dir_name)
+
+    def take_completed(self) -> List[str]:
+        with self.lock:
+            completed, self.completed = self.completed, []
+        return completed
+
+    def save(self, ds) -> int:
+        completed = self.take_completed()
+        if completed:
+            ds.insert_progress(self.session_id, completed)
+        return len(completed)
+
+
+class SessionWriter:
+    """Buffers FileRecords and writes them with DataStore.insert_files.
+
+    The buffer is flushed, in its own transaction, once it holds commit_rows
+    records or commit_interval_ms went by since the last flush (checked on
+    every write), and when the context exits. Those two knobs bound how much
+    of a scan is lost on a crash: commit_rows=1 is the old commit per file.
+    With a WalkProgress, every flush also saves the directories it completed.
+    on_flush(rows, seconds) is called after every flush that wrote rows.
+    """
+
+    ds: "DataStore"
+    commit_rows: int
+    commit_interval_ms: int
+    progress: WalkProgress
+    pending: List[FileRecord]
+    written: int
+
+    def __init__(
+        self,
+        ds,
+        commit_rows: int = 1000,
+        commit_interval_ms: int = 1000,
+        progress: WalkProgress = None,
+        on_flush=None,
+    ):
+        self.ds = ds
+        self.commit_rows = max(1, commit_rows)
+        self.commit_interval_ms = commit_interval_ms
+        self.progress = progress
+        self.on_flush = on_flush
+        self.pending = []
+        self.written = 0
+        self.last_flush = monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+        return False
+
+    def write(self, file: FileRecord):
+        self.pending.append(file)
+        if self.progress is not None:
+            self.progress.written(file.file_name)
+        if (
+            len(self.pending) >= self.commit_rows
+            or (monotonic() - self.last_flush) * 1000 >= self.commit_interval_ms
+        ):
+            self.flush()
+
+    def flush(self):
+        begin = monotonic()
+        rows = 0
+        if self.pending:
+            rows = self.ds.insert_files(self.pending)
+            self.written += rows
+            self.pending = []
+        if self.progress is not None:
+            self.progress.save(self.ds)
+        self.last_flush = monotonic()
+        if rows and self.on_flush is not None:
+            self.on_flush(rows, self.last_flush - begin)
+
+
+class Interned:
+    """Append-only store of distinct values by integer id, each value kept once."""
+
+    __slots__ = ("ids", "values")
+
+    ids: dict
+    values: list
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def intern(self, value) -> int:
+        value_id = self.ids.get(value)
+        if value_id is None:
+            value_id = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return value_id
+
+    def __getitem__(self, value_id: int):
+        return self.values[value_id]
+
+    def __len__(self):
+        return len(self.values)
+
+
+class BlobArray:
+    """Append-only list of bytes values packed in one bytearray, indexed by their end offsets."""
+
+    __slots__ = ("data", "ends")
+
+    data: bytearray
+    ends: array
+
+    def __init__(self):
+        self.data = bytearray()
+        self.ends = array("Q")
+
+    def append(self, value: bytes) -> int:
+        self.data += value
+        self.ends.append(len(self.data))
+        return len(self.ends) - 1
+
+    def __getitem__(self, i: int) -> bytes:
+        return bytes(self.data[self.ends[i - 1] if i else 0 : self.ends[i]])
+
+    def __len__(self):
+        return len(self.ends)
+
+
+class PathStore:
+    """Append-only file names by integer id: an interned directory and the base name bytes.
+
+    The directories are shared by all their files, the base names are packed
+    in one BlobArray, so a file name costs its base name plus 12 bytes
+    instead of a str object (49 bytes of header) per file.
+    """
+
+    __slots__ = ("dirs", "dir_ids", "base_names")
+
+    dirs: Interned
+    dir_ids: array
+    base_names: BlobArray
+
+    def __init__(self):
+        self.dirs = Interned()
+        self.dir_ids = array("I")
+        self.base_names = BlobArray()
+
+    def append(self, file_name: str) -> int:
+        path, base_name = split_file_name(file_name)
+        self.dir_ids.append(self.dirs.intern(path))
+        # fsencode round trips the names that aren't valid UTF-8
+        return self.base_names.append(os.fsencode(base_name))
+
+    def __getitem__(self, path_id: int) -> str:
+        return self.dirs[self.dir_ids[path_id]] + os.fsdecode(self.base_names[path_id])
+
+    def __len__(self):
+        return len(self.base_names)
+
+
+# session, hash_algo and skip_reason ids and file_size, followed by the raw digest
+MEMORY_KEY_HEADER = struct.Struct("<LHBq")
+# the session id a key starts with
+SESSION_ID = struct.Struct("<L")
+
+# MemoryDataStore.save format: SNAPSHOT_MAGIC, the length of a JSON header
+# and the header, then its sections, every one starting on an 8 byte boundary.
+# 003 adds the st_mtime_ns and st_ino of every file, 002 keeps the key of
+# every file, 001 only had the keys of the index
+SNAPSHOT_MAGIC = b"SMIDX003"
+# formats load() maps without the stat of their files
+SNAPSHOT_WITHOUT_STAT_MAGICS = (b"SMIDX002",)
+# the format load() reads into memory instead (read_first_format)
+SNAPSHOT_FIRST_MAGIC = b"SMIDX001"
+SNAPSHOT_LENGTH = struct.Struct("<Q")
+SNAPSHOT_ALIGN = 8
+
+# what MemoryDataStore returns for the files table, the columns of the files view
+FILES_VIEW_COLUMNS = FILE_COLUMNS + ("skip_reason",)
+SKIP_REASON_TEXTS = {code: text for text, code in SKIP_REASONS.items()}
+
+
+# content_key of a file that wasn't read, without a digest
+CONTENT_HEADER_SIZE = MEMORY_KEY_HEADER.size - SESSION_ID.size - 1
+
+
+def content_key(key: bytes) -> bytes:
+    """hash_algo, file_size and digest of a MEMORY_KEY_HEADER key: the key
+    without its session id and skip_reason, equal for the same content in
+    any session. Files that weren't read share it by size, like the NULL
+    file_hash of the files view groups them."""
+    return key[4:6] + key[7:]
+
+
+class KeyIndex:
+    """The ids of a Snapshot's index files sorted by key, searched with bisect.
+
+    Every key is read from the snapshot's keys column when a lookup touches
+    it, so the index costs 4 bytes per file on top of the keys.
+    """
+
+    __slots__ = ("snapshot", "ids")
+
+    snapshot: "Snapshot"
+    ids: memoryview
+
+    def __init__(self, snapshot: "Snapshot", ids: memoryview):
+        self.snapshot = snapshot
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i: int) -> bytes:
+        return self.snapshot.key(self.ids[i])
+
+    def get(self, key: bytes) -> int | None:
+        i = bisect_left(self, key)
+        if i < len(self) and self[i] == key:
+            return self.ids[i]
+        return None
+
+
+class Snapshot:
+    """Files of a MemoryDataStore.save file, read-only on a memory map.
+
+    Same columns as MemoryDataStore, as memoryviews of the file; their
+    directories, sessions, algorithms and timestamps are interned back in
+    the MemoryDataStore that loaded it.
+    """
+
+    def __init__(self, file_name: str):
+        with open(file_name, "rb") as f:
+            magic = f.read(len(SNAPSHOT_MAGIC))
+            if magic != SNAPSHOT_MAGIC and magic not in SNAPSHOT_WITHOUT_STAT_MAGICS:
+                raise ValueError(f"{file_name} is not a MemoryDataStore snapshot")
+            self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        begin = len(SNAPSHOT_MAGIC) + SNAPSHOT_LENGTH.size
+        (length,) = SNAPSHOT_LENGTH.unpack_from(self.mapping, len(SNAPSHOT_MAGIC))
+        self.header = json.loads(self.mapping[begin : begin + length])
+        if self.header["byteorder"] != sys.byteorder:
+            raise ValueError(f"{file_name} was saved on a {self.header['byteorder']} endian machine")
+        self.data_begin = aligned(begin + length)
+        self.view = memoryview(self.mapping)
+        self.files = self.header["files"]
+        self.dir_ids = self.section("dir_ids").cast("I")
+        self.name_ends = self.section("name_ends").cast("Q")
+        self.names = self.section("names")
+        self.timestamp_ids = self.section("timestamp_ids").cast("I")
+        self.key_ends = self.section("key_ends").cast("Q")
+        self.keys = self.section("keys")
+        self.index = KeyIndex(self, self.section("index").cast("I"))
+        self.session_files = self.section("session_files").cast("I")
+        self.content_files = self.section("content_files").cast("I")
+        self.content_ends = self.section("content_ends").cast("Q")
+        # None for the formats from before them
+        self.mtime_ns = self.section("mtime_ns").cast("q") if "mtime_ns" in self.header["sections"] else None
+        self.inos = self.section("inos").cast("Q") if "inos" in self.header["sections"] else None
+
+    def section(self, name: str) -> memoryview:
+        offset, length = self.header["sections"][name]
+        return self.view[self.data_begin + offset : self.data_begin + offset + length]
+
+    def lookup(self, key: bytes) -> int | None:
+        return self.index.get(key)
+
+    def key(self, file_id: int) -> bytes:
+        return bytes(self.keys[self.key_ends[file_id - 1] if file_id else 0 : self.key_ends[file_id]])
+
+    def base_name(self, file_id: int) -> bytes:
+        return bytes(self.names[self.name_ends[file_id - 1] if file_id else 0 : self.name_ends[file_id]])
+
+
+def aligned(offset: int) -> int:
+    return -(-offset // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+
+
+def read_first_format(file_name: str) -> Iterable[FileRecord]:
+    """FileRecords of a SMIDX001 snapshot, in the order they were inserted.
+
+    That format only kept the keys of the index, sorted in one table of
+    keys and one of file ids per key width: a file inserted again with the
+    key of another one replaced it and is the only one left.
+    """
+    with open(file_name, "rb") as f:
+        data = f.read()
+    begin = len(SNAPSHOT_FIRST_MAGIC) + SNAPSHOT_LENGTH.size
+    (length,) = SNAPSHOT_LENGTH.unpack_from(data, len(SNAPSHOT_FIRST_MAGIC))
+    header = json.loads(data[begin : begin + length])
+    if header["byteorder"] != sys.byteorder:
+        raise ValueError(f"{file_name} was saved on a {header['byteorder']} endian machine")
+    data_begin = aligned(begin + length)
+
+    def section(name: str) -> memoryview:
+        offset, length = header["sections"][name]
+        return memoryview(data)[data_begin + offset : data_begin + offset + length]
+
+    dir_ids = section("dir_ids").cast("I")
+    name_ends = section("name_ends").cast("Q")
+    names = section("names")
+    timestamp_ids = section("timestamp_ids").cast("I")
+    keys = {}  # file id -> key
+    for width in header["key_widths"]:
+        table = section(f"keys{width}")
+        for i, file_id in enumerate(section(f"ids{width}").cast("I")):
+            keys[file_id] = bytes(table[i * width : (i + 1) * width])
+    for file_id in sorted(keys):
+        key = keys[file_id]
+        session, hash_algo, skip_reason, file_size = MEMORY_KEY_HEADER.unpack_from(key)
+        base_name = names[name_ends[file_id - 1] if file_id else 0 : name_ends[file_id]]
+        yield FileRecord(
+            header["sessions"][session],
+            header["dirs"][dir_ids[file_id]] + os.fsdecode(bytes(base_name)),
+            file_size,
+            header["timestamps"][timestamp_ids[file_id]],
+            key[MEMORY_KEY_HEADER.size :] or SKIP_REASON_TEXTS.get(skip_reason),
+            hash_algo=header["hash_algos"][hash_algo],
+        )
+
+
+class SecondaryIndexes:
+    """What the reports of a MemoryDataStore look its files up by, built in one pass over the keys.
+
+    by_session maps an interned session id to the ids of its files.
+    by_content maps a content_key to the ids of its files, only for the
+    content that two or more files have, whatever their sessions.
+    The ids by file name need every name decoded, so by_name builds them
+    the first time it's called.
+
+    save() writes by_session and by_content to the snapshot, a store
+    with nothing inserted since its load reads them from there instead of
+    going through every key again, by_content only once a report needs it.
+    """
+
+    by_session: dict
+
+    def __init__(self, ds: "MemoryDataStore"):
+        self.ds = ds
+        self.by_session = {}
+        self.contents = None
+        self.names = None
+        if ds.snapshot is not None and len(ds) == ds.base_files:
+            self.read(ds.snapshot)
+        else:
+            self.build()
+
+    def read(self, snapshot: Snapshot):
+        begin = 0
+        for session, count in snapshot.header["session_files"]:
+            self.by_session[session] = snapshot.session_files[begin : begin + count]
+            begin += count
+
+    @property
+    def by_content(self) -> dict:
+        if self.contents is None:
+            snapshot = self.ds.snapshot
+            self.contents = {}
+            begin = 0
+            for end in snapshot.content_ends:
+                ids = snapshot.content_files[begin:end]
+                self.contents[content_key(snapshot.key(ids[0]))] = ids
+                begin = end
+        return self.contents
+
+    def build(self):
+        ds = self.ds
+        self.contents = {}
+        first = {}
+        for file_id in range(len(ds)):
+            key = ds.key_of(file_id)
+            (session,) = SESSION_ID.unpack_from(key)
+            ids = self.by_session.get(session)
+            if ids is None:
+                ids = self.by_session[session] = array("I")
+            ids.append(file_id)
+            content = content_key(key)
+            ids = self.contents.get(content)
+            if ids is not None:
+                ids.append(file_id)
+            elif content in first:
+                self.contents[content] = array("I", (first.pop(content), file_id))
+            else:
+                first[content] = file_id
+
+    def by_name(self) -> dict:
+        """file name -> ids of the files inserted with it"""
+        if self.names is None:
+            self.names = {}
+            for file_id in range(len(self.ds)):
+                file_name = self.ds.file_name(file_id)
+                ids = self.names.get(file_name)
+                if ids is None:
+                    ids = self.names[file_name] = array("I")
+                ids.append(file_id)
+        return self.names
+
+
 @dataclass
 class MemoryDataStore:
+    """The files index of a run in compact in-memory structures, no SQLite.
+
+    files maps a fixed-width binary key (MEMORY_KEY_HEADER + raw digest,
+    see file_key) to the id of the file it was inserted with. The rest of
+    every file is kept by id in append-only columns: its name in paths,
+    its key in keys (the same bytes object as in files), its timestamp,
+    interned like the sessions and hash algorithms, and its st_mtime_ns and
+    st_ino, to tell whether it changed since (file_stat). No object is
+    allocated per file besides the key and its files entry.
+
+    save() writes all of it to a file that load() maps back as a Snapshot:
+    its files keep their ids, are looked up in place, and the ones
+    inserted afterwards are numbered after them.
+
+    Every file inserted is a row of the files table, with the files view
+    columns a MemoryDataStore keeps and None for the rest (st_*,
+    partial_hash), also the duplicates of insert_duplicate that files
+    doesn't point to. exec_query answers the data.py reports from the
+    SecondaryIndexes, built when the first one runs after an insert.
+    """
 
     database_name: str
     db: dict
@@ -279,13 +1103,156 @@ class MemoryDataStore:
     def set_audit_handler(self, func):
         self.audit = func
 
-    def __init__(self, database_name: str = DATABASE_NAME):
+    def __init__(self, database_name: str = DATABASE_NAME, profile: str = None):
         self.database_name = database_name
         self.db = dict()
         self.cur = None
         self.audit = audit
+        self.sessions = Interned()
+        self.hash_algos = Interned()
+        self.timestamps = Interned()
+        self.paths = PathStore()
+        self.keys = []  # file id - base_files -> its key in files
+        self.timestamp_ids = array("I")  # file id - base_files -> timestamps id
+        self.mtime_ns = array("q")  # file id - base_files -> st_mtime_ns, 0 when not known
+        self.inos = array("Q")  # file id - base_files -> st_ino, 0 when not known
+        self.snapshot = None  # the files loaded, ids 0 to base_files - 1
+        self.base_files = 0
+        self.links = {}  # file id -> link_of, of the few files that are another name of an inode
+        self.indexes = None  # SecondaryIndexes, until the next insert
         self.create_schema_if_needed()
 
+    @classmethod
+    def load(cls, file_name: str, profile: str = None) -> "MemoryDataStore":
+        """A MemoryDataStore starting with the files of a save() file, mapped instead of read.
+
+        A SMIDX001 file is read into memory instead, its next save() is in
+        the current format.
+        """
+        with open(file_name, "rb") as f:
+            magic = f.read(len(SNAPSHOT_FIRST_MAGIC))
+        if magic == SNAPSHOT_FIRST_MAGIC:
+            ds = cls(file_name, profile)
+            ds.insert_files(read_first_format(file_name))
+            return ds
+        snapshot = Snapshot(file_name)
+        ds = cls(file_name, profile)
+        for interned, name in [
+            (ds.sessions, "sessions"),
+            (ds.hash_algos, "hash_algos"),
+            (ds.timestamps, "timestamps"),
+            (ds.paths.dirs, "dirs"),
+        ]:
+            for value in snapshot.header[name]:
+                interned.intern(value)
+        ds.snapshot = snapshot
+        ds.base_files = snapshot.files
+        ds.links = {file_id: link_of for file_id, link_of in snapshot.header["links"]}
+        return ds
+
+    def save(self, file_name: str) -> int:
+        """Writes every file of the store to file_name for load(), returns how many.
+
+        Written to a temporary file that then replaces file_name, so a crash
+        leaves the previous snapshot as it was.
+        """
+        snapshot = self.snapshot
+        dir_ids = array("I")
+        name_ends = array("Q")
+        names = bytearray()
+        timestamp_ids = array("I")
+        if snapshot is not None:
+            dir_ids.frombytes(snapshot.section("dir_ids"))
+            name_ends.frombytes(snapshot.section("name_ends"))
+            names += snapshot.names
+            timestamp_ids.frombytes(snapshot.section("timestamp_ids"))
+        dir_ids += self.paths.dir_ids
+        offset = len(names)
+        name_ends.extend(end + offset for end in self.paths.base_names.ends)
+        names += self.paths.base_names.data
+        timestamp_ids += self.timestamp_ids
+        mtime_ns = array("q")
+        inos = array("Q")
+        if snapshot is not None and snapshot.inos is not None:
+            mtime_ns.frombytes(snapshot.section("mtime_ns"))
+            inos.frombytes(snapshot.section("inos"))
+        elif snapshot is not None:
+            mtime_ns.extend(bytes(snapshot.files))
+            inos.extend(bytes(snapshot.files))
+        mtime_ns += self.mtime_ns
+        inos += self.inos
+        sections = [
+            ("dir_ids", dir_ids),
+            ("name_ends", name_ends),
+            ("names", names),
+            ("timestamp_ids", timestamp_ids),
+            ("mtime_ns", mtime_ns),
+            ("inos", inos),
+        ]
+
+        key_ends = array("Q")
+        keys = bytearray()
+        if snapshot is not None:
+            key_ends.frombytes(snapshot.section("key_ends"))
+            keys += snapshot.keys
+        for key in self.keys:
+            keys += key
+            key_ends.append(len(keys))
+
+        inserted = sorted((key, 0, file_id) for key, file_id in self.db["files"].items())
+        loaded = ((snapshot.key(file_id), 1, file_id) for file_id in snapshot.index.ids) if snapshot is not None else ()
+        index = array("I")
+        last_key = None
+        for key, tier, file_id in heapq.merge(inserted, loaded):
+            # a key inserted again after the load comes first and wins
+            if key != last_key:
+                index.append(file_id)
+                last_key = key
+        sections += [("key_ends", key_ends), ("keys", keys), ("index", index)]
+
+        indexes = self.secondary()
+        session_files = array("I")
+        session_counts = []
+        for session, ids in sorted(indexes.by_session.items()):
+            session_files.extend(ids)
+            session_counts.append([session, len(ids)])
+        content_files = array("I")
+        content_ends = array("Q")
+        for ids in indexes.by_content.values():
+            content_files.extend(ids)
+            content_ends.append(len(content_files))
+        sections += [("session_files", session_files), ("content_files", content_files), ("content_ends", content_ends)]
+
+        header = {
+            "byteorder": sys.byteorder,
+            "files": len(dir_ids),
+            "sessions": self.sessions.values,
+            "hash_algos": self.hash_algos.values,
+            "timestamps": self.timestamps.values,
+            "dirs": self.paths.dirs.values,
+            "links": sorted(self.links.items()),
+            "session_files": session_counts,
+            "sections": {},
+        }
+        offset = 0
+        for name, data in sections:
+            length = memoryview(data).nbytes
+            header["sections"][name] = [offset, length]
+            offset = aligned(offset + length)
+        encoded = json.dumps(header).encode()
+
+        temp_name = f"{file_name}.tmp"
+        with open(temp_name, "wb") as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(SNAPSHOT_LENGTH.pack(len(encoded)))
+            f.write(encoded)
+            f.write(bytes(aligned(f.tell()) - f.tell()))
+            for name, data in sections:
+                f.write(data)
+                f.write(bytes(aligned(f.tell()) - f.tell()))
+        os.replace(temp_name, file_name)
+        return len(dir_ids)
+
     def get_observability(self):
         return metrics
 
@@ -309,6 +1276,9 @@ class MemoryDataStore:
         if not self.detect_table("errors"):
             self.create_table("errors")
             count += 1
+        if not self.detect_table("walk_progress"):
+            self.create_table("walk_progress")
+            count += 1
         return count
 
     def insert_error(self, error: ErrorRecord) -> bool:
@@ -320,31 +1290,154 @@ class MemoryDataStore:
         }
         return True
 
+    def file_key(self, file: FileRecord) -> bytes:
+        file_hash, skip_reason = stored_hash(file.file_hash)
+        if isinstance(file_hash, str):
+            file_hash = file_hash.encode()
+        header = MEMORY_KEY_HEADER.pack(
+            self.sessions.intern(file.session_id),
+            self.hash_algos.intern(file.hash_algo),
+            skip_reason or 0,
+            file.file_size,
+        )
+        return header + (file_hash or b"")
+
+    def file_name(self, file_id: int) -> str:
+        if file_id < self.base_files:
+            dir_name = self.paths.dirs[self.snapshot.dir_ids[file_id]]
+            return dir_name + os.fsdecode(self.snapshot.base_name(file_id))
+        return self.paths[file_id - self.base_files]
+
+    def file_stat(self, file_id: int) -> tuple | None:
+        """(file_size, st_mtime_ns, st_ino) of file_id when it was inserted, None if not known."""
+        if file_id < self.base_files:
+            if self.snapshot.inos is None:
+                return None
+            mtime_ns, ino = self.snapshot.mtime_ns[file_id], self.snapshot.inos[file_id]
+        else:
+            mtime_ns, ino = self.mtime_ns[file_id - self.base_files], self.inos[file_id - self.base_files]
+        if not ino:
+            return None
+        return MEMORY_KEY_HEADER.unpack_from(self.key_of(file_id))[3], mtime_ns, ino
+
+    def indexed_stat(self, file: FileRecord) -> tuple | None:
+        """file_stat of the file indexed with the key of file, None if there is none."""
+        file_id = self.lookup(self.file_key(file))
+        return self.file_stat(file_id) if file_id is not None else None
+
+    def key_of(self, file_id: int) -> bytes:
+        if file_id < self.base_files:
+            return self.snapshot.key(file_id)
+        return self.keys[file_id - self.base_files]
+
+    def __len__(self):
+        return self.base_files + len(self.keys)
+
+    def row(self, file_id: int) -> tuple:
+        """file_id as a row of the files view, FILES_VIEW_COLUMNS."""
+        return next(self.rows((file_id,)))
+
+    def rows(self, file_ids: Iterable[int], hashed_only: bool = False) -> Iterable[tuple]:
+        """row() of every one of file_ids, or only of the ones whose content was read.
+
+        The columns are looked up once instead of once per file, reports
+        go through most of the files.
+        """
+        unpack_from = MEMORY_KEY_HEADER.unpack_from
+        header_size = MEMORY_KEY_HEADER.size
+        sessions = self.sessions.values
+        hash_algos = self.hash_algos.values
+        timestamps = self.timestamps.values
+        dirs = self.paths.dirs.values
+        links = self.links
+        base_files = self.base_files
+        # os.fsdecode, without its per call checks
+        encoding, errors = sys.getfilesystemencoding(), sys.getfilesystemencodeerrors()
+        snapshot = self.snapshot
+        if snapshot is not None:
+            keys, key_ends = snapshot.keys, snapshot.key_ends
+            names, name_ends = snapshot.names, snapshot.name_ends
+        for file_id in file_ids:
+            if file_id < base_files:
+                key = keys[key_ends[file_id - 1] if file_id else 0 : key_ends[file_id]]
+                base_name = names[name_ends[file_id - 1] if file_id else 0 : name_ends[file_id]]
+                dir_id = snapshot.dir_ids[file_id]
+                timestamp_id = snapshot.timestamp_ids[file_id]
+            else:
+                key = self.keys[file_id - base_files]
+                base_name = self.paths.base_names[file_id - base_files]
+                dir_id = self.paths.dir_ids[file_id - base_files]
+                timestamp_id = self.timestamp_ids[file_id - base_files]
+            if hashed_only and len(key) == header_size:
+                continue
+            session, hash_algo, skip_reason, file_size = unpack_from(key)
+            yield (
+                sessions[session],
+                dirs[dir_id] + str(base_name, encoding, errors),
+                file_size,
+                timestamps[timestamp_id],
+                bytes(key[header_size:]) or None,
+                None,
+                None,
+                None,
+                None,
+                hash_algos[hash_algo],
+                links.get(file_id),
+                SKIP_REASON_TEXTS.get(skip_reason),
+            )
+
+    def lookup(self, key: bytes) -> int | None:
+        file_id = self.db["files"].get(key)
+        if file_id is None and self.snapshot is not None:
+            file_id = self.snapshot.lookup(key)
+        return file_id
+
+    def add_file(self, key: bytes, file: FileRecord, indexed: bool = True) -> int:
+        file_id = self.base_files + self.paths.append(file.file_name)
+        self.keys.append(key)
+        self.timestamp_ids.append(self.timestamps.intern(file.timestamp))
+        self.mtime_ns.append(file.st_mtime_ns or 0)
+        self.inos.append(file.st_ino or 0)
+        if file.link_of is not None:
+            self.links[file_id] = file.link_of
+        if indexed:
+            self.db["files"][key] = file_id
+        self.indexes = None
+        return file_id
+
     @function_counter(metrics)
     @function_timer(metrics)
     def insert_file(self, file: FileRecord) -> bool:
-        key = f"{file.session_id}#{file.file_size}#{file.file_hash}"
-        self.db["files"][key] = {
-            "file_name": file.file_name,
-            "timestamp": file.timestamp,
-        }
+        self.add_file(self.file_key(file), file)
         return True
 
+    def insert_duplicate(self, file: FileRecord) -> int:
+        """Adds a row for file, its key keeps finding the file inserted with it before."""
+        return self.add_file(self.file_key(file), file, indexed=False)
+
+    def insert_files(self, files: Iterable[FileRecord]) -> int:
+        count = 0
+        for file in files:
+            self.insert_file(file)
+            count += 1
+        return count
+
     @function_counter(metrics)
     @function_timer(metrics)
     def check_file_exists(self, file: FileRecord) -> str:
-        key = f"{file.session_id}#{file.file_size}#{file.file_hash}"
-        if key in self.db["files"]:
-            return self.db["files"][key]["file_name"]
+        file_id = self.lookup(self.file_key(file))
+        if file_id is not None:
+            return self.file_name(file_id)
         return None
 
     def check_and_insert_file(self, file: FileRecord) -> str:
-        res = self.check_file_exists(file)
-        if not res:
-            self.insert_file(file)
-            return None
-        else:
-            return res
+        # one key for both, it's most of the cost of either
+        key = self.file_key(file)
+        file_id = self.lookup(key)
+        if file_id is not None:
+            return self.file_name(file_id)
+        self.add_file(key, file)
+        return None
 
     def update_count(self, file: FileRecord):
         raise Exception(f"update_count Not Implemented in {type(self).__name__}")
@@ -352,18 +1445,121 @@ class MemoryDataStore:
     def create_query_stmt(self, table_name: str, **kwargs):
         raise Exception(f"create_query_stmt Not Implemented in {type(self).__name__}")
 
+    def secondary(self) -> SecondaryIndexes:
+        if self.indexes is None:
+            self.indexes = SecondaryIndexes(self)
+        return self.indexes
+
+    def session_files(self, session_ids: List[str]) -> Iterable[int]:
+        """Ids of the files of session_ids in insertion order, every file without session_ids."""
+        if not session_ids:
+            return range(len(self))
+        by_session = self.secondary().by_session
+        sessions = {self.sessions.ids.get(session_id) for session_id in session_ids}
+        return heapq.merge(*(by_session[session] for session in sessions if session in by_session))
+
     def get_records(
         self, table_name: str, session_id: str = None, file_name: str = None
     ):
-        raise Exception(f"get_records Not Implemented in {type(self).__name__}")
+        if table_name == "files":
+            if file_name:
+                file_ids = self.secondary().by_name().get(file_name, ())
+            else:
+                file_ids = self.session_files([session_id] if session_id else [])
+            for row in self.rows(file_ids):
+                if not session_id or row[0] == session_id:
+                    yield row
+            return
+        # errors and walk_progress are keyed by session_id#name
+        for key, value in self.db[table_name].items():
+            session, name = key.split("#", 1)
+            if (session_id and session != session_id) or (file_name and name != file_name):
+                continue
+            if table_name == "errors":
+                yield (session, name, value["timestamp"], value["exception_msg"], value["recoverable"])
+            else:
+                yield (session, name)
+
+    def get_fingerprints(self, session_id: str):
+        raise Exception(f"get_fingerprints Not Implemented in {type(self).__name__}")
+
+    def insert_progress(self, session_id: str, dir_names: Iterable[str]) -> int:
+        count = 0
+        for dir_name in dir_names:
+            self.db["walk_progress"][f"{session_id}#{dir_name}"] = True
+            count += 1
+        return count
+
+    def get_checkpoint(self, session_id: str):
+        raise Exception(f"get_checkpoint Not Implemented in {type(self).__name__}")
 
     def format_content_table(self, table_name):
-        raise Exception(
-            f"format_content_table Not Implemented in {type(self).__name__}"
-        )
+        yield from self.get_records(table_name)
 
     def exec_query(self, dq: DataQuery):
-        raise Exception(f"exec_query Not Implemented in {type(self).__name__}")
+        """The rows of the report dq was built for (DataQuery.report), there is no SQL to run."""
+        report = getattr(self, f"report_{dq.report}", None) if dq.report else None
+        if report is None:
+            raise Exception(f"exec_query of {dq.report or dq.format_query()} Not Implemented in {type(self).__name__}")
+        self.header_description, rows = report(dq.session_ids)
+        return rows
 
     def headers(self):
-        raise Exception(f"headers Not Implemented in {type(self).__name__}")
+        return self.header_description
+
+    # report_<name>(session_ids) -> (headers, rows), the same as the DataQuery of reports.<name> on a DataStore
+
+    def report_sessions(self, session_ids: List[str]):
+        by_session = self.secondary().by_session
+        rows = sorted((self.sessions[session], len(ids)) for session, ids in by_session.items())
+        return ["session_id", "count(*)"], rows
+
+    def report_count_sessions(self, session_ids: List[str]):
+        return ["COUNT(DISTINCT session_id)"], [(len(self.secondary().by_session),)]
+
+    def report_files(self, session_ids: List[str]):
+        return list(FILES_VIEW_COLUMNS), list(self.rows(self.session_files(session_ids), hashed_only=True))
+
+    def report_count_files(self, session_ids: List[str]):
+        return list(FILES_VIEW_COLUMNS), list(self.rows(self.session_files(session_ids)))
+
+    def report_hardlinks(self, session_ids: List[str]):
+        sessions = {self.sessions.ids.get(session_id) for session_id in session_ids}
+        rows = []
+        for file_id, link_of in self.links.items():
+            key = self.key_of(file_id)
+            if not session_ids or SESSION_ID.unpack_from(key)[0] in sessions:
+                rows.append((link_of, self.file_name(file_id), MEMORY_KEY_HEADER.unpack_from(key)[3]))
+        return ["link_of", "file_name", "file_size"], sorted(rows)
+
+    def report_duplicatedpaths(self, session_ids: List[str]):
+        sessions = {self.sessions.ids.get(session_id) for session_id in session_ids}
+        rows = []
+        for ids in self.secondary().by_content.values():
+            selected = [
+                file_id for file_id in ids if not session_ids or SESSION_ID.unpack_from(self.key_of(file_id))[0] in sessions
+            ]
+            if len(selected) > 1:
+                rows.append((self.file_name(selected[0]), len(selected)))
+        return ["file_name", "cnt"], rows
+
+    def report_duplicated(self, session_ids: List[str]):
+        sessions = {self.sessions.ids.get(session_id) for session_id in session_ids}
+        file_ids = []
+        for content, ids in self.secondary().by_content.items():
+            # files that weren't read only share hash_algo and file_size
+            if len(content) == CONTENT_HEADER_SIZE:
+                continue
+            # the other names of an inode aren't duplicated content
+            if self.links:
+                ids = [file_id for file_id in ids if file_id not in self.links]
+            if session_ids:
+                selected = sum(1 for file_id in ids if SESSION_ID.unpack_from(self.key_of(file_id))[0] in sessions)
+            else:
+                selected = len(ids)
+            if selected > 1:
+                # every copy, also the ones of the other sessions
+                file_ids.extend(ids)
+        rows = [(row[4], row[2], row[1]) for row in self.rows(file_ids)]
+        rows.sort(key=lambda row: row[:2])
+        return ["file_hash", "file_size", "file_name"], rows
@@ -5,15 +5,33 @@ import traceback
 import uuid
 from filecmp import cmp
 from functools import cache, wraps
+from itertools import chain
 from pathlib import Path
 from shutil import copy2
-from time import sleep
+from time import perf_counter, sleep
+from typing import List
 import mimetypes
 from datetime import datetime
 
 from config import ScanConfig
 from stats import ProcessStats, Metrics, function_counter, function_timer
-from data_store import MemoryDataStore, FileRecord, ErrorRecord
+from data_store import DataStore, MemoryDataStore, FileRecord, ErrorRecord, SessionWriter, WalkProgress
+from walker import FileEntry, check_roots, roots_by_device, walk
+from pipeline import interleave
+from preflight import Preflight
+from rules import Rules, load_patterns
+from devices import hashed_in_physical_order
+from hashing import (
+    HASH_ALGORITHMS,
+    HASH_BACKENDS,
+    READ_STRATEGIES,
+    HashEngine,
+    LinkCache,
+    ReadOptions,
+    digest_file,
+    mark_unique_partials,
+    mark_unique_sizes,
+)
 import logging
 
 logger = logging.getLogger(__name__)
@@ -40,6 +58,9 @@ CHECK_EXTENSIONS.extend(AUDIO)
 CHECK_EXTENSIONS.extend(IMAGE)
 CHECK_EXTENSIONS.extend(COMPRESSED)
 
+# pruned from every walk on top of config.EXCLUDE
+EXCLUDE_ALWAYS = [".git/"]
+
 try:
     from alive_progress import alive_bar
 except ImportError as e:
@@ -49,13 +70,24 @@ stats = ProcessStats()
 metrics = Metrics()
 config = ScanConfig()
 ds = MemoryDataStore(config.DATASTORE)
+checkpoint_ds = None  # DataStore the index and the walk progress are kept in, only when checkpointing
+writer = None  # SessionWriter of checkpoint_ds for the files ds indexes
+walk_progress = None  # WalkProgress of the running session, only when checkpointing
+completed_dirs = set()  # directories a resumed session already went through
+recorded_files = set()  # files a resumed session already indexed, outside of completed_dirs
+links = LinkCache()  # digests of hardlinked inodes, one per run
 
 
-script_file = open("script.sh", "w")
+# opened on first use: worker processes re-import this module and must not truncate it
+script_file = None
 
 
 @function_counter(metrics)
 def write_to_file(line):
+    global script_file
+    if script_file is None:
+        # a resumed session adds to the commands of the run that stopped
+        script_file = open("script.sh", "a" if config.RESUME else "w")
     script_file.write(f"{line}\n")
 
 
@@ -115,53 +147,116 @@ def handle_exception(func):
     return handle_exception_inner
 
 
-@handle_exception
-@function_counter(metrics)
-def calc_size(file_name):
-    assert "Path" in str(type(file_name))
-    if (
-        file_name.is_file()
-    ):  # this is an extra fs call but due to handling exception it is better to do this, except performance is critical
-        return file_name.stat().st_size
-    else:
-        return 0
-
-
 @handle_exception
 @function_counter(metrics)
 def hash_file(file_name: str):
     assert "Path" in str(type(file_name))
-    hash_function = config.HASH_FUNCTION()
-
-    with file_name.open("rb") as f:
-        while True:
-            data = f.read(config.BUF_SIZE)
-            if not data:
-                break
-            hash_function.update(data)
-
-    return hash_function.hexdigest()
+    return digest_file(file_name, config.HASH_ALGO, ReadOptions.from_config(config))
 
 
 @function_counter(metrics)
-def is_duplicated(file_name: Path) -> str:
-    assert "Path" in str(type(file_name))
-    file_size = calc_size(file_name)
-    if file_size > config.SIZE_THRESHOLD:
-        hash = hash_file(file_name)
+def pending_record(file_entry: FileEntry) -> FileRecord:
+    # file_hash is left as None when the content still has to be hashed
+    if file_entry.size > config.SIZE_THRESHOLD:
+        hash = None
     else:
         hash = config.UNDER_THRESHOLD_TEXT
 
     file_record = FileRecord(
-        config.SESSION_ID, str(file_name), file_size, config.TIMESTAMP, hash
+        config.SESSION_ID,
+        file_entry.path,
+        file_entry.size,
+        config.TIMESTAMP,
+        hash,
+        st_mtime_ns=file_entry.mtime_ns,
+        st_ino=file_entry.ino,
+        st_dev=file_entry.dev,
+        hash_algo=config.HASH_ALGO,
     )
+    if file_entry.nlink > 1:
+        file_record.link_of = links.claim(file_record)
+        links.publish(file_record)
+    return file_record
+
+
+def link_digest(file_record: FileRecord):
+    # another name of an inode already read, the primary comes first in walk (and physical) order
+    if file_record.file_hash is None and file_record.link_of is not None:
+        file_record.file_hash = links.known(file_record)
+        if file_record.file_hash is not None:
+            stats.phase("link", 1, file_record.file_size)
+    return file_record
+
+
+def hash_record(file_record: FileRecord) -> FileRecord:
+    link_digest(file_record)
+    if file_record.file_hash is None:
+        with stats.timed("hash", file_record.file_size):
+            file_record.file_hash = hash_file(Path(file_record.file_name))
+        links.publish(file_record)
+    return file_record
+
+
+@function_counter(metrics)
+def is_duplicated(file_record: FileRecord) -> str:
+    return check_duplicated(hash_record(file_record))
+
+
+@function_counter(metrics)
+def check_duplicated(file_record: FileRecord) -> str:
+    if file_record.file_hash in (config.UNIQUE_SIZE_TEXT, config.UNIQUE_PARTIAL_TEXT):
+        # the pre-pass stages already proved nothing else in this run matches it
+        return None
     begin = datetime.now()
-    existing_file = ds.check_and_insert_file(file_record)
+    with stats.timed("db"):
+        existing_file = ds.check_and_insert_file(file_record)
+        if existing_file is None and writer is not None:
+            # committed with the directory it completes, or when the writer's buffer is full
+            writer.write(file_record)
     time_taken = datetime.now() - begin
     metrics.timer(f"#check_and_insert_file_timer", time_taken.total_seconds() * 1000)
+    if existing_file == file_record.file_name:
+        # indexed before the session we are resuming stopped
+        return None
+    if existing_file is None or existing_file == file_record.link_of:
+        # the same inode, removing this name frees nothing
+        return None
+    try:
+        existing_stat = os.stat(existing_file)
+    except OSError:
+        existing_stat = None
+    if existing_stat is None and config.INDEX_FILE:
+        # gone since the snapshot was saved, this file is the copy to keep now
+        ds.insert_file(file_record)
+        return None
+    if existing_stat is not None and (existing_stat.st_dev, existing_stat.st_ino) == (file_record.st_dev, file_record.st_ino):
+        # the same inode too, indexed by an earlier run the links of this one don't know about
+        return None
+    if config.INDEX_FILE and not unchanged_since_indexed(file_record, existing_file, existing_stat):
+        # edited since the snapshot was saved, this file is the copy to keep now
+        ds.insert_file(file_record)
+        return None
+    if config.INDEX_FILE:
+        # the snapshot keeps it with the copy kept, for the data.py duplicated report
+        ds.insert_duplicate(file_record)
     return existing_file
 
 
+def unchanged_since_indexed(file_record: FileRecord, existing_file: str, existing_stat: os.stat_result) -> bool:
+    """Whether existing_file, indexed with the digest of file_record, still has that content."""
+    indexed_stat = ds.indexed_stat(file_record)
+    if indexed_stat == (existing_stat.st_size, existing_stat.st_mtime_ns, existing_stat.st_ino):
+        return True
+    if existing_stat.st_size != file_record.file_size:
+        return False
+    if not isinstance(file_record.file_hash, bytes):
+        # under the size threshold, the size is all that was compared
+        return True
+    # touched, or indexed without its stat: read it again
+    with stats.timed("hash"):
+        return hash_file(Path(existing_file)) == file_record.file_hash
+
+
 @function_counter(metrics)
 def ignore_file(source_file):
     assert "Path" in str(type(source_file))
@@ -171,6 +266,8 @@ def ignore_file(source_file):
 @function_counter(metrics)
 def walk_error(e):
     print_or_quiet("my Error", e)
+    if isinstance(e, FileNotFoundError) and config.LOG_FILE_NOT_FOUND_ERRORS:
+        audit_exceptions(e)
 
 
 @function_counter(metrics)
@@ -191,31 +288,163 @@ def delete_file(source_file: Path, duplicated_file: Path):
 
 @function_counter(metrics)
 @function_timer(metrics)
-def should_ignore(file_name: Path):
-    # ignore if file is not in approved extensions
-    if file_name.suffix.lower() not in CHECK_EXTENSIONS:
-        return True
-
-    # ignore if file is inside a .git directory
-    if str(file_name).find(".git") > 0:
+def should_ignore(file_name: str):
+    # ignore if file is not in approved extensions, excluded paths never get here
+    if os.path.splitext(file_name)[1].lower() not in CHECK_EXTENSIONS:
         return True
 
     return False
 
 
+@handle_exception
 @function_counter(metrics)
-def tree_walk(source_dir):
-    assert "str" in str(type(source_dir))
-    s = Path(source_dir).resolve()
-    source_depth = len(s.parts)
-    with alive_bar() as bar:
-        for root, dirs, files in s.walk(top_down=True, on_error=walk_error):
-            for f in files:
-                if not should_ignore(root / f):
-                    duplicated = is_duplicated(root / f)
+def raise_hash_error(e: Exception):
+    raise e
+
+
+def scripted_files() -> set:
+    """Files the rm commands of script.sh already remove."""
+    if not os.path.exists("script.sh"):
+        return set()
+    with open("script.sh") as f:
+        return {line[len("rm ") :].partition(" #")[0] for line in f.read().splitlines() if line.startswith("rm ")}
+
+
+def load_checkpoint(session_id: str):
+    global completed_dirs, recorded_files
+    completed_dirs, recorded_files = checkpoint_ds.get_checkpoint(session_id)
+    # the copies to keep of the stopped run, the rest of the walk is checked against them
+    ds.insert_files(checkpoint_ds.get_file_records(session_id))
+    # duplicates never go in the index, the commands that reached script.sh before the stop tell them
+    recorded_files |= scripted_files()
+    return len(completed_dirs), len(recorded_files)
+
+
+def candidate_files(s: Path, on_skip):
+    """FileEntry of the files under s to check, on_skip(count) gets the number left out of every directory."""
+    begin = perf_counter()
+    rules = Rules(EXCLUDE_ALWAYS + config.EXCLUDE)
+    for root, dirs, files in walk(s, top_down=True, on_error=walk_error, rules=rules):
+        stats.phase("stat", len(files), 0, perf_counter() - begin)
+        begin = perf_counter()
+        dir_name = str(root)
+        if dir_name in completed_dirs:
+            continue
+        candidates = []
+        for file_entry in files:
+            if not should_ignore(file_entry.path) and file_entry.path not in recorded_files:
+                candidates.append(file_entry)
+        if len(candidates) < len(files):
+            on_skip(len(files) - len(candidates))
+        if walk_progress is not None:
+            walk_progress.walked(dir_name, len(candidates))
+        yield from candidates
+        begin = perf_counter()
+
+
+def save_checkpoint():
+    # the rm commands and the indexed files of a directory must be on disk before it counts as done
+    if script_file is not None:
+        script_file.flush()
+    writer.flush()
+    walk_progress.save(checkpoint_ds)
+
+
+def checkpoint(file_record: FileRecord):
+    # one write for every directory completed, none for the files in between
+    if walk_progress is not None:
+        walk_progress.written(file_record.file_name)
+        if walk_progress.completed:
+            save_checkpoint()
+
+
+def partial_records(file_records):
+    engine = HashEngine.from_config(config)
+    checked = []
+    with engine:
+        for file_record, error in engine.partial_hash_records(file_records):
+            if error:
+                raise_hash_error(error)
+            checked.append(file_record)
+    return mark_unique_partials(checked, config.UNIQUE_PARTIAL_TEXT)
+
+
+def pending_records(roots: List[Path], on_skip):
+    # the roots of each device are walked on a thread of their own, the index is only touched from this one
+    walks = [
+        chain.from_iterable(candidate_files(root, on_skip) for root in device_roots)
+        for device_roots in roots_by_device(roots)
+    ]
+    file_records = map(pending_record, interleave(walks, config.QUEUE_SIZE))
+    if config.SIZE_PREPASS or config.PARTIAL_HASH:
+        # a size nobody else has in this run can't be a duplicate, no need to read it
+        file_records = mark_unique_sizes(file_records, config.UNIQUE_SIZE_TEXT)
+    if config.PARTIAL_HASH:
+        file_records = partial_records(file_records)
+    return file_records
+
+
+@function_counter(metrics)
+def tree_walk(source_dirs: str | List[str], total: int = None):
+    """Deletes the duplicates under one source directory, or several sharing the same index."""
+    global walk_progress, writer, links
+    if isinstance(source_dirs, str):
+        source_dirs = [source_dirs]
+    roots = check_roots(source_dirs)
+    if config.CHECKPOINT:
+        walk_progress = WalkProgress(config.SESSION_ID)
+        # the walk progress is saved by save_checkpoint, after script.sh is flushed
+        writer = SessionWriter(checkpoint_ds, config.COMMIT_ROWS, config.COMMIT_INTERVAL_MS)
+    links = LinkCache()
+    # counts of files the walkers left out, the bar is only updated from this thread
+    skipped = []
+    with alive_bar(total=total) as bar:
+
+        def advance(count: int = 1):
+            while skipped:
+                count += skipped.pop()
+            if count:
+                bar(count)
+            bar.text = stats.rate_text()
+
+        file_records = pending_records(roots, skipped.append)
+        if config.WORKERS > 1:
+            # hashes run in the pool, the duplicate index is only touched from this thread
+            engine = HashEngine.from_config(config)
+            with engine:
+                # a link whose primary is still in the pool gets read again
+                file_records = map(link_digest, file_records)
+                if config.PHYSICAL_ORDER:
+                    # read in on-disk order, checked in walk order so the same copy is kept
+                    hashed = hashed_in_physical_order(file_records, engine.hash_records, config.ORDER_BATCH)
+                else:
+                    hashed = engine.hash_records(file_records)
+                for file_record, error in hashed:
+                    links.publish(file_record)
+                    if error:
+                        raise_hash_error(error)
+                    duplicated = check_duplicated(file_record)
                     if duplicated:
-                        delete_file(root / f, duplicated)
-                bar()
+                        with stats.timed("delete", file_record.file_size):
+                            delete_file(Path(file_record.file_name), duplicated)
+                    checkpoint(file_record)
+                    advance()
+        else:
+            if config.PHYSICAL_ORDER:
+                file_records = hashed_in_physical_order(
+                    file_records, lambda batch: map(hash_record, batch), config.ORDER_BATCH
+                )
+            for file_record in file_records:
+                duplicated = is_duplicated(file_record)
+                if duplicated:
+                    with stats.timed("delete", file_record.file_size):
+                        delete_file(Path(file_record.file_name), duplicated)
+                checkpoint(file_record)
+                advance()
+        advance(0)
+        if walk_progress is not None:
+            # directories without candidates are completed by the walk alone
+            save_checkpoint()
 
 
 @function_counter(metrics)
@@ -228,13 +457,25 @@ def get_stats():
 def run(args):
     source = args.source
 
-    if not Path(source).resolve().is_dir():
-        print(f"Source: {source} - is not a directory. Aborting")
+    for source_dir in source:
+        if not Path(source_dir).resolve().is_dir():
+            print(f"Source: {source_dir} - is not a directory. Aborting")
+            sys.exit(1)
+    try:
+        check_roots(source)
+    except ValueError as e:
+        print(f"Source: {e}. Aborting")
         sys.exit(1)
 
-    print(f"Source: {source} - files will be deleted from this directory after copied")
+    print(f"Source: {', '.join(source)} - files will be deleted from these directories when already found")
     print(config.show_config())
 
+    # sizing the job is metadata only, it runs while we wait anyway
+    preflight = None
+    if config.PREFLIGHT:
+        rules = Rules(EXCLUDE_ALWAYS + config.EXCLUDE)
+        preflight = Preflight(source, config.SIZE_THRESHOLD, rules=rules).start()
+
     with alive_bar(total=config.SECURITY_TIMEOUT) as bar:
         i = 0
         while i < config.SECURITY_TIMEOUT:
@@ -242,9 +483,24 @@ def run(args):
             sleep(1)
             i += 1
 
+    total = None
+    if preflight is not None:
+        if not preflight.done():
+            print("Sizing the job ...")
+        job = preflight.result()
+        print(job.report())
+        total = job.files
+
+    if config.RESUME:
+        dir_count, file_count = load_checkpoint(config.SESSION_ID)
+        print(f"Resuming session {config.SESSION_ID}: skipping {dir_count} completed directories and {file_count} more files")
+
     print(f"Scanning ...")
 
-    tree_walk(source)
+    tree_walk(source, total)
+
+    if config.INDEX_FILE:
+        print(f"Saved the index of {ds.save(config.INDEX_FILE)} files to {config.INDEX_FILE}")
 
     print(
         f"""Session Id (in case you want to file new files was): {config.SESSION_ID}."""
@@ -260,7 +516,7 @@ if __name__ == "__main__":
         description="Scan Directories and Deletes files if the file has already been found",
         epilog="Use carefully",
     )
-    parser.add_argument("source")
+    parser.add_argument("source", nargs="+", help="Directories checked against the same duplicate index, walked concurrently per device")
     parser.add_argument(
         "-i", "--ignore", action="store_false", dest="IGNORE_DOT_UNDERSCORE_FILES"
     )
@@ -272,13 +528,96 @@ if __name__ == "__main__":
     parser.add_argument(
         "-p", "--physical", action="store", type=int, dest="PHYSICAL_DELETE"
     )
+    parser.add_argument(
+        "-w", "--workers", action="store", type=int, dest="WORKERS", default=1,
+        help="Number of threads or processes hashing files",
+    )
+    parser.add_argument(
+        "--hash-algo", action="store", choices=list(HASH_ALGORITHMS), dest="HASH_ALGO", default="md5",
+        help="Digest used for file hashes",
+    )
+    parser.add_argument(
+        "--read-strategy", action="store", choices=READ_STRATEGIES, dest="READ_STRATEGY", default="readinto",
+        help="How file content is fed to the hash: read() copies, readinto() a reused buffer, or mmap for big files",
+    )
+    parser.add_argument(
+        "--hash-backend", action="store", choices=HASH_BACKENDS, dest="HASH_BACKEND", default="thread",
+        help="Hash with a pool of threads or of processes (only used with --workers > 1)",
+    )
+    parser.add_argument(
+        "--physical-order", action="store_true", dest="PHYSICAL_ORDER",
+        help="Hash files in the order their data sits on disk (FIEMAP extent, else inode), for spinning disks",
+    )
+    parser.add_argument(
+        "--size-prepass", action="store_true", dest="SIZE_PREPASS",
+        help="Stat the whole tree first and only hash files that share their size with another file",
+    )
+    parser.add_argument(
+        "--partial-hash", action="store_true", dest="PARTIAL_HASH",
+        help="After the size pre-pass, only fully hash files whose first and last KB match another file",
+    )
+    parser.add_argument(
+        "--exclude", action="append", dest="EXCLUDE", default=[], metavar="PATTERN",
+        help="gitignore style glob, or re:REGEX, of paths to leave out of the walk (can be repeated)",
+    )
+    parser.add_argument(
+        "--exclude-from", action="store", dest="EXCLUDE_FROM", default=None, metavar="FILE",
+        help="Read --exclude patterns from FILE, one per line",
+    )
+    parser.add_argument(
+        "--no-preflight", action="store_false", dest="PREFLIGHT",
+        help="Don't size the job (files, bytes, ETA) during the timeout countdown",
+    )
+    parser.add_argument(
+        "--checkpoint", action="store_true", dest="CHECKPOINT",
+        help="Keep the duplicate index and the walk progress in the datastore, so the session can be resumed",
+    )
+    parser.add_argument(
+        "--resume", action="store", dest="RESUME", default="", metavar="SESSION_ID",
+        help="Continue a checkpointed session that stopped (implies --checkpoint)",
+    )
+    parser.add_argument(
+        "--index-file", action="store", dest="INDEX_FILE", default="", metavar="FILE",
+        help="Start from the duplicate index saved in FILE by a previous run, if it exists, and save it there at the end, with the duplicates found for data.py --index-file",
+    )
     args = parser.parse_args()
+    if args.RESUME and (args.SIZE_PREPASS or args.PARTIAL_HASH):
+        # the unique size/partial marks only hold among the files of one run
+        parser.error("--resume can't be combined with --size-prepass or --partial-hash")
+    if args.INDEX_FILE and (args.SIZE_PREPASS or args.PARTIAL_HASH):
+        # a size alone in this run can still match a file of the snapshot
+        parser.error("--index-file can't be combined with --size-prepass or --partial-hash")
+    if args.INDEX_FILE and (args.CHECKPOINT or args.RESUME):
+        parser.error("--index-file keeps the index in memory, it can't be combined with --checkpoint or --resume")
     print(args.source, args)
-    config.SESSION_ID = get_session_id()
+    config.INDEX_FILE = args.INDEX_FILE
+    snapshot_session = ""
+    if config.INDEX_FILE and os.path.exists(config.INDEX_FILE):
+        try:
+            ds = MemoryDataStore.load(config.INDEX_FILE)
+        except ValueError as e:
+            parser.error(str(e))
+        # its files only match lookups of the session they were indexed in, so this run continues it
+        snapshot_session = ds.sessions[-1] if ds.sessions else ""
+        print(f"Loaded the index of {ds.base_files} files from {config.INDEX_FILE}")
+    config.SESSION_ID = args.RESUME or snapshot_session or get_session_id()
+    config.RESUME = bool(args.RESUME)
+    config.CHECKPOINT = args.CHECKPOINT or config.RESUME
+    config.PREFLIGHT = args.PREFLIGHT
+    config.EXCLUDE = args.EXCLUDE + (load_patterns(args.EXCLUDE_FROM) if args.EXCLUDE_FROM else [])
+    if config.CHECKPOINT:
+        checkpoint_ds = DataStore(config.DATASTORE, config.DATASTORE_PROFILE)
     config.IGNORE_DOT_UNDERSCORE_FILES = args.IGNORE_DOT_UNDERSCORE_FILES
     config.DO_QUIET = args.DO_QUIET
     config.DO_STATS = args.DO_STATS
     config.SECURITY_TIMEOUT = max(5, args.SECURITY_TIMEOUT)  # in seconds
+    config.WORKERS = max(1, args.WORKERS)
+    config.HASH_BACKEND = args.HASH_BACKEND
+    config.PHYSICAL_ORDER = args.PHYSICAL_ORDER
+    config.HASH_ALGO = args.HASH_ALGO
+    config.READ_STRATEGY = args.READ_STRATEGY
+    config.SIZE_PREPASS = args.SIZE_PREPASS
+    config.PARTIAL_HASH = args.PARTIAL_HASH
     config.LOG_FILE_NOT_FOUND_ERRORS = True
     config.AUDIT_LOG_FILE = f"{os.getcwd()}/AUDIT_LOG_FILE-{config.SESSION_ID}.log"
     config.DO_SUPRESS_UNKNOWN_EXCEPTIONS = True
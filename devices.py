@@ -0,0 +1,171 @@
+import os
+import logging
+import struct
+import threading
+from contextlib import ExitStack, contextmanager
+from functools import cache
+from typing import Callable, Dict, Iterable
+
+from data_store import FileRecord
+from hashing import batched
+
+try:
+    import fcntl
+except ImportError:  # Windows, files are only ordered by inode there
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv("MERGELOGGING", "INFO"))
+
+SYS_DEV_BLOCK = "/sys/dev/block"
+
+# linux/fs.h and linux/fiemap.h: struct fiemap followed by one struct fiemap_extent
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct("=QQLLLL")  # fm_start, fm_length, fm_flags, fm_mapped_extents, fm_extent_count, fm_reserved
+FIEMAP_EXTENT = struct.Struct("=QQQQQLLLL")  # fe_logical, fe_physical, fe_length, 2 reserved, fe_flags, 3 reserved
+FIEMAP_ALL = 0xFFFFFFFFFFFFFFFF
+FIEMAP_EXTENT_UNKNOWN = 0x2  # no location yet, fe_physical is 0 (also set with FIEMAP_EXTENT_DELALLOC)
+
+
+@cache
+def is_rotational(dev: int) -> bool | None:
+    """Whether the block device st_dev lives on is a spinning disk.
+
+    Read from /sys/dev/block/<major>:<minor>/queue/rotational, or from its
+    parent disk for a partition, which has no queue of its own. None when it
+    can't be told: not Linux, or not a block device (tmpfs, NFS, overlay...).
+    """
+    sys_dir = os.path.join(SYS_DEV_BLOCK, f"{os.major(dev)}:{os.minor(dev)}")
+    if not os.path.exists(sys_dir):
+        return None
+    sys_dir = os.path.realpath(sys_dir)
+    for block_dir in (sys_dir, os.path.dirname(sys_dir)):
+        try:
+            with open(os.path.join(block_dir, "queue", "rotational")) as f:
+                return f.read().strip() == "1"
+        except OSError:
+            continue
+    return None
+
+
+class DeviceScheduler:
+    """Concurrency limit for the I/O of every device, by st_dev.
+
+    A spinning disk gets at most rotational_workers readers/writers, more
+    only make its head seek back and forth between files; SSD/NVMe and the
+    devices that can't be told apart get workers.
+    """
+
+    workers: int
+    rotational_workers: int
+    semaphores: Dict[int, threading.Semaphore]
+
+    def __init__(self, workers: int, rotational_workers: int = 1):
+        self.workers = max(1, workers)
+        self.rotational_workers = max(1, min(rotational_workers, self.workers))
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def limit(self, dev: int | None) -> int:
+        if dev is not None and is_rotational(dev):
+            return self.rotational_workers
+        return self.workers
+
+    @contextmanager
+    def slots(self, *devs: int):
+        """Holds one slot of every device in devs, e.g. source and destination of a copy.
+
+        Always taken in st_dev order, so two copies between the same devices
+        in opposite directions can't deadlock.
+        """
+        with ExitStack() as stack:
+            for dev in sorted({dev for dev in devs if dev is not None}):
+                with self.lock:
+                    if dev not in self.semaphores:
+                        self.semaphores[dev] = threading.Semaphore(self.limit(dev))
+                    semaphore = self.semaphores[dev]
+                stack.enter_context(semaphore)
+            yield
+
+    def describe(self, devs) -> str:
+        kinds = {True: "rotational", False: "non-rotational", None: "unknown"}
+        return ", ".join(
+            f"device {dev} ({kinds[is_rotational(dev)]}): {self.limit(dev)} workers" for dev in devs
+        )
+
+
+def first_physical_offset(file_name: str) -> int | None:
+    """Byte offset on the device of the first extent of file_name, from FIEMAP.
+
+    None where the mapping can't be read: not Linux, a filesystem without
+    FIEMAP (NFS, FAT...), a file without extents (empty or inline), or one
+    whose data isn't allocated yet (written but not flushed).
+    FIBMAP would need root, FIEMAP doesn't.
+    """
+    if fcntl is None:
+        return None
+    request = bytearray(FIEMAP_HEADER.size + FIEMAP_EXTENT.size)
+    FIEMAP_HEADER.pack_into(request, 0, 0, FIEMAP_ALL, 0, 0, 1, 0)
+    try:
+        fd = os.open(file_name, os.O_RDONLY)
+        try:
+            fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        logger.debug(f"no FIEMAP for {file_name}: {e}")
+        return None
+    if FIEMAP_HEADER.unpack_from(request)[3] == 0:
+        return None
+    extent = FIEMAP_EXTENT.unpack_from(request, FIEMAP_HEADER.size)
+    if extent[5] & FIEMAP_EXTENT_UNKNOWN:
+        return None
+    return extent[1]
+
+
+def physical_key(file_record: FileRecord) -> tuple:
+    """Sort key putting the files of a device in the order their data sits on it.
+
+    By first extent where FIEMAP tells, by inode number (on most filesystems
+    close to allocation order) after those.
+    """
+    offset = first_physical_offset(file_record.file_name)
+    if offset is not None:
+        return file_record.st_dev or 0, 0, offset
+    return file_record.st_dev or 0, 1, file_record.st_ino or 0
+
+
+def physical_order(file_records: Iterable[FileRecord], batch_size: int):
+    """Yields file_records with the ones still to be hashed sorted by physical_key.
+
+    They are sorted batch_size at a time so the walk keeps streaming; the
+    records that won't be read go through as they come.
+    """
+    pending = []
+    for file_record in file_records:
+        if file_record.file_hash is not None:
+            yield file_record
+            continue
+        pending.append(file_record)
+        if len(pending) >= batch_size:
+            yield from sorted(pending, key=physical_key)
+            pending = []
+    yield from sorted(pending, key=physical_key)
+
+
+def hashed_in_physical_order(file_records: Iterable[FileRecord], hash_records: Callable, batch_size: int):
+    """Runs hash_records over every batch of file_records in physical_key order.
+
+    The results of hash_records (one per record, in the order it got them)
+    are yielded back in the order of file_records, for callers where the
+    order decides something, like which copy of a duplicate is kept.
+    """
+    for batch in batched(file_records, batch_size):
+        # records that won't be read sort first, without asking FIEMAP
+        order = sorted(
+            range(len(batch)), key=lambda i: physical_key(batch[i]) if batch[i].file_hash is None else ()
+        )
+        results = [None] * len(batch)
+        for i, result in zip(order, hash_records(batch[i] for i in order)):
+            results[i] = result
+        yield from results
@@ -0,0 +1,395 @@
+import hashlib
+import mmap
+import multiprocessing
+import os
+import logging
+import threading
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from itertools import islice
+from pathlib import Path
+from time import perf_counter
+from typing import Iterable, List, Tuple
+
+from data_store import FileRecord
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv("MERGELOGGING", "INFO"))
+
+# This module is imported by the worker processes, so it must stay free of
+# import time side effects (no DataStore instance, no config globals, no open files)
+
+HASH_BACKENDS = ("thread", "process")
+
+# read: f.read() loop, a new bytes object per chunk
+# readinto: unbuffered readinto() a per-thread reusable buffer
+# mmap: hash straight from a mapping of the file (readinto below mmap_min_size)
+READ_STRATEGIES = ("read", "readinto", "mmap")
+
+# Digests from the standard library we can hash with, name -> (hashlib name, parameters).
+# The name is what gets stored in files.hash_algo, so never change what a name means.
+HASH_ALGORITHMS = {
+    "md5": ("md5", {}),
+    "sha1": ("sha1", {}),
+    "sha256": ("sha256", {}),
+    "blake2b": ("blake2b", {}),
+    "blake2b-128": ("blake2b", {"digest_size": 16}),
+    "blake2b-256": ("blake2b", {"digest_size": 32}),
+    "blake2s": ("blake2s", {}),
+    "blake2s-128": ("blake2s", {"digest_size": 16}),
+}
+
+
+def new_hash(hash_algo: str):
+    if hash_algo not in HASH_ALGORITHMS:
+        raise ValueError(f"Unknown hash algorithm {hash_algo}, expected one of {list(HASH_ALGORITHMS)}")
+    hashlib_name, parameters = HASH_ALGORITHMS[hash_algo]
+    return hashlib.new(hashlib_name, **parameters)
+
+
+def bench_hash_algorithms(total_size: int, buf_size: int, hash_algos: Iterable[str] = None):
+    """Yields (hash_algo, MB/s) hashing total_size bytes from memory in buf_size chunks.
+
+    The data is already in memory, so this measures what the CPU can digest,
+    the ceiling for each algorithm once the disk is fast enough or cached.
+    """
+    data = memoryview(os.urandom(buf_size))
+    for hash_algo in hash_algos or HASH_ALGORITHMS:
+        hash_function = new_hash(hash_algo)
+        begin = perf_counter()
+        for _ in range(total_size // buf_size):
+            hash_function.update(data)
+        hash_function.digest()
+        elapsed = perf_counter() - begin
+        yield hash_algo, total_size / (1024 * 1024) / elapsed
+
+
+@dataclass
+class ReadOptions:
+    buf_size: int = 65536
+    read_strategy: str = "readinto"
+    mmap_min_size: int = 64 * 1024 * 1024
+    fadvise: bool = True
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.BUF_SIZE, config.READ_STRATEGY, config.MMAP_MIN_SIZE, config.FADVISE)
+
+
+_buffers = threading.local()
+
+
+def reusable_buffer(buf_size: int) -> bytearray:
+    buffer = getattr(_buffers, "buffer", None)
+    if buffer is None or len(buffer) != buf_size:
+        buffer = _buffers.buffer = bytearray(buf_size)
+    return buffer
+
+
+def advise(fd: int, advice_name: str):
+    # posix_fadvise only exists on some platforms, elsewhere it's just a hint we can't give
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice_name))
+
+
+def digest_file(file_name: Path, hash_algo: str, read_options: ReadOptions) -> bytes:
+    """Digest of the whole content of file_name, read with read_options.read_strategy.
+
+    With read_options.fadvise the kernel is told we read sequentially, and once
+    done that we won't need the pages again, so a scan doesn't push out of the
+    page cache what other processes on the machine are using.
+    """
+    if read_options.read_strategy not in READ_STRATEGIES:
+        raise ValueError(f"Unknown read strategy {read_options.read_strategy}, expected one of {READ_STRATEGIES}")
+    hash_function = new_hash(hash_algo)
+
+    with file_name.open("rb", buffering=0) as f:
+        fd = f.fileno()
+        if read_options.fadvise:
+            advise(fd, "POSIX_FADV_SEQUENTIAL")
+        try:
+            file_size = os.fstat(fd).st_size
+            if (
+                read_options.read_strategy == "mmap"
+                and file_size > 0
+                and file_size >= read_options.mmap_min_size
+            ):
+                with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mapping:
+                    if hasattr(mapping, "madvise"):
+                        mapping.madvise(mmap.MADV_SEQUENTIAL)
+                    hash_function.update(mapping)
+            elif read_options.read_strategy == "read":
+                while True:
+                    data = f.read(read_options.buf_size)
+                    if not data:
+                        break
+                    hash_function.update(data)
+            else:
+                buffer = reusable_buffer(read_options.buf_size)
+                view = memoryview(buffer)
+                while size := f.readinto(buffer):
+                    hash_function.update(view[:size])
+        finally:
+            if read_options.fadvise:
+                advise(fd, "POSIX_FADV_DONTNEED")
+
+    return hash_function.digest()
+
+
+def bench_read_strategies(file_name: Path, hash_algo: str, buf_size: int, repeat: int = 3):
+    """Yields (read_strategy, MB/s) hashing file_name with every strategy, best of repeat runs.
+
+    Every strategy maps the file regardless of its size and drops it from the
+    page cache after each run, so the runs start from the same (cold) state
+    where the platform allows it.
+    """
+    file_size = file_name.stat().st_size
+    for read_strategy in READ_STRATEGIES:
+        read_options = ReadOptions(buf_size, read_strategy, 1, True)
+        best = None
+        for _ in range(repeat):
+            begin = perf_counter()
+            digest_file(file_name, hash_algo, read_options)
+            elapsed = perf_counter() - begin
+            best = elapsed if best is None else min(best, elapsed)
+        yield read_strategy, file_size / (1024 * 1024) / best
+
+
+def partial_digest(file_name: Path, hash_algo: str, partial_size: int, file_size: int) -> bytes:
+    """Digest of the first and last partial_size bytes of the file.
+
+    When the file is no bigger than 2 * partial_size the two reads cover the
+    whole content back to back, so the result equals the full digest.
+    """
+    hash_function = new_hash(hash_algo)
+
+    with file_name.open("rb") as f:
+        hash_function.update(f.read(partial_size))
+        if file_size > partial_size:
+            f.seek(max(partial_size, file_size - partial_size))
+            hash_function.update(f.read(partial_size))
+
+    return hash_function.digest()
+
+
+def hash_batch(
+    batch: List[FileRecord], hash_algo: str, read_options: ReadOptions
+) -> List[Tuple[FileRecord, Exception | None]]:
+    """Fills file_hash on every record of batch that doesn't have one yet.
+
+    The caller decides what needs hashing (under threshold files, hashes reused
+    from a previous session) before the record gets here. Errors are returned
+    next to the record instead of being raised, so one vanished file doesn't
+    throw away the rest of the batch and the caller can apply its own
+    exception policy.
+    """
+    results = []
+    for file_record in batch:
+        try:
+            if file_record.file_hash is None:
+                file_record.file_hash = digest_file(Path(file_record.file_name), hash_algo, read_options)
+            results.append((file_record, None))
+        except Exception as e:
+            results.append((file_record, e))
+    return results
+
+
+def partial_hash_batch(
+    batch: List[FileRecord], hash_algo: str, partial_size: int
+) -> List[Tuple[FileRecord, Exception | None]]:
+    """Fills partial_hash on every record of batch that still needs hashing.
+
+    Records with a digest already (reused from an earlier session) get one
+    too, so the files still to hash can be compared with them. Same error
+    handling as hash_batch.
+    """
+    results = []
+    for file_record in batch:
+        try:
+            if file_record.partial_hash is None and (
+                file_record.file_hash is None or isinstance(file_record.file_hash, bytes)
+            ):
+                file_record.partial_hash = partial_digest(
+                    Path(file_record.file_name), hash_algo, partial_size, file_record.file_size
+                )
+                if file_record.file_hash is None and file_record.file_size <= 2 * partial_size:
+                    file_record.file_hash = file_record.partial_hash
+            results.append((file_record, None))
+        except Exception as e:
+            results.append((file_record, e))
+    return results
+
+
+def mark_unique_sizes(
+    file_records: Iterable[FileRecord], unique_size_text: str
+) -> List[FileRecord]:
+    """Size bucket pre-pass: a file whose size nobody else has can't have a duplicate.
+
+    Consumes all of file_records (they only carry stat data at this point) and
+    sets unique_size_text as the hash of the ones that are alone in their size
+    bucket, so only the colliding sizes get their content read.
+    """
+    file_records = list(file_records)
+    sizes = Counter(file_record.file_size for file_record in file_records)
+    for file_record in file_records:
+        if file_record.file_hash is None and sizes[file_record.file_size] == 1:
+            file_record.file_hash = unique_size_text
+    return file_records
+
+
+def mark_unique_partials(
+    file_records: List[FileRecord], unique_partial_text: str
+) -> List[FileRecord]:
+    """Second stage after mark_unique_sizes, the same idea on (size, head/tail digest).
+
+    Files whose partial digest is alone in their size bucket differ from every
+    other file, so their full content never gets read. Every record with a
+    partial digest counts, the ones whose full digest is known too.
+    """
+    partials = Counter(
+        (file_record.file_size, file_record.partial_hash)
+        for file_record in file_records
+        if file_record.partial_hash is not None
+    )
+    for file_record in file_records:
+        if (
+            file_record.file_hash is None
+            and file_record.partial_hash is not None
+            and partials[(file_record.file_size, file_record.partial_hash)] == 1
+        ):
+            file_record.file_hash = unique_partial_text
+    return file_records
+
+
+class LinkCache:
+    """Digests of the inodes with more than one hardlink, so each is read once per run.
+
+    claim() is called in walk order: the first path of an inode is its
+    primary, the later ones are links and get the primary's file_name as
+    link_of. The primary publish()es its digest once known; links wait()
+    for it, or take it when already known() on pools that can't block.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.primaries = {}  # (st_dev, st_ino) -> file_name of the first link walked
+        self.events = {}  # (st_dev, st_ino) -> set once the primary published its digest
+        self.digests = {}  # (st_dev, st_ino) -> digest of the primary, None if it couldn't be read
+
+    def claim(self, file_record: FileRecord) -> str | None:
+        """Returns the primary of file_record's inode, None if file_record is it."""
+        key = (file_record.st_dev, file_record.st_ino)
+        with self.lock:
+            primary = self.primaries.setdefault(key, file_record.file_name)
+            if primary != file_record.file_name:
+                return primary
+            self.events[key] = threading.Event()
+        return None
+
+    def publish(self, file_record: FileRecord):
+        """Keeps file_record.file_hash for the links, if file_record is a primary."""
+        key = (file_record.st_dev, file_record.st_ino)
+        if self.primaries.get(key) != file_record.file_name:
+            return
+        self.digests[key] = file_record.file_hash
+        self.events[key].set()
+
+    def known(self, file_record: FileRecord) -> str | None:
+        return self.digests.get((file_record.st_dev, file_record.st_ino))
+
+    def wait(self, file_record: FileRecord) -> str | None:
+        """Digest of the primary of file_record, blocking until it's published.
+
+        The primary is walked first and sits ahead of its links in the queue
+        of their device, so it's always being hashed by then.
+        """
+        key = (file_record.st_dev, file_record.st_ino)
+        self.events[key].wait()
+        return self.digests[key]
+
+
+def batched(iterable: Iterable, batch_size: int):
+    it = iter(iterable)
+    while batch := list(islice(it, batch_size)):
+        yield batch
+
+
+class HashEngine:
+    """Hashes FileRecords on a pool of threads or processes.
+
+    Records are sent to the pool in batches of batch_size, so with the process
+    backend the per-file pickling overhead is amortised. At most 2 batches
+    per worker are in flight, which keeps memory bounded on huge trees, and
+    results are yielded in the same order as the input records.
+    """
+
+    backend: str
+    workers: int
+    hash_algo: str
+    read_options: ReadOptions
+    batch_size: int
+    partial_size: int
+
+    def __init__(
+        self,
+        backend: str,
+        workers: int,
+        hash_algo: str,
+        read_options: ReadOptions,
+        batch_size: int = 64,
+        partial_size: int = 16384,
+    ):
+        if backend not in HASH_BACKENDS:
+            raise ValueError(f"Unknown hash backend {backend}, expected one of {HASH_BACKENDS}")
+        self.backend = backend
+        self.workers = workers
+        self.hash_algo = hash_algo
+        self.read_options = read_options
+        self.batch_size = batch_size
+        self.partial_size = partial_size
+        self.executor = None
+
+    @classmethod
+    def from_config(cls, config, backend: str = None, workers: int = None):
+        return cls(
+            backend or config.HASH_BACKEND,
+            workers or config.WORKERS,
+            config.HASH_ALGO,
+            ReadOptions.from_config(config),
+            config.HASH_BATCH_SIZE,
+            config.PARTIAL_HASH_SIZE,
+        )
+
+    def __enter__(self):
+        if self.backend == "process":
+            # the pool can be started from a pipeline thread, and forking a
+            # multi-threaded process can deadlock the child
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context(start_method)
+            )
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self
+
+    def __exit__(self, *exc):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.executor = None
+        return False
+
+    def map_batches(self, func, file_records: Iterable[FileRecord], *args):
+        assert self.executor is not None, "HashEngine must be used as a context manager"
+        in_flight = deque()
+        for batch in batched(file_records, self.batch_size):
+            in_flight.append(self.executor.submit(func, batch, *args))
+            if len(in_flight) >= 2 * self.workers:
+                yield from in_flight.popleft().result()
+        while in_flight:
+            yield from in_flight.popleft().result()
+
+    def hash_records(self, file_records: Iterable[FileRecord]):
+        return self.map_batches(hash_batch, file_records, self.hash_algo, self.read_options)
+
+    def partial_hash_records(self, file_records: Iterable[FileRecord]):
+        return self.map_batches(partial_hash_batch, file_records, self.hash_algo, self.partial_size)
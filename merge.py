@@ -7,11 +7,16 @@ from filecmp import cmp
 from functools import cache, wraps
 from pathlib import Path
 from shutil import copy2
-from time import sleep, time
+from time import perf_counter, sleep, time
 
 
 from config import MergeConfig
 from stats import ProcessStats
+from walker import walk
+from preflight import Preflight
+from rules import Rules, load_patterns
+from pipeline import NullSink, Pipeline
+from devices import DeviceScheduler
 import logging
 
 logger = logging.getLogger(__name__)
@@ -26,6 +31,8 @@ except ImportError as e:
 stats = ProcessStats()
 config = MergeConfig()
 
+PROGRESS_INTERVAL = 0.25  # seconds between progress bar updates while the copiers run
+
 
 def reset_stats():
     global stats
@@ -148,10 +155,17 @@ def calc_size(file_name):
 def clean_up(source_dir):
     assert "str" in str(type(source_dir))
     s = Path(source_dir).resolve()
-    for root, dirs, files in s.walk(top_down=False, on_error=walk_error):
+    # excluded directories and files stay in the source, with their parents
+    kept = set()
+    for root, dirs, files in walk(s, top_down=False, on_error=walk_error, rules=Rules(config.EXCLUDE)):
+        walked = set(dirs) | {f.name for f in files}
+        if any(name not in walked for name in os.listdir(s / root)):
+            kept.add(s / root)
         for d in dirs:
             t = s / root / d
-            if config.DO_CLEANUP_SOURCE:
+            if t in kept:
+                kept.add(s / root)
+            elif config.DO_CLEANUP_SOURCE:
                 t.rmdir()
             else:
                 print_or_quiet(f'rm -r "{t}"')
@@ -181,34 +195,42 @@ def generate_filename(destination_file):
     return possible_destination_name
 
 
-def merge_file(source_file, destination_file):
+def merge_file(source_file, destination_file, source_size=None):
     assert "Path" in str(type(source_file))
     assert "Path" in str(type(destination_file))
-    source_size = calc_size(source_file)
+    if source_size is None:
+        source_size = calc_size(source_file)
     stats.processed(source_size)
+    # excluded files are pruned by the walk and never get here, ignored ones are deleted without a copy
     if config.DO_IGNORE and config.IGNORE_PATH in str(source_file):
+        ignore_file(source_file)
+        stats.ignored(source_size)
+    elif Path(destination_file).is_file():
+        with stats.timed("compare", source_size):
+            issame = file_issame(source_file, destination_file)
+        if not issame:
+            # file exists but is different
+            destination_file = generate_filename(destination_file)
+            with stats.timed("copy", source_size):
+                copied = copy_file(source_file, destination_file)
+            if len(str(copied)) <= 0:
+                raise Exception(
+                    f"copy_file {source_file} -> {destination_file} failed!"
+                )
+            else:
+                stats.duplicated(source_size)
+        else:
             ignore_file(source_file)
             stats.ignored(source_size)
     else:
-        if Path(destination_file).is_file():
-            if not file_issame(source_file, destination_file):
-                # file exists but is different
-                destination_file = generate_filename(destination_file)
-                if len(str(copy_file(source_file, destination_file))) <= 0:
-                    raise Exception(
-                        f"copy_file {source_file} -> {destination_file} failed!"
-                    )
-                else:
-                    stats.duplicated(source_size)
-            else:
-                ignore_file(source_file)
-                stats.ignored(source_size)
+        with stats.timed("copy", source_size):
+            copied = copy_file(source_file, destination_file)
+        if len(str(copied)) <= 0:
+            raise Exception(f"copy_file {source_file} -> {destination_file} failed!")
         else:
-            if len(str(copy_file(source_file, destination_file))) <= 0:
-                raise Exception(f"copy_file {source_file} -> {destination_file} failed!")
-            else:
-                stats.copied(source_size)
-    delete_file(source_file)
+            stats.copied(source_size)
+    with stats.timed("delete", source_size):
+        delete_file(source_file)
     stats.deleted(
         source_size
     )  # TODO: stats.deleted should be inside the delete command
@@ -218,18 +240,72 @@ def walk_error(e):
     print_or_quiet("my Error", e)
 
 
-def tree_walk(source_dir, destination_dir):
+def source_files(s: Path, t: Path):
+    """(file_entry, source_file, destination_file) for every file under s."""
+    source_depth = len(s.parts)
+    begin = perf_counter()
+    for root, dirs, files in walk(s, top_down=True, on_error=walk_error, rules=Rules(config.EXCLUDE)):
+        stats.phase("stat", len(files), 0, perf_counter() - begin)
+        target_dir = t.joinpath(*root.parts[source_depth:])
+        for file_entry in files:
+            yield file_entry, root / file_entry.name, target_dir / file_entry.name
+        begin = perf_counter()
+
+
+def parallel_merge(s: Path, t: Path, bar):
+    """merge_file on a pool of copiers, grouped by the device of the source file.
+
+    Every source device gets config.WORKERS copiers, or ROTATIONAL_WORKERS
+    for a spinning disk, and every copy also takes a slot of the destination
+    device, so a spinning destination isn't written by more copiers than it
+    can take either.
+    """
+    scheduler = DeviceScheduler(config.WORKERS, config.ROTATIONAL_WORKERS)
+    destination_dev = t.stat().st_dev
+
+    def copy(item):
+        file_entry, source_file, destination_file = item
+        with scheduler.slots(file_entry.dev, destination_dev):
+            # the walk already stat'ed the file, no need for calc_size
+            merge_file(source_file, destination_file, file_entry.size)
+
+    pipeline = Pipeline(
+        source_files(s, t),
+        copy,
+        NullSink(),
+        config.WORKERS,
+        config.QUEUE_SIZE,
+        route=lambda item: item[0].dev,
+        limit=scheduler.limit,
+    )
+    shown = 0
+
+    def report(pipeline: Pipeline):
+        nonlocal shown
+        if pipeline.written > shown:
+            bar(pipeline.written - shown)
+            shown = pipeline.written
+        bar.text = stats.rate_text()
+
+    with pipeline:
+        pipeline.wait(PROGRESS_INTERVAL, report)
+    print_or_quiet(f"Copiers: {scheduler.describe(pipeline.queues)}")
+
+
+def tree_walk(source_dir, destination_dir, total: int = None):
     assert "str" in str(type(source_dir))
     assert "str" in str(type(destination_dir))
     s = Path(source_dir).resolve()
     t = Path(destination_dir).resolve()
-    source_depth = len(s.parts)
-    with alive_bar() as bar:
-        for root, dirs, files in s.walk(top_down=True, on_error=walk_error):
-            for f in files:
-                target_dir = t.joinpath(*root.parts[source_depth:])
-                merge_file(root / f, target_dir / f)
-                bar()
+    with alive_bar(total=total) as bar:
+        if config.WORKERS > 1:
+            parallel_merge(s, t, bar)
+            return
+        for file_entry, source_file, destination_file in source_files(s, t):
+            # the walk already stat'ed the file, no need for calc_size
+            merge_file(source_file, destination_file, file_entry.size)
+            bar()
+            bar.text = stats.rate_text()
 
 
 def get_stats():
@@ -252,6 +328,9 @@ def run(args):
     print(f"Destination: {destination}")
     print (config.show_config())
 
+    # sizing the job is metadata only, it runs while we wait anyway
+    preflight = Preflight(source, 0, rules=Rules(config.EXCLUDE)).start() if config.PREFLIGHT else None
+
     with alive_bar(total=config.SECURITY_TIMEOUT) as bar:
         i = 0
         while i < config.SECURITY_TIMEOUT:
@@ -259,9 +338,17 @@ def run(args):
             sleep(1)
             i += 1
 
+    total = None
+    if preflight is not None:
+        if not preflight.done():
+            print("Sizing the job ...")
+        job = preflight.result()
+        print(job.report())
+        total = job.files
+
     print(f"Merging ...")
 
-    tree_walk(source, destination)
+    tree_walk(source, destination, total)
     clean_up(source)
 
     print(
@@ -296,6 +383,26 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "-w", "--shallow", action="store_true", dest="DO_SHALLOW")
+    parser.add_argument(
+        "--exclude", action="append", dest="EXCLUDE", default=[], metavar="PATTERN",
+        help="gitignore style glob, or re:REGEX, of paths to leave in the source, untouched (can be repeated)",
+    )
+    parser.add_argument(
+        "--exclude-from", action="store", dest="EXCLUDE_FROM", default=None, metavar="FILE",
+        help="Read --exclude patterns from FILE, one per line",
+    )
+    parser.add_argument(
+        "--no-preflight", action="store_false", dest="PREFLIGHT",
+        help="Don't size the job (files, bytes, ETA) during the timeout countdown",
+    )
+    parser.add_argument(
+        "--workers", action="store", type=int, dest="WORKERS", default=1,
+        help="Files copied at once from every SSD source device (1 copies serially)",
+    )
+    parser.add_argument(
+        "--rotational-workers", action="store", type=int, dest="ROTATIONAL_WORKERS", default=1,
+        help="Files copied at once when the source or the destination is a spinning disk",
+    )
 
     args = parser.parse_args()
     print(args.source, args.destination, args)
@@ -310,11 +417,17 @@ if __name__ == "__main__":
     config.DO_STATS = args.DO_STATS
     config.SECURITY_TIMEOUT = max(5, args.SECURITY_TIMEOUT)  # in seconds
     config.DO_SHALLOW = args.DO_SHALLOW
+    config.PREFLIGHT = args.PREFLIGHT
+    config.WORKERS = max(1, args.WORKERS)
+    config.ROTATIONAL_WORKERS = max(1, args.ROTATIONAL_WORKERS)
     config.LOG_FILE_NOT_FOUND_ERRORS = True
     config.AUDIT_LOG_FILE = f"{os.getcwd()}/AUDIT_LOG_FILE-{session_id}.log"
     config.DO_SUPRESS_UNKNOWN_EXCEPTIONS = True
     config.DO_IGNORE = True
     config.IGNORE_PATH = "$RECYCLE.BIN"
+    config.EXCLUDE = args.EXCLUDE
+    if args.EXCLUDE_FROM:
+        config.EXCLUDE += load_patterns(args.EXCLUDE_FROM)
 
     begin = time()
     run(args)
@@ -0,0 +1,267 @@
+import os
+import logging
+import threading
+from queue import Empty, Full, Queue
+from typing import Callable, Iterable, List
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv("MERGELOGGING", "INFO"))
+
+# Sentinel put on a queue to tell the consumer that its producer is done
+_DONE = object()
+
+# how often a blocked put/get wakes up to check whether the pipeline was stopped
+_POLL_SECONDS = 0.1
+
+
+def interleave(sources: List[Iterable], queue_size: int = 1024):
+    """Drains every source on a thread of its own and yields their items as they come.
+
+    For walking several roots at once, one thread per device. The first
+    exception raised by a source is raised again here, and closing the
+    generator stops the threads.
+    """
+    if len(sources) == 1:
+        yield from sources[0]
+        return
+    queue = Queue(maxsize=queue_size)
+    stopped = threading.Event()
+    errors = []
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=_POLL_SECONDS)
+                return True
+            except Full:
+                pass
+        return False
+
+    def drain(source):
+        try:
+            for item in source:
+                if not put(item):
+                    return
+        except Exception as e:
+            errors.append(e)
+        finally:
+            put(_DONE)
+
+    for i, source in enumerate(sources):
+        threading.Thread(target=drain, args=(source,), name=f"walker-{i}", daemon=True).start()
+    try:
+        running = len(sources)
+        while running > 0:
+            item = queue.get()
+            if item is _DONE:
+                running -= 1
+                if errors:
+                    raise errors[0]
+            else:
+                yield item
+    finally:
+        stopped.set()
+
+
+class NullSink:
+    """Sink for pipelines whose work leaves nothing to write, Pipeline.written still counts."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def write(self, item):
+        pass
+
+
+class Pipeline:
+    """walker -> N workers -> single writer, on threads connected by bounded queues.
+
+    The walker thread drains source into the work queue, `workers` threads
+    apply work to every item and the writer thread passes the results, in
+    completion order, to sink.write inside a `with sink:` block. Both queues
+    hold at most queue_size items, so a slow stage makes the ones in front of
+    it block instead of piling up records in memory (backpressure).
+
+    Only the writer thread calls sink, so a sink holding a DataStore owns its
+    sqlite3 connection for the whole run while the other threads read and hash.
+    With work None the walker hands the items straight to the writer, for
+    sources that already do their work elsewhere (e.g. a process pool).
+
+    With route, items are grouped by route(item) (e.g. the device they are
+    on): every group gets its own bounded queue and limit(key) worker
+    threads, started when its first item shows up, so a slow group only
+    holds up its own items and never has more than its limit in flight.
+
+    The first exception raised in any stage stops the pipeline and is raised
+    again by wait().
+    """
+
+    source: Iterable
+    work: Callable
+    sink: object
+    workers: int
+    queue_size: int
+    route: Callable
+    limit: Callable
+    written: int
+
+    def __init__(
+        self,
+        source: Iterable,
+        work: Callable | None,
+        sink,
+        workers: int = 1,
+        queue_size: int = 1024,
+        route: Callable = None,
+        limit: Callable = None,
+    ):
+        self.source = source
+        self.work = work
+        self.sink = sink
+        self.workers = max(1, workers) if work is not None else 0
+        self.queue_size = queue_size
+        self.route = route
+        self.limit = limit or (lambda key: self.workers)
+        self.queues = {}  # route key -> (work queue, number of workers on it)
+        self.results = Queue(maxsize=queue_size)
+        self.expected_done = None  # _DONE the writer waits for, known once the walk is over
+        self.written = 0
+        self.max_depths = {}
+        self.error = None
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is not None:
+            self.stop()
+        for t in list(self.threads):
+            t.join()
+        return False
+
+    def depths(self) -> dict:
+        """Items waiting in front of each stage, a full queue points at the bottleneck.
+
+        With route, the items waiting for every group are listed as hash:key too.
+        """
+        queues = list(self.queues.items())
+        depths = {"hash": sum(queue.qsize() for key, (queue, workers) in queues)}
+        if self.route is not None:
+            for key, (queue, workers) in queues:
+                depths[f"hash:{key}"] = queue.qsize()
+        depths["write"] = self.results.qsize()
+        for stage, depth in depths.items():
+            self.max_depths[stage] = max(self.max_depths.get(stage, 0), depth)
+        return depths
+
+    def start(self):
+        walker = threading.Thread(target=self._walk, name="walker", daemon=True)
+        self.writer = threading.Thread(target=self._write, name="writer", daemon=True)
+        self.threads = [walker, self.writer]
+        if self.work is not None and self.route is None:
+            self._add_queue(None)
+        # from here on the walker adds the workers of every new route key
+        walker.start()
+        self.writer.start()
+
+    def _add_queue(self, key) -> Queue:
+        queue = Queue(maxsize=self.queue_size)
+        workers = max(1, self.limit(key))
+        self.queues[key] = (queue, workers)
+        for i in range(workers):
+            t = threading.Thread(target=self._work, args=(queue,), name=f"worker-{key}-{i}", daemon=True)
+            self.threads.append(t)
+            t.start()
+        return queue
+
+    def stop(self, error: Exception = None):
+        if error is not None and self.error is None:
+            self.error = error
+        self.stopped.set()
+
+    def wait(self, interval: float = None, on_tick: Callable = None):
+        """Blocks until the writer is done, calling on_tick(self) every interval seconds."""
+        while self.writer.is_alive():
+            self.writer.join(interval)
+            if on_tick is not None:
+                on_tick(self)
+        for t in list(self.threads):
+            t.join()
+        if self.error is not None:
+            raise self.error
+        return self.written
+
+    def _put(self, queue: Queue, item) -> bool:
+        while not self.stopped.is_set():
+            try:
+                queue.put(item, timeout=_POLL_SECONDS)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _get(self, queue: Queue):
+        while not self.stopped.is_set():
+            try:
+                return queue.get(timeout=_POLL_SECONDS)
+            except Empty:
+                pass
+        return _DONE
+
+    def _walk(self):
+        try:
+            for item in self.source:
+                if self.work is None:
+                    queue = self.results
+                elif self.route is None:
+                    queue = self.queues[None][0]
+                else:
+                    key = self.route(item)
+                    queue = self.queues[key][0] if key in self.queues else self._add_queue(key)
+                if not self._put(queue, item):
+                    return
+        except Exception as e:
+            self.stop(e)
+        finally:
+            queues = list(self.queues.values())
+            workers = sum(workers for queue, workers in queues)
+            # without workers the walker itself tells the writer it's done
+            self.expected_done = workers or 1
+            if workers == 0:
+                self._put(self.results, _DONE)
+            for queue, workers in queues:
+                for _ in range(workers):
+                    self._put(queue, _DONE)
+
+    def _work(self, queue: Queue):
+        try:
+            while (item := self._get(queue)) is not _DONE:
+                if not self._put(self.results, self.work(item)):
+                    return
+        except Exception as e:
+            self.stop(e)
+        finally:
+            self._put(self.results, _DONE)
+
+    def _write(self):
+        done = 0
+        try:
+            with self.sink:
+                # expected_done is set before the walker sends any _DONE
+                while self.expected_done is None or done < self.expected_done:
+                    item = self._get(self.results)
+                    if item is _DONE:
+                        if self.stopped.is_set():
+                            return
+                        done += 1
+                    else:
+                        self.sink.write(item)
+                        self.written += 1
+        except Exception as e:
+            self.stop(e)
@@ -0,0 +1,198 @@
+import os
+import logging
+import threading
+from datetime import timedelta
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, List
+
+from stats import sizeof_fmt
+from walker import walk
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv("MERGELOGGING", "INFO"))
+
+# name of the top-level "directory" holding the files directly under the source
+ROOT_FILES = "."
+
+
+class DirSize:
+    __slots__ = ("files", "bytes")
+
+    files: int
+    bytes: int
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+
+    def add(self, size: int):
+        self.files += 1
+        self.bytes += size
+
+
+class JobSize:
+    """Files and bytes a run will go through, from a metadata only walk.
+
+    dirs groups everything by top-level directory of the source. devices
+    only counts the files bigger than min_size, the ones whose content gets
+    read, by st_dev; together with throughput (bytes/s measured on each
+    device) that gives the ETA.
+    """
+
+    dirs: Dict[str, DirSize]
+    devices: Dict[int, DirSize]
+    samples: Dict[int, List]
+    throughput: Dict[int, float]
+    elapsed: float
+
+    def __init__(self):
+        self.dirs = {}
+        self.devices = {}
+        self.samples = {}
+        self.throughput = {}
+        self.elapsed = 0
+
+    def add(self, name: str, files, min_size: int, sample_files: int):
+        """Counts the FileEntry files of a directory under the top-level directory name."""
+        dir_size = self.dirs.setdefault(name, DirSize())
+        for file_entry in files:
+            if not file_entry.is_file:
+                continue
+            dir_size.add(file_entry.size)
+            if file_entry.size > min_size:
+                self.devices.setdefault(file_entry.dev, DirSize()).add(file_entry.size)
+                samples = self.samples.setdefault(file_entry.dev, [])
+                samples.append((file_entry.size, file_entry.path))
+                if len(samples) > sample_files:
+                    samples.remove(min(samples))
+
+    @property
+    def files(self) -> int:
+        return sum(d.files for d in self.dirs.values())
+
+    @property
+    def bytes(self) -> int:
+        return sum(d.bytes for d in self.dirs.values())
+
+    def eta(self) -> timedelta | None:
+        """Time to read the content of the job, devices read at the same time: the slowest one's."""
+        if not self.devices:
+            return timedelta(0)
+        seconds = 0
+        for dev, size in self.devices.items():
+            if not self.throughput.get(dev):
+                return None
+            seconds = max(seconds, size.bytes / self.throughput[dev])
+        return timedelta(seconds=round(seconds))
+
+    def report(self) -> str:
+        lines = [
+            f"Job: {self.files} files, {sizeof_fmt(self.bytes)} (sized in {self.elapsed:.1f}s)"
+        ]
+        for name, size in sorted(self.dirs.items()):
+            lines.append(f"  {name:<40} {size.files:>10} files {sizeof_fmt(size.bytes):>12}")
+        for dev, size in self.devices.items():
+            throughput = self.throughput.get(dev)
+            speed = f"{sizeof_fmt(throughput)}/s" if throughput else "unknown speed"
+            lines.append(f"  device {dev}: {sizeof_fmt(size.bytes)} to read at {speed}")
+        eta = self.eta()
+        lines.append(f"Estimated time: {eta if eta is not None else 'unknown'}")
+        return "\n".join(lines)
+
+
+def size_job(top: str | Path | List, min_size: int = 0, on_error=None, sample_files: int = 4, rules=None) -> JobSize:
+    """Walks top, or every root in a list, with stat only: nothing gets opened.
+
+    rules prune it like the run's walk. With several roots, job.dirs are
+    named by full path. The sample_files biggest files of every device are
+    kept in job.samples for measure_throughput.
+    """
+    begin = perf_counter()
+    tops = [Path(t) for t in top] if isinstance(top, (list, tuple)) else [Path(top)]
+    job = JobSize()
+    for top in tops:
+        top_depth = len(top.parts)
+        for root, dirs, files in walk(top, top_down=True, on_error=on_error, rules=rules):
+            name = root.parts[top_depth] if len(root.parts) > top_depth else ROOT_FILES
+            if len(tops) > 1:
+                name = str(top) if name == ROOT_FILES else str(top / name)
+            job.add(name, files, min_size, sample_files)
+    job.elapsed = perf_counter() - begin
+    return job
+
+
+def measure_throughput(file_names: List[str], budget: int, buf_size: int = 1024 * 1024) -> float | None:
+    """Bytes/s reading up to budget bytes from file_names, None if nothing could be read.
+
+    The pages are dropped from the cache afterwards where the platform
+    allows it, so the real run doesn't start from a warmer cache than it
+    would have.
+    """
+    buffer = bytearray(buf_size)
+    total = 0
+    begin = perf_counter()
+    for file_name in file_names:
+        try:
+            with open(file_name, "rb", buffering=0) as f:
+                while total < budget and (size := f.readinto(buffer)):
+                    total += size
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError as e:
+            logger.debug(f"can't sample {file_name}: {e}")
+        if total >= budget:
+            break
+    elapsed = perf_counter() - begin
+    if total == 0 or elapsed == 0:
+        return None
+    return total / elapsed
+
+
+class Preflight:
+    """size_job, and measure_throughput on every device, on a background thread.
+
+    Meant to be started before the SECURITY_TIMEOUT countdown so the
+    mandatory wait is spent sizing the job: start(), count down, result().
+    """
+
+    def __init__(
+        self,
+        top: str | Path | List,
+        min_size: int = 0,
+        on_error=None,
+        sample_budget: int = 64 * 1024 * 1024,
+        rules=None,
+    ):
+        self.top = top
+        self.rules = rules
+        self.min_size = min_size
+        self.on_error = on_error
+        self.sample_budget = sample_budget
+        self.job = None
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="preflight", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def done(self) -> bool:
+        return not self.thread.is_alive()
+
+    def result(self) -> JobSize:
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.job
+
+    def _run(self):
+        try:
+            job = size_job(self.top, self.min_size, self.on_error, rules=self.rules)
+            for dev, samples in job.samples.items():
+                job.throughput[dev] = measure_throughput(
+                    [path for size, path in sorted(samples, reverse=True)], self.sample_budget
+                )
+            self.job = job
+        except Exception as e:
+            self.error = e
@@ -0,0 +1,88 @@
+# the queries of the data.py reports. DataStore runs their SQL, a MemoryDataStore
+# runs its report_<report> method instead, from query.report and query.session_ids
+from data_store import DataQuery
+
+
+def list_sessions(query: DataQuery):
+    query.select_clause = 'session_id, count(*)'
+    query.from_clause = 'files'
+    query.group_clause = 'session_id'
+    query.report = 'sessions'
+    return query
+
+
+def list_duplicated(query: DataQuery, session_ids):
+    query_inner = DataQuery()
+    query_inner.select_clause = 'file_hash as file_hash, file_size as file_size, hash_algo as hash_algo, COUNT(*) as cnt'
+    query_inner.from_clause = 'files'
+    if len(session_ids) > 0:
+        query_inner.add_where(query_inner.format_query_in_clause('session_id', session_ids))
+    # files whose content wasn't read have no file_hash, only a skip_reason
+    query_inner.add_where('file_hash IS NOT NULL')
+    # hardlinks are the same inode, not duplicated content: only their first name counts
+    query_inner.add_where('link_of IS NULL')
+    # digests of different algorithms never match, even when they happen to be equal
+    query_inner.group_clause = 'file_size, file_hash, hash_algo'
+    query_inner.having_clause = 'cnt > 1'
+
+    query.select_clause = 'f.file_hash, f.file_size, f.file_name'
+    query.from_clause = f'''files AS f INNER JOIN ({query_inner.format_query()}) AS q ON f.file_hash == q.file_hash AND f.file_size == q.file_size AND f.hash_algo == q.hash_algo'''
+    query.add_where('f.link_of IS NULL')
+    # the subquery placeholders come first in the statement
+    query.params = query_inner.params + query.params
+    query.order_clause = 'f.file_hash, f.file_size'
+    query.report = 'duplicated'
+    query.session_ids = list(session_ids)
+    return query
+
+
+def list_duplicatedpaths(query: DataQuery, session_ids):
+    query.select_clause = 'file_name, COUNT(*) as cnt'
+    query.from_clause = 'files'
+    if len(session_ids) > 0:
+        query.add_where(query.format_query_in_clause('session_id', session_ids))
+    query.group_clause = 'file_size, file_hash, hash_algo'
+    query.having_clause = 'cnt > 1'
+    query.report = 'duplicatedpaths'
+    query.session_ids = list(session_ids)
+    return query
+
+
+def list_hardlinks(query: DataQuery, session_ids):
+    query.select_clause = 'link_of, file_name, file_size'
+    query.from_clause = 'files'
+    if len(session_ids) > 0:
+        query.add_where(query.format_query_in_clause('session_id', session_ids))
+    query.add_where('link_of IS NOT NULL')
+    query.order_clause = 'link_of, file_name'
+    query.report = 'hardlinks'
+    query.session_ids = list(session_ids)
+    return query
+
+
+def list_files(query: DataQuery, session_ids):
+    query.select_clause = '*'
+    query.from_clause = 'files'
+    if len(session_ids) > 0:
+        query.add_where(query.format_query_in_clause('session_id', session_ids))
+    query.add_where('file_hash IS NOT NULL')
+    query.report = 'files'
+    query.session_ids = list(session_ids)
+    return query
+
+
+def count_sessions(query: DataQuery):
+    query.select_clause = 'COUNT(DISTINCT session_id)'
+    query.from_clause = 'files'
+    query.report = 'count_sessions'
+    return query
+
+
+def count_files(query: DataQuery, session_ids):
+    query.select_clause = '*'
+    query.from_clause = 'files'
+    if len(session_ids) > 0:
+        query.add_where(query.format_query_in_clause('session_id', session_ids))
+    query.report = 'count_files'
+    query.session_ids = list(session_ids)
+    return query
@@ -0,0 +1,173 @@
+import os
+import re
+import logging
+from typing import Iterable, List
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv("MERGELOGGING", "INFO"))
+
+# a line starting with this is a regular expression instead of a glob
+REGEX_PREFIX = "re:"
+
+
+def glob_to_regex(glob: str) -> str:
+    """gitignore glob, without its leading ! or trailing /, to a regex for the whole path.
+
+    * and ? stop at /, ** also crosses directories. A glob without a / in
+    it matches the name at any depth, one with a / is relative to the root.
+    """
+    anchored = "/" in glob
+    glob = glob.lstrip("/")
+    regex = []
+    i = 0
+    while i < len(glob):
+        c = glob[i]
+        if glob.startswith("**/", i):
+            regex.append("(?:.*/)?")
+            i += 3
+            continue
+        if glob.startswith("**", i):
+            regex.append(".*")
+            i += 2
+            continue
+        if c == "*":
+            regex.append("[^/]*")
+        elif c == "?":
+            regex.append("[^/]")
+        elif c == "[" and (end := glob.find("]", i + 2)) > 0:
+            content = glob[i + 1 : end]
+            if content[0] == "!":
+                content = "^" + content[1:]
+            regex.append(f"[{content}]")
+            i = end
+        elif c == "\\" and i + 1 < len(glob):
+            i += 1
+            regex.append(re.escape(glob[i]))
+        else:
+            regex.append(re.escape(c))
+        i += 1
+    body = "".join(regex)
+    return f"^{body}$" if anchored else f"^(?:.*/)?{body}$"
+
+
+class Rule:
+    __slots__ = ("pattern", "regex", "negate", "dir_only")
+
+    pattern: str
+    regex: re.Pattern
+    negate: bool
+    dir_only: bool
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.negate = pattern.startswith("!")
+        if self.negate:
+            pattern = pattern[1:]
+        if pattern.startswith(REGEX_PREFIX):
+            self.dir_only = False
+            self.regex = re.compile(pattern[len(REGEX_PREFIX):])
+        else:
+            self.dir_only = pattern.endswith("/")
+            self.regex = re.compile(glob_to_regex(pattern.rstrip("/")))
+
+    def __repr__(self):
+        return f"Rule({self.pattern!r})"
+
+
+def parse_rules(lines: Iterable[str]) -> List[Rule]:
+    """One rule per line, blank lines and lines starting with # are skipped."""
+    rules = []
+    for line in lines:
+        line = line.rstrip("\n").rstrip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            rules.append(Rule(line))
+        except re.error as e:
+            raise ValueError(f"Invalid exclusion rule {line!r}: {e}") from e
+    return rules
+
+
+def load_patterns(file_name: str) -> List[str]:
+    with open(file_name) as f:
+        return [line.rstrip("\n") for line in f]
+
+
+def substring_patterns(lines: Iterable[str]) -> List[str]:
+    """Plain lines as re: rules matching them anywhere in the path, re: lines as they are.
+
+    For the exclude files of data.py, whose lines were always substrings of
+    the file_name: `backup` still leaves out /home/backups/a.jpg.
+    """
+    patterns = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith("#") and not line.startswith(REGEX_PREFIX):
+            line = REGEX_PREFIX + re.escape(line)
+        patterns.append(line)
+    return patterns
+
+
+class Rules:
+    """What to leave out of a walk, gitignore style, compiled once.
+
+    Globs follow .gitignore: `node_modules/` only matches directories,
+    `*.tmp` matches a name anywhere, `/build` only at the root, `**`
+    crosses directories and a leading `!` takes a path back in. Lines
+    starting with `re:` are regular expressions searched in the path. Paths
+    are matched relative to the root of the walk, with / separators, and
+    the last rule that matches decides.
+
+    Like git, nothing under an excluded directory can be taken back: the
+    walkers prune it and never list, stat or hash what's inside.
+    """
+
+    rules: List[Rule]
+
+    def __init__(self, patterns: Iterable[str] = ()):
+        self.rules = parse_rules(patterns)
+        if any(rule.negate for rule in self.rules):
+            self.dirs = self.files = None
+        else:
+            # without ! the order doesn't matter, a single search per path for all the globs
+            self.dirs = self._combine(self.rules)
+            self.files = self._combine([rule for rule in self.rules if not rule.dir_only])
+
+    @classmethod
+    def from_file(cls, file_name: str):
+        return cls(load_patterns(file_name))
+
+    @staticmethod
+    def _combine(rules: List[Rule]) -> List[re.Pattern]:
+        """The globs of rules as one regex, followed by the re: rules as they are.
+
+        re: rules aren't joined: inline flags like (?i) are only allowed at
+        the start of a pattern and group numbers of backreferences would shift.
+        """
+        globs = [rule for rule in rules if not rule.pattern.startswith(REGEX_PREFIX)]
+        combined = [rule.regex for rule in rules if rule.pattern.startswith(REGEX_PREFIX)]
+        if globs:
+            combined.insert(0, re.compile("|".join(f"(?:{rule.regex.pattern})" for rule in globs)))
+        return combined
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def excluded(self, path: str, is_dir: bool = False) -> bool:
+        """Whether path, relative to the root of the walk, is left out."""
+        if self.dirs is not None:
+            return any(regex.search(path) for regex in (self.dirs if is_dir else self.files))
+        for rule in reversed(self.rules):
+            if rule.dir_only and not is_dir:
+                continue
+            if rule.regex.search(path):
+                return not rule.negate
+        return False
+
+    def excluded_path(self, path: str) -> bool:
+        """excluded() for a file path outside of a walk: its directories count too."""
+        parts = path.strip("/").split("/")
+        for depth in range(1, len(parts)):
+            if self.excluded("/".join(parts[:depth]), is_dir=True):
+                return True
+        return self.excluded("/".join(parts))
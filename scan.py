@@ -5,13 +5,33 @@ import traceback
 import uuid
 from filecmp import cmp
 from functools import cache, wraps
+from itertools import chain
 from pathlib import Path
 from shutil import copy2
-from time import sleep
+from time import perf_counter, sleep
+from typing import List
 
 from config import ScanConfig
 from stats import ProcessStats
-from data_store import DataStore, FileRecord, ErrorRecord
+from data_store import DataStore, FileRecord, ErrorRecord, SessionWriter, WalkProgress, PRAGMA_PROFILES
+from walker import FileEntry, check_roots, path_entry, roots_by_device, walk
+from pipeline import Pipeline, interleave
+from devices import DeviceScheduler, physical_order
+from preflight import Preflight
+from rules import Rules, load_patterns
+from hashing import (
+    HASH_ALGORITHMS,
+    HASH_BACKENDS,
+    READ_STRATEGIES,
+    HashEngine,
+    LinkCache,
+    ReadOptions,
+    bench_hash_algorithms,
+    bench_read_strategies,
+    digest_file,
+    mark_unique_partials,
+    mark_unique_sizes,
+)
 import logging
 
 logger = logging.getLogger(__name__)
@@ -25,7 +45,13 @@ except ImportError as e:
 
 stats = ProcessStats()
 config = ScanConfig()
-ds = DataStore(config.DATASTORE)
+ds = DataStore(config.DATASTORE, config.DATASTORE_PROFILE)
+PROGRESS_INTERVAL = 0.25  # seconds between progress bar updates from the pipeline
+previous_session = {}  # file_name -> (file_size, st_mtime_ns, st_ino, st_dev, file_hash, partial_hash, hash_algo)
+walk_progress = None  # WalkProgress of the running session
+completed_dirs = set()  # directories a resumed session already has all the files of
+recorded_files = set()  # files a resumed session already has, outside of completed_dirs
+links = LinkCache()  # digests of hardlinked inodes, one per run
 
 
 def reset_stats():
@@ -78,38 +104,112 @@ def handle_exception(func):
     return handle_exception_inner
 
 @handle_exception
-def calc_size(file_name):
+def hash_file(file_name: str):
     assert "Path" in str(type(file_name))
-    if (
-        file_name.is_file()
-    ):  # this is an extra fs call but due to handling exception it is better to do this, except performance is critical
-        return file_name.stat().st_size
-    else:
-        return 0
+    return digest_file(file_name, config.HASH_ALGO, ReadOptions.from_config(config))
 
 @handle_exception
-def hash_file(file_name: str):
+def stat_file(file_name):
     assert "Path" in str(type(file_name))
-    hash_function = config.HASH_FUNCTION()
+    return path_entry(file_name)
 
-    with file_name.open('rb') as f:
-        while True:
-            data = f.read(config.BUF_SIZE)
-            if not data:
-                break
-            hash_function.update(data)
-    
-    return hash_function.hexdigest()
 
-def save_data(file_name: Path) -> bool:
-    assert "Path" in str(type(file_name))
-    file_size = calc_size(file_name)
-    if file_size > config.SIZE_THRESHOLD:
-        hash = hash_file(file_name)
+def load_previous_session(session_id: str) -> int:
+    global previous_session
+    previous_session = {}
+    for file_name, *fingerprint in ds.get_fingerprints(session_id):
+        previous_session[file_name] = tuple(fingerprint)
+    return len(previous_session)
+
+
+def load_checkpoint(session_id: str):
+    global completed_dirs, recorded_files
+    completed_dirs, recorded_files = ds.get_checkpoint(session_id)
+    return len(completed_dirs), len(recorded_files)
+
+
+def is_digest(hash: str) -> bool:
+    # the sentinels only mean something within the run that stored them
+    return hash not in (
+        None,
+        "None",
+        config.UNDER_THRESHOLD_TEXT,
+        config.UNIQUE_SIZE_TEXT,
+        config.UNIQUE_PARTIAL_TEXT,
+    )
+
+
+def reuse_previous_hashes(file_record: FileRecord):
+    previous = previous_session.get(file_record.file_name)
+    if previous is None:
+        return
+    file_size, st_mtime_ns, st_ino, st_dev, file_hash, partial_hash, hash_algo = previous
+    if (file_size, st_mtime_ns, st_ino, st_dev, hash_algo) != (
+        file_record.file_size,
+        file_record.st_mtime_ns,
+        file_record.st_ino,
+        file_record.st_dev,
+        file_record.hash_algo,
+    ):
+        return
+    file_record.partial_hash = partial_hash
+    if is_digest(file_hash):
+        file_record.file_hash = file_hash
+
+
+def stat_record(file_entry: FileEntry) -> FileRecord:
+    """Returns the record of file_name with everything but the hash of its content.
+
+    file_hash is already set when the content doesn't need to be read: files
+    under SIZE_THRESHOLD, and files whose stat fingerprint matches the session
+    we are running incrementally from.
+    """
+    file_record = FileRecord(
+        config.SESSION_ID,
+        file_entry.path,
+        file_entry.size,
+        config.TIMESTAMP,
+        None,
+        file_entry.mtime_ns,
+        file_entry.ino,
+        file_entry.dev,
+        hash_algo=config.HASH_ALGO,
+    )
+    if file_entry.nlink > 1:
+        file_record.link_of = links.claim(file_record)
+    if file_record.file_size <= config.SIZE_THRESHOLD:
+        file_record.file_hash = config.UNDER_THRESHOLD_TEXT
     else:
-        hash = config.UNDER_THRESHOLD_TEXT
-    
-    file_record = FileRecord(config.SESSION_ID, str(file_name), file_size, config.TIMESTAMP, hash)
+        reuse_previous_hashes(file_record)
+    if file_record.file_hash is not None:
+        links.publish(file_record)
+    return file_record
+
+
+def hash_record(file_record: FileRecord) -> FileRecord:
+    if file_record.file_hash is None and file_record.link_of is not None:
+        # another name of an inode that is read once
+        file_record.file_hash = links.wait(file_record)
+        if file_record.file_hash is not None:
+            stats.phase("link", 1, file_record.file_size)
+    try:
+        if file_record.file_hash is None:
+            with stats.timed("hash", file_record.file_size):
+                file_record.file_hash = hash_file(Path(file_record.file_name))
+    finally:
+        # published even when it failed, its links read the file themselves then
+        links.publish(file_record)
+    return file_record
+
+
+def build_record(file_name: Path) -> FileRecord:
+    assert "Path" in str(type(file_name))
+    file_entry = stat_file(file_name) or FileEntry(file_name.name, str(file_name))
+    return hash_record(stat_record(file_entry))
+
+
+def save_data(file_name: Path) -> bool:
+    file_record = build_record(file_name)
     ds.insert_file(file_record)
     return file_record
 
@@ -121,33 +221,189 @@ def ignore_file(source_file):
 
 def walk_error(e):
     print_or_quiet("my Error", e)
+    if isinstance(e, FileNotFoundError) and config.LOG_FILE_NOT_FOUND_ERRORS:
+        audit_exceptions(e)
+
+
+def walk_files(s: Path):
+    begin = perf_counter()
+    for root, dirs, files in walk(s, top_down=True, on_error=walk_error, rules=Rules(config.EXCLUDE)):
+        # walk lists and stats a whole directory before yielding it
+        stats.phase("stat", len(files), 0, perf_counter() - begin)
+        dir_name = str(root)
+        if dir_name in completed_dirs:
+            # its subdirectories may not be, so only its own files are skipped
+            begin = perf_counter()
+            continue
+        if recorded_files:
+            files = [f for f in files if f.path not in recorded_files]
+        if walk_progress is not None:
+            walk_progress.walked(dir_name, len(files))
+        yield from files
+        begin = perf_counter()
 
 
-def tree_walk(source_dir):
-    assert "str" in str(type(source_dir))
-    s = Path(source_dir).resolve()
-    source_depth = len(s.parts)
-    with alive_bar() as bar:
-        for root, dirs, files in s.walk(top_down=True, on_error=walk_error):
-            for f in files:
-                save_data(root / f)
-                bar()
+@handle_exception
+def raise_hash_error(e: Exception):
+    raise e
+
+
+def process_records(file_records, workers: int):
+    """Hashes file_records in worker processes, for CPU-bound digests, and yields them."""
+    engine = HashEngine.from_config(config, "process", workers)
+    # records come back as copies, so the ones sent for hashing are known by name
+    to_hash = set()
+
+    def track(file_records):
+        for file_record in file_records:
+            if file_record.file_hash is None and file_record.link_of is not None:
+                # the feeder can't wait for the pool, a primary still in it means reading twice
+                file_record.file_hash = links.known(file_record)
+            if file_record.file_hash is None:
+                to_hash.add(file_record.file_name)
+            yield file_record
+
+    with engine:
+        for file_record, error in engine.hash_records(track(file_records)):
+            links.publish(file_record)
+            if error:
+                raise_hash_error(error)
+            if file_record.file_name in to_hash:
+                to_hash.discard(file_record.file_name)
+                # the time is spent in the pool, only the rates are known here
+                stats.phase("hash", 1, file_record.file_size)
+            yield file_record
+
+
+def partial_records(file_records):
+    # a digest reused from INCREMENTAL_FROM is only read when files of its size still need hashing
+    pending_sizes = {r.file_size for r in file_records if r.file_hash is None}
+    to_read = [i for i, r in enumerate(file_records) if r.file_hash is None or r.file_size in pending_sizes]
+    engine = HashEngine.from_config(config)
+    checked = list(file_records)
+    with engine:
+        results = engine.partial_hash_records(file_records[i] for i in to_read)
+        for i, (file_record, error) in zip(to_read, results):
+            if error:
+                raise_hash_error(error)
+            checked[i] = file_record
+    return mark_unique_partials(checked, config.UNIQUE_PARTIAL_TEXT)
+
+
+def walk_roots(roots: List[Path]):
+    """walk_files of every root, the roots of each device walked on a thread of their own."""
+    walks = [chain.from_iterable(map(walk_files, device_roots)) for device_roots in roots_by_device(roots)]
+    return interleave(walks, config.QUEUE_SIZE)
+
+
+def pending_records(roots: List[Path]):
+    """Yields the stat'ed records under roots, only the ones with file_hash None need hashing.
+
+    The optional stages in front of the full hash go from cheapest to most
+    expensive: size only, then a digest of the head and tail of the file.
+    """
+    # records come out of a single thread, so the first name of a hardlinked inode is well defined
+    file_records = map(stat_record, walk_roots(roots))
+    if config.SIZE_PREPASS or config.PARTIAL_HASH:
+        file_records = mark_unique_sizes(file_records, config.UNIQUE_SIZE_TEXT)
+        unique = sum(1 for r in file_records if r.file_hash == config.UNIQUE_SIZE_TEXT)
+        print_or_quiet(f"{unique} of {len(file_records)} files have a unique size and won't be hashed")
+    if config.PARTIAL_HASH:
+        file_records = partial_records(file_records)
+        unique = sum(1 for r in file_records if r.file_hash == config.UNIQUE_PARTIAL_TEXT)
+        print_or_quiet(f"{unique} of {len(file_records)} files have a unique head/tail and won't be fully hashed")
+    return file_records
+
+
+def tree_walk(source_dirs: str | List[str], total: int = None):
+    """Scans one source directory, or several into the same session."""
+    global walk_progress, links
+    if isinstance(source_dirs, str):
+        source_dirs = [source_dirs]
+    roots = check_roots(source_dirs)
+    walk_progress = WalkProgress(config.SESSION_ID)
+    links = LinkCache()
+    file_records = pending_records(roots)
+    if config.PHYSICAL_ORDER:
+        file_records = physical_order(file_records, config.ORDER_BATCH)
+    work = hash_record
+    scheduler = DeviceScheduler(config.WORKERS, config.ROTATIONAL_WORKERS)
+    route = None
+    if config.WORKERS > 1 and config.HASH_BACKEND == "process":
+        # the pool does the hashing, the walker thread just feeds it
+        file_records = process_records(file_records, config.WORKERS)
+        work = None
+    else:
+        # hashers per device, records that don't need reading go to their own group (None)
+        route = lambda file_record: file_record.st_dev if file_record.file_hash is None else None
+    # the writer thread is the only one using the DataStore connection while the pipeline runs
+    writer = SessionWriter(
+        ds,
+        config.COMMIT_ROWS,
+        config.COMMIT_INTERVAL_MS,
+        walk_progress,
+        lambda rows, seconds: stats.phase("db", rows, 0, seconds),
+    )
+    pipeline = Pipeline(
+        file_records, work, writer, config.WORKERS, config.QUEUE_SIZE, route=route, limit=scheduler.limit
+    )
+    shown = 0
+
+    def report(pipeline: Pipeline):
+        nonlocal shown
+        if pipeline.written > shown:
+            bar(pipeline.written - shown)
+            shown = pipeline.written
+        depths = ", ".join(f"{stage} queue {depth}" for stage, depth in pipeline.depths().items())
+        bar.text = f"{depths} | {stats.rate_text()}"
+
+    with alive_bar(total=total) as bar, pipeline:
+        pipeline.wait(PROGRESS_INTERVAL, report)
+    if route is not None:
+        print_or_quiet(f"Hashers: {scheduler.describe(dev for dev in pipeline.queues if dev is not None)}")
+    print_or_quiet(
+        "Peak queue depths: "
+        + ", ".join(f"{stage} {depth}/{config.QUEUE_SIZE}" for stage, depth in pipeline.max_depths.items())
+    )
 
 
 def get_stats():
     return stats
 
 
+def print_hash_benchmark(total_size: int):
+    print(f"Hashing {total_size // (1024 * 1024)}MiB from memory in {config.BUF_SIZE} bytes chunks:")
+    for hash_algo, throughput in bench_hash_algorithms(total_size, config.BUF_SIZE):
+        print(f"  {hash_algo:<12} {throughput:10.1f} MB/s")
+
+
+def print_read_benchmark(file_name: Path):
+    print(f"Hashing {file_name} ({config.HASH_ALGO}) with every read strategy:")
+    for read_strategy, throughput in bench_read_strategies(file_name, config.HASH_ALGO, config.BUF_SIZE):
+        print(f"  {read_strategy:<12} {throughput:10.1f} MB/s")
+
+
 def run(args):
     source = args.source
 
-    if not Path(source).resolve().is_dir():
-        print(f"Source: {source} - is not a directory. Aborting")
+    for source_dir in source:
+        if not Path(source_dir).resolve().is_dir():
+            print(f"Source: {source_dir} - is not a directory. Aborting")
+            sys.exit(1)
+    try:
+        check_roots(source)
+    except ValueError as e:
+        print(f"Source: {e}. Aborting")
         sys.exit(1)
 
-    print(f"Source: {source} - files will be deleted from this directory after copied")
+    print(f"Source: {', '.join(source)}")
     print (config.show_config())
 
+    # sizing the job is metadata only, it runs while we wait anyway
+    preflight = None
+    if config.PREFLIGHT:
+        preflight = Preflight(source, config.SIZE_THRESHOLD, rules=Rules(config.EXCLUDE)).start()
+
     with alive_bar(total=config.SECURITY_TIMEOUT) as bar:
         i = 0
         while i < config.SECURITY_TIMEOUT:
@@ -155,9 +411,27 @@ def run(args):
             sleep(1)
             i += 1
 
+    total = None
+    if preflight is not None:
+        if not preflight.done():
+            print("Sizing the job ...")
+        job = preflight.result()
+        print(job.report())
+        total = job.files
+
+    ds.apply_profile(config.DATASTORE_PROFILE)
+
+    if config.RESUME:
+        dir_count, file_count = load_checkpoint(config.SESSION_ID)
+        print(f"Resuming session {config.SESSION_ID}: skipping {dir_count} completed directories and {file_count} more files")
+
+    if config.INCREMENTAL_FROM:
+        count = load_previous_session(config.INCREMENTAL_FROM)
+        print(f"Loaded {count} fingerprints from session {config.INCREMENTAL_FROM}")
+
     print(f"Scanning ...")
 
-    tree_walk(source)
+    tree_walk(source, total)
 
     print(
         f"""Session Id (in case you want to file new files was): {config.SESSION_ID}."""
@@ -173,7 +447,7 @@ if __name__ == "__main__":
         description="Scan of directories",
         epilog="Use carefully",
     )
-    parser.add_argument("source")
+    parser.add_argument("source", nargs="*", help="Directories scanned into the same session, walked concurrently per device")
     parser.add_argument(
         "-i", "--ignore", action="store_false", dest="IGNORE_DOT_UNDERSCORE_FILES"
     )
@@ -182,13 +456,112 @@ if __name__ == "__main__":
     parser.add_argument(
         "-t", "--timeout", action="store", type=int, dest="SECURITY_TIMEOUT", default=30
     )
+    parser.add_argument(
+        "-w", "--workers", action="store", type=int, dest="WORKERS", default=1,
+        help="Threads hashing files from every SSD device while the directory walk continues",
+    )
+    parser.add_argument(
+        "--rotational-workers", action="store", type=int, dest="ROTATIONAL_WORKERS", default=1,
+        help="Threads hashing files from every spinning disk, more only makes it seek",
+    )
+    parser.add_argument(
+        "--hash-algo", action="store", choices=list(HASH_ALGORITHMS), dest="HASH_ALGO", default="md5",
+        help="Digest used for file hashes, stored with every record",
+    )
+    parser.add_argument(
+        "--bench-hash", action="store_true", dest="BENCH_HASH",
+        help="Measure the throughput of every hash algorithm on this machine and exit",
+    )
+    parser.add_argument(
+        "--read-strategy", action="store", choices=READ_STRATEGIES, dest="READ_STRATEGY", default="readinto",
+        help="How file content is fed to the hash: read() copies, readinto() a reused buffer, or mmap for big files",
+    )
+    parser.add_argument(
+        "--bench-read", action="store", dest="BENCH_READ", default=None, metavar="FILE",
+        help="Measure the throughput of every read strategy hashing FILE and exit",
+    )
+    parser.add_argument(
+        "--hash-backend", action="store", choices=HASH_BACKENDS, dest="HASH_BACKEND", default="thread",
+        help="Hash with a pool of threads or of processes (only used with --workers > 1)",
+    )
+    parser.add_argument(
+        "--physical-order", action="store_true", dest="PHYSICAL_ORDER",
+        help="Hash files in the order their data sits on disk (FIEMAP extent, else inode), for spinning disks",
+    )
+    parser.add_argument(
+        "--size-prepass", action="store_true", dest="SIZE_PREPASS",
+        help="Stat the whole tree first and only hash files that share their size with another file",
+    )
+    parser.add_argument(
+        "--partial-hash", action="store_true", dest="PARTIAL_HASH",
+        help="After the size pre-pass, only fully hash files whose first and last KB match another file",
+    )
+    parser.add_argument(
+        "--commit-rows", action="store", type=int, dest="COMMIT_ROWS", default=1000,
+        help="Files written to the datastore per transaction",
+    )
+    parser.add_argument(
+        "--commit-interval", action="store", type=int, dest="COMMIT_INTERVAL_MS", default=1000,
+        help="Commit pending files at least this often, in milliseconds",
+    )
+    parser.add_argument(
+        "--datastore-profile", action="store", choices=list(PRAGMA_PROFILES), dest="DATASTORE_PROFILE", default="fast",
+        help="SQLite settings: safe fsyncs every commit, fast uses WAL, a bigger cache and mmap",
+    )
+    parser.add_argument(
+        "--exclude", action="append", dest="EXCLUDE", default=[], metavar="PATTERN",
+        help="gitignore style glob, or re:REGEX, of paths to leave out of the walk (can be repeated)",
+    )
+    parser.add_argument(
+        "--exclude-from", action="store", dest="EXCLUDE_FROM", default=None, metavar="FILE",
+        help="Read --exclude patterns from FILE, one per line",
+    )
+    parser.add_argument(
+        "--no-preflight", action="store_false", dest="PREFLIGHT",
+        help="Don't size the job (files, bytes, ETA) during the timeout countdown",
+    )
+    parser.add_argument(
+        "--resume", action="store", dest="RESUME", default="", metavar="SESSION_ID",
+        help="Continue a session that stopped, skipping the files it already recorded",
+    )
+    parser.add_argument(
+        "--incremental-from", action="store", dest="INCREMENTAL_FROM", default="",
+        help="Reuse the hash recorded in this session for files whose size, mtime, inode and device didn't change",
+    )
     args = parser.parse_args()
+    if args.BENCH_HASH:
+        print_hash_benchmark(256 * 1024 * 1024)
+        sys.exit(0)
+    if args.BENCH_READ:
+        config.HASH_ALGO = args.HASH_ALGO
+        print_read_benchmark(Path(args.BENCH_READ))
+        sys.exit(0)
+    if not args.source:
+        parser.error("the following arguments are required: source")
+    if args.RESUME and (args.SIZE_PREPASS or args.PARTIAL_HASH):
+        # the unique size/partial marks only hold among the files of one run
+        parser.error("--resume can't be combined with --size-prepass or --partial-hash")
     print(args.source, args)
-    config.SESSION_ID = get_session_id()
+    config.SESSION_ID = args.RESUME or get_session_id()
+    config.RESUME = bool(args.RESUME)
+    config.PREFLIGHT = args.PREFLIGHT
+    config.EXCLUDE = args.EXCLUDE + (load_patterns(args.EXCLUDE_FROM) if args.EXCLUDE_FROM else [])
     config.IGNORE_DOT_UNDERSCORE_FILES = args.IGNORE_DOT_UNDERSCORE_FILES
     config.DO_QUIET = args.DO_QUIET
     config.DO_STATS = args.DO_STATS
     config.SECURITY_TIMEOUT = max(5, args.SECURITY_TIMEOUT)  # in seconds
+    config.WORKERS = max(1, args.WORKERS)
+    config.ROTATIONAL_WORKERS = max(1, args.ROTATIONAL_WORKERS)
+    config.HASH_BACKEND = args.HASH_BACKEND
+    config.PHYSICAL_ORDER = args.PHYSICAL_ORDER
+    config.HASH_ALGO = args.HASH_ALGO
+    config.READ_STRATEGY = args.READ_STRATEGY
+    config.INCREMENTAL_FROM = args.INCREMENTAL_FROM
+    config.SIZE_PREPASS = args.SIZE_PREPASS
+    config.COMMIT_ROWS = max(1, args.COMMIT_ROWS)
+    config.COMMIT_INTERVAL_MS = args.COMMIT_INTERVAL_MS
+    config.DATASTORE_PROFILE = args.DATASTORE_PROFILE
+    config.PARTIAL_HASH = args.PARTIAL_HASH
     config.LOG_FILE_NOT_FOUND_ERRORS = True
     config.AUDIT_LOG_FILE = f"{os.getcwd()}/AUDIT_LOG_FILE-{config.SESSION_ID}.log"
     config.DO_SUPRESS_UNKNOWN_EXCEPTIONS = True
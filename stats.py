@@ -1,8 +1,12 @@
 from dataclasses import dataclass
 import os
 import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
 from functools import wraps
 from datetime import datetime
+from time import monotonic, perf_counter
 
 logger = logging.getLogger(__name__)
 logger.setLevel(os.getenv("MERGELOGGING", "INFO"))
@@ -16,6 +20,52 @@ def sizeof_fmt(num, suffix="B"):
     return f"{num:.1f}Yi{suffix}"
 
 
+def rate_fmt(files: float, size: float) -> str:
+    if not size:
+        return f"{files:.1f} files/s"
+    return f"{files:.1f} files/s {sizeof_fmt(size)}/s"
+
+
+class PhaseRate:
+    """Files, bytes and busy seconds of one phase of a run (stat, hash, db, copy ...).
+
+    busy is the time spent inside the phase, summed over the threads doing
+    it, so size / busy is how fast the phase goes on its own while the rates
+    over the wall clock (overall and over the last window seconds) are what
+    the run gets out of it. The window is kept as one bucket per second.
+    """
+
+    __slots__ = ("files", "bytes", "busy", "window", "buckets")
+
+    def __init__(self, window: int = 10):
+        self.files = 0
+        self.bytes = 0
+        self.busy = 0.0
+        self.window = window
+        self.buckets = deque()  # [second, files, bytes]
+
+    def add(self, files: int, size: int, seconds: float, now: float):
+        self.files += files
+        self.bytes += size
+        self.busy += seconds
+        second = int(now)
+        if self.buckets and self.buckets[-1][0] == second:
+            self.buckets[-1][1] += files
+            self.buckets[-1][2] += size
+        else:
+            self.buckets.append([second, files, size])
+        while self.buckets[0][0] <= second - self.window:
+            self.buckets.popleft()
+
+    def window_rate(self, now: float, started: float):
+        """(files/s, bytes/s) over the last window seconds, or since started if shorter."""
+        since = max(int(now) - self.window + 1, started)
+        elapsed = max(now - since, 1e-9)
+        files = sum(b[1] for b in self.buckets if b[0] >= int(since))
+        size = sum(b[2] for b in self.buckets if b[0] >= int(since))
+        return files / elapsed, size / elapsed
+
+
 @dataclass
 class ProcessStats:
     processed_files_size: int
@@ -40,29 +90,88 @@ class ProcessStats:
         self.copied_files_count = 0
         self.duplicated_files_count = 0
 
+        self.started = None  # first phase recorded, the countdown before doesn't count
+        self.phases = {}  # phase name -> PhaseRate, in the order phases first show up
+        self.lock = threading.Lock()  # fed from the pipeline threads and merge's copiers
+        self.rate_text_at = 0
+        self.rate_text_cached = ""
+
+    def phase(self, name: str, files: int = 1, size: int = 0, seconds: float = 0.0):
+        now = monotonic()
+        with self.lock:
+            if self.started is None:
+                self.started = now
+            if name not in self.phases:
+                self.phases[name] = PhaseRate()
+            self.phases[name].add(files, size, seconds, now)
+
+    @contextmanager
+    def timed(self, name: str, size: int = 0, files: int = 1):
+        begin = perf_counter()
+        try:
+            yield
+        finally:
+            self.phase(name, files, size, perf_counter() - begin)
+
+    def rate_text(self, refresh: float = 0.5) -> str:
+        """Moving window rate of every phase, for the progress bar text."""
+        now = monotonic()
+        if now - self.rate_text_at >= refresh:
+            with self.lock:
+                rates = [
+                    (name, phase.window_rate(now, self.started))
+                    for name, phase in self.phases.items()
+                ]
+            self.rate_text_cached = " | ".join(
+                f"{name} {rate_fmt(files, size)}" for name, (files, size) in rates
+            )
+            self.rate_text_at = now
+        return self.rate_text_cached
+
+    def throughput_report(self) -> str:
+        elapsed = max(monotonic() - (self.started or monotonic()), 1e-9)
+        lines = [f"Throughput over {elapsed:.1f}s:"]
+        for name, phase in self.phases.items():
+            line = f"  {name:<8} {phase.files:>10} files {sizeof_fmt(phase.bytes):>10}  {rate_fmt(phase.files / elapsed, phase.bytes / elapsed)}"
+            if phase.busy > 0:
+                line += f"  busy {phase.busy:.1f}s"
+                if phase.bytes:
+                    line += f" ({sizeof_fmt(phase.bytes / phase.busy)}/s while busy)"
+            lines.append(line)
+        if any(phase.busy > 0 for phase in self.phases.values()):
+            busiest = max(self.phases, key=lambda name: self.phases[name].busy)
+            lines.append(f"  most busy time: {busiest}")
+        return "\n".join(lines)
+
     def deleted(self, size: int):
-        self.deleted_files_count += 1
-        self.deleted_files_size += size
+        with self.lock:
+            self.deleted_files_count += 1
+            self.deleted_files_size += size
 
     def processed(self, size: int):
-        self.processed_files_count += 1
-        self.processed_files_size += size
+        with self.lock:
+            self.processed_files_count += 1
+            self.processed_files_size += size
 
     def ignored(self, size: int):
-        self.ignored_files_count += 1
-        self.ignored_files_size += size
+        with self.lock:
+            self.ignored_files_count += 1
+            self.ignored_files_size += size
 
     def deleted(self, size: int):
-        self.deleted_files_count += 1
-        self.deleted_files_size += size
+        with self.lock:
+            self.deleted_files_count += 1
+            self.deleted_files_size += size
 
     def copied(self, size: int):
-        self.copied_files_count += 1
-        self.copied_files_size += size
+        with self.lock:
+            self.copied_files_count += 1
+            self.copied_files_size += size
 
     def duplicated(self, size: int):
-        self.duplicated_files_count += 1
-        self.duplicated_files_size += size
+        with self.lock:
+            self.duplicated_files_count += 1
+            self.duplicated_files_size += size
 
     def print_stats(self):
         total_msg = f"""
@@ -86,6 +195,9 @@ Size of duplicated files: {sizeof_fmt(self.duplicated_files_size)}"""
         print(delete_msg)
         print(ignored_msg)
         print(duplicated_msg)
+        if self.phases:
+            print()
+            print(self.throughput_report())
         print("***********************************************")
 
 
@@ -1,4 +1,8 @@
-from data_store import DataStore, FileRecord, ErrorRecord, DataQuery
+from data_store import DataStore, MemoryDataStore, FileRecord, ErrorRecord, DataQuery, SessionWriter, WalkProgress
+import json
+import struct
+import sys
+import sqlite3
 import uuid
 from typing import Any
 import pytest
@@ -127,11 +131,12 @@ def test_get_at_least_one_record(open_default_db):
 
 def test_query_creation(open_default_db):
     ds = open_default_db
-    ret = ds.create_query_stmt("errors", session_id=1, file_name="pp")
+    ret, params = ds.create_query_stmt("errors", session_id=1, file_name="pp")
 
     assert (
-        ret == 'SELECT * FROM errors WHERE session_id == "1" AND file_name == "pp"'
+        ret == 'SELECT * FROM errors WHERE session_id == ? AND file_name == ?'
     ), ret
+    assert params == [1, "pp"]
 
 
 def test_query_1(open_default_db):
@@ -147,11 +152,11 @@ def test_query_1(open_default_db):
 
 def test_query_builder_inner_join(open_default_db):
     STMT1="""SELECT file_hash, file_size, COUNT(*) as cnt FROM files
-WHERE session_id in ('1', '2') AND file_hash != "UNDER THRESHOLD"
+WHERE session_id in (?, ?) AND file_hash != ?
 GROUP BY file_size, file_hash
 HAVING cnt > 1"""
     STMT2="""SELECT f.file_hash, f.file_size, f.file_name FROM files AS f INNER JOIN (SELECT file_hash, file_size, COUNT(*) as cnt FROM files
-WHERE session_id in ('1', '2') AND file_hash != "UNDER THRESHOLD"
+WHERE session_id in (?, ?) AND file_hash != ?
 GROUP BY file_size, file_hash
 HAVING cnt > 1) AS q ON f.file_hash == q.file_hash AND f.file_size == q.file_size
 ORDER BY f.file_hash, f.file_size"""
@@ -162,8 +167,8 @@ ORDER BY f.file_hash, f.file_size"""
     data_query1 = DataQuery()
     data_query1.select_clause = 'file_hash, file_size, COUNT(*) as cnt'
     data_query1.from_clause = 'files'
-    data_query1.where_clause = [f'{data_query1.format_query_in_clause('session_id', session_ids)}']
-    data_query1.where_clause.append(f'file_hash != "UNDER THRESHOLD"')
+    data_query1.add_where(data_query1.format_query_in_clause('session_id', session_ids))
+    data_query1.add_where('file_hash != ?', "UNDER THRESHOLD")
     data_query1.group_clause = 'file_size, file_hash'
     data_query1.having_clause = 'cnt > 1'
     query1 = data_query1.format_query()
@@ -172,10 +177,300 @@ ORDER BY f.file_hash, f.file_size"""
     data_query2.select_clause = 'f.file_hash, f.file_size, f.file_name'
     data_query2.from_clause = f'''files AS f INNER JOIN ({query1}) AS q ON f.file_hash == q.file_hash AND f.file_size == q.file_size'''
     data_query2.order_clause = 'f.file_hash, f.file_size'
+    data_query2.params = data_query1.params + data_query2.params
     query2 = data_query2.format_query()
     
     assert query1 == STMT1
     assert query2 == STMT2
+    assert data_query2.params == [1, 2, "UNDER THRESHOLD"]
+    assert ds.exec_query(data_query2) is not None
 
     # assert query1 == 0, query1
 
+
+
+def test_upgrade_existing_files_table(tmp_path):
+    database_name = str(tmp_path / "old.db")
+    old_db = sqlite3.connect(database_name)
+    old_db.execute(
+        "CREATE TABLE files (session_id TEXT NOT NULL, file_name TEXT NOT NULL, file_size INTEGER NOT NULL, timestamp TEXT, file_hash TEXT)"
+    )
+    old_db.close()
+
+    ds = DataStore(database_name)
+    ds.insert_file(FileRecord("1", "new_file_name.txt", 10, "20240101120000.00000", "hash", 1, 2, 3))
+    assert list(ds.get_fingerprints("1")) == [("new_file_name.txt", 10, 1, 2, 3, "hash", None, None)]
+
+
+def test_insert_files_batch(new_database_name):
+    ds = DataStore(new_database_name)
+    session_id = str(uuid.uuid4())
+    files = [FileRecord(session_id, f"file{i}.txt", i, "20240101120000.00000", str(i)) for i in range(10)]
+
+    assert ds.insert_files(files) == 10
+    assert len(list(ds.get_records("files", session_id))) == 10
+
+
+def test_session_writer_flushes_every_commit_rows(new_database_name):
+    ds = DataStore(new_database_name)
+    session_id = str(uuid.uuid4())
+    with SessionWriter(ds, commit_rows=4, commit_interval_ms=60000) as writer:
+        for i in range(10):
+            writer.write(FileRecord(session_id, f"file{i}.txt", i, "20240101120000.00000", str(i)))
+        assert writer.written == 8
+        assert len(list(ds.get_records("files", session_id))) == 8
+    assert writer.written == 10
+    assert len(list(ds.get_records("files", session_id))) == 10
+
+
+def test_file_names_with_quotes(new_database_name):
+    ds = DataStore(new_database_name)
+    session_id = str(uuid.uuid4())
+    file_name = """it's a "quoted" name.txt"""
+    f = FileRecord(session_id, file_name, 1, "20240101120000.00000", "hash", hash_algo="md5")
+
+    assert ds.check_and_insert_file(f) is None
+    assert ds.check_file_exists(f) == file_name
+    assert [r[1] for r in ds.get_records("files", session_id, file_name)] == [file_name]
+    ds.insert_error(ErrorRecord(session_id, file_name, "20240101120000.00000", 'No such file: "x"', True))
+    assert len(list(ds.get_records("errors", session_id, file_name))) == 1
+
+
+def test_indexes_created_on_existing_database(tmp_path):
+    database_name = str(tmp_path / "old.db")
+    DataStore(database_name).db.execute("DROP INDEX files_size_hash")
+
+    ds = DataStore(database_name)
+    indexes = [r[1] for r in ds.db.execute("PRAGMA index_list(file_entries)").fetchall()]
+    assert {"files_size_hash", "files_session", "files_name"} <= set(indexes)
+
+
+def test_fast_profile_pragmas(tmp_path):
+    ds = DataStore(str(tmp_path / "fast.db"), "fast")
+    assert ds.db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert ds.db.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+    ds.apply_profile("safe")
+    assert ds.db.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+    with pytest.raises(ValueError):
+        ds.apply_profile("unknown")
+
+
+def test_walk_progress_saved_once_directory_is_written(new_database_name):
+    ds = DataStore(new_database_name)
+    session_id = str(uuid.uuid4())
+    progress = WalkProgress(session_id)
+    progress.walked("/src", 0)
+    progress.walked("/src/a", 2)
+    with SessionWriter(ds, commit_rows=1, commit_interval_ms=60000, progress=progress) as writer:
+        writer.write(FileRecord(session_id, "/src/a/1.txt", 1, "20240101120000.00000", "1"))
+        assert ds.get_checkpoint(session_id) == ({"/src"}, {"/src/a/1.txt"})
+        writer.write(FileRecord(session_id, "/src/a/2.txt", 2, "20240101120000.00000", "2"))
+    assert ds.get_checkpoint(session_id) == ({"/src", "/src/a"}, set())
+
+
+def test_file_names_stored_by_directory(new_database_name):
+    ds = DataStore(new_database_name)
+    names = ["/src/a/1.txt", "/src/a/2.txt", "/src/b/3.txt", "/4.txt", "relative.txt"]
+    ds.insert_files(FileRecord("1", name, i, "20240101120000.00000", str(i)) for i, name in enumerate(names))
+
+    assert sorted(r[1] for r in ds.get_records("files", "1")) == sorted(names)
+    assert [r[1] for r in ds.get_records("files", "1", "/src/b/3.txt")] == ["/src/b/3.txt"]
+    dirs = {path: (parent_id, name) for dir_id, parent_id, name, path in ds.db.execute("SELECT * FROM dirs")}
+    assert set(dirs) == {"/", "/src/", "/src/a/", "/src/b/", ""}
+    assert dirs["/src/a/"][1] == "a"
+    assert dirs["/src/a/"][0] == dirs["/src/b/"][0] == ds.dir_id("/src/")
+    assert dirs["/"][0] is None
+
+
+def test_files_table_migrated_to_dirs(tmp_path):
+    database_name = str(tmp_path / "old.db")
+    old_db = sqlite3.connect(database_name)
+    old_db.execute(
+        "CREATE TABLE files (session_id TEXT NOT NULL, file_name TEXT NOT NULL, file_size INTEGER NOT NULL, timestamp TEXT, file_hash TEXT, "
+        "PRIMARY KEY (session_id, file_size, file_hash, file_name))"
+    )
+    old_db.execute("CREATE INDEX files_name ON files (file_name)")
+    rows = [("1", f"/src/dir{i % 3}/file{i}.txt", i, "20240101120000.00000", str(i)) for i in range(10)]
+    old_db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?)", rows)
+    old_db.commit()
+    old_db.close()
+
+    ds = DataStore(database_name)
+    assert sorted(r[:5] for r in ds.get_records("files", "1")) == sorted(rows)
+    # every digest stored before hash_algo existed was md5
+    assert {r[9] for r in ds.get_records("files", "1")} == {"md5"}
+    assert ds.detect_table("files", "view")
+    assert not ds.detect_table("files")
+    indexes = [r[1] for r in ds.db.execute("PRAGMA index_list(file_entries)").fetchall()]
+    assert "files_name" in indexes
+
+
+def test_digests_stored_as_blob(new_database_name):
+    ds = DataStore(new_database_name)
+    digest = bytes.fromhex("ccca4d28d9b929c1a429eadad7ab0d6d")
+    small = FileRecord("1", "/src/small.txt", 10, "20240101120000.00000", "UNDER THRESHOLD", hash_algo="md5")
+    big = FileRecord("1", "/src/big.txt", 100000, "20240101120000.00000", digest, partial_hash=digest, hash_algo="md5")
+    ds.insert_files([small, big])
+
+    stored = ds.db.execute("SELECT base_name, typeof(file_hash), typeof(partial_hash), skip_reason FROM file_entries").fetchall()
+    assert sorted(stored) == [("big.txt", "blob", "blob", None), ("small.txt", "null", "null", 1)]
+    records = {r[1]: (r[4], r[11]) for r in ds.get_records("files", "1")}
+    assert records == {"/src/small.txt": (None, "UNDER THRESHOLD"), "/src/big.txt": (digest, None)}
+    assert ds.check_file_exists(big) == "/src/big.txt"
+    assert ds.check_file_exists(small) == "/src/small.txt"
+
+
+def test_hex_digests_converted_on_migration(tmp_path):
+    database_name = str(tmp_path / "old.db")
+    old_db = sqlite3.connect(database_name)
+    old_db.execute(
+        "CREATE TABLE files (session_id TEXT NOT NULL, file_name TEXT NOT NULL, file_size INTEGER NOT NULL, timestamp TEXT, file_hash TEXT, partial_hash TEXT)"
+    )
+    old_db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)", [
+        ("1", "/src/a.txt", 100000, "20240101120000.00000", "ccca4d28d9b929c1a429eadad7ab0d6d", "00ff"),
+        ("1", "/src/b.txt", 10, "20240101120000.00000", "UNDER THRESHOLD", None),
+        ("1", "/src/c.txt", 20, "20240101120000.00000", "UNIQUE SIZE", None),
+    ])
+    old_db.commit()
+    old_db.close()
+
+    ds = DataStore(database_name)
+    records = {r[1]: (r[4], r[8], r[11]) for r in ds.get_records("files", "1")}
+    assert records == {
+        "/src/a.txt": (bytes.fromhex("ccca4d28d9b929c1a429eadad7ab0d6d"), b"\x00\xff", None),
+        "/src/b.txt": (None, None, "UNDER THRESHOLD"),
+        "/src/c.txt": (None, None, "UNIQUE SIZE"),
+    }
+
+
+def test_memory_data_store_check_and_insert():
+    ds = MemoryDataStore()
+    digest = bytes.fromhex("ccca4d28d9b929c1a429eadad7ab0d6d")
+    odd_name = "/src/dir/caf\udce9.jpg"  # not valid UTF-8 on disk
+    first = FileRecord("1", odd_name, 100000, "20240101120000.00000", digest, hash_algo="md5")
+
+    assert ds.check_and_insert_file(first) is None
+    assert ds.check_and_insert_file(FileRecord("1", "/src/copy.jpg", 100000, "", digest, hash_algo="md5")) == odd_name
+    # another session, size, algorithm or an unread file never match it
+    for other in [
+        FileRecord("2", "/src/a.jpg", 100000, "", digest, hash_algo="md5"),
+        FileRecord("1", "/src/b.jpg", 100001, "", digest, hash_algo="md5"),
+        FileRecord("1", "/src/c.jpg", 100000, "", digest, hash_algo="blake2s-128"),
+        FileRecord("1", "/src/d.jpg", 100000, "", "UNIQUE SIZE", hash_algo="md5"),
+    ]:
+        assert ds.check_and_insert_file(other) is None
+    assert ds.check_file_exists(FileRecord("1", "", 100000, "", "UNIQUE SIZE", hash_algo="md5")) == "/src/d.jpg"
+    assert [ds.file_name(i) for i in range(len(ds.paths))] == [odd_name, "/src/a.jpg", "/src/b.jpg", "/src/c.jpg", "/src/d.jpg"]
+    assert len(ds.paths.dirs) == 2
+
+
+def test_memory_data_store_snapshot(tmp_path):
+    snapshot = str(tmp_path / "index.bin")
+    ds = MemoryDataStore()
+    digests = [i.to_bytes(16, "big") for i in range(10)]
+    for i, digest in enumerate(digests):
+        ds.insert_file(FileRecord("1", f"/src/dir{i % 3}/caf\udce9{i}.jpg", 1000 + i, "20240101120000.00000", digest, hash_algo="md5"))
+    ds.insert_file(FileRecord("1", "/src/small.txt", 10, "20240101120000.00000", "UNDER THRESHOLD", hash_algo="md5"))
+    assert ds.save(snapshot) == 11
+
+    loaded = MemoryDataStore.load(snapshot)
+    lookup = lambda size, file_hash: loaded.check_file_exists(FileRecord("1", "", size, "", file_hash, hash_algo="md5"))
+    assert lookup(1003, digests[3]) == "/src/dir0/caf\udce93.jpg"
+    assert lookup(10, "UNDER THRESHOLD") == "/src/small.txt"
+    assert lookup(1003, digests[4]) is None
+    # new files get the next ids, a key inserted again replaces the loaded one
+    assert loaded.check_and_insert_file(FileRecord("1", "/new/a.jpg", 5000, "20240102", b"\xff" * 16, hash_algo="md5")) is None
+    loaded.insert_file(FileRecord("1", "/new/b.jpg", 1003, "20240102", digests[3], hash_algo="md5"))
+    assert loaded.save(snapshot) == 13
+
+    reloaded = MemoryDataStore.load(snapshot)
+    assert [reloaded.file_name(i) for i in (0, 11, 12)] == ["/src/dir0/caf\udce90.jpg", "/new/a.jpg", "/new/b.jpg"]
+    assert reloaded.check_file_exists(FileRecord("1", "", 1003, "", digests[3], hash_algo="md5")) == "/new/b.jpg"
+    assert reloaded.check_file_exists(FileRecord("1", "", 5000, "", b"\xff" * 16, hash_algo="md5")) == "/new/a.jpg"
+
+
+def test_memory_data_store_snapshot_keeps_the_stat_of_files(tmp_path):
+    snapshot = str(tmp_path / "index.bin")
+    ds = MemoryDataStore()
+    ds.insert_file(FileRecord("1", "/src/a.jpg", 1000, "", b"\x01" * 16, st_mtime_ns=123, st_ino=7, hash_algo="md5"))
+    ds.insert_file(FileRecord("1", "/src/b.jpg", 2000, "", b"\x02" * 16, hash_algo="md5"))
+    ds.save(snapshot)
+    loaded = MemoryDataStore.load(snapshot)
+    loaded.insert_file(FileRecord("1", "/new/c.jpg", 3000, "", b"\x03" * 16, st_mtime_ns=456, st_ino=8, hash_algo="md5"))
+    indexed_stat = lambda size, digest: loaded.indexed_stat(FileRecord("1", "", size, "", digest, hash_algo="md5"))
+    assert indexed_stat(1000, b"\x01" * 16) == (1000, 123, 7)
+    assert indexed_stat(2000, b"\x02" * 16) is None
+    assert indexed_stat(3000, b"\x03" * 16) == (3000, 456, 8)
+    assert indexed_stat(3000, b"\x04" * 16) is None
+
+
+def test_memory_data_store_snapshot_without_stat(tmp_path):
+    snapshot = tmp_path / "index.bin"
+    ds = MemoryDataStore()
+    ds.insert_file(FileRecord("1", "/src/a.jpg", 1000, "", b"\x01" * 16, st_mtime_ns=123, st_ino=7, hash_algo="md5"))
+    ds.save(str(snapshot))
+    # the previous format: no stat sections, the header padded to keep the sections in place
+    data = snapshot.read_bytes()
+    (length,) = struct.unpack_from("<Q", data, 8)
+    header = json.loads(data[16 : 16 + length])
+    del header["sections"]["mtime_ns"], header["sections"]["inos"]
+    encoded = json.dumps(header).encode().ljust(length)
+    snapshot.write_bytes(b"SMIDX002" + data[8:16] + encoded + data[16 + length :])
+
+    loaded = MemoryDataStore.load(str(snapshot))
+    record = FileRecord("1", "", 1000, "", b"\x01" * 16, hash_algo="md5")
+    assert loaded.check_file_exists(record) == "/src/a.jpg"
+    assert loaded.indexed_stat(record) is None
+    # saved again in the current format, the stat stays unknown
+    loaded.save(str(snapshot))
+    assert MemoryDataStore.load(str(snapshot)).indexed_stat(record) is None
+
+
+def test_memory_data_store_snapshot_rejects_other_files(tmp_path):
+    other = tmp_path / "other.bin"
+    other.write_bytes(b"not a snapshot at all")
+    with pytest.raises(ValueError, match="not a MemoryDataStore snapshot"):
+        MemoryDataStore.load(str(other))
+
+
+def test_memory_data_store_snapshot_of_the_first_format(tmp_path):
+    # SMIDX001: the sorted keys of the index and their file ids, in one table per key width
+    digest = b"\x01" * 16
+    key = struct.pack("<LHBq", 0, 0, 0, 1000) + digest
+    skipped = struct.pack("<LHBq", 0, 0, 1, 10)
+    replaced = key  # a.jpg inserted again as c.jpg, only c.jpg is in the index
+    sections = [
+        ("dir_ids", struct.pack("<3I", 0, 0, 1)),
+        ("name_ends", struct.pack("<3Q", 5, 11, 16)),
+        ("names", b"a.jpgb.textc.jpg"),
+        ("timestamp_ids", struct.pack("<3I", 0, 0, 0)),
+        (f"keys{len(skipped)}", skipped),
+        (f"ids{len(skipped)}", struct.pack("<I", 1)),
+        (f"keys{len(replaced)}", replaced),
+        (f"ids{len(replaced)}", struct.pack("<I", 2)),
+    ]
+    header = {
+        "byteorder": sys.byteorder,
+        "files": 3,
+        "sessions": ["1"],
+        "hash_algos": ["md5"],
+        "timestamps": ["20240101120000.00000"],
+        "dirs": ["/src/", "/other/"],
+        "key_widths": [len(skipped), len(replaced)],
+        "sections": {},
+    }
+    data = b""
+    for name, section in sections:
+        header["sections"][name] = [len(data), len(section)]
+        data += section.ljust(-(-len(section) // 8) * 8, b"\0")
+    encoded = json.dumps(header).encode()
+    encoded = encoded.ljust(-(-(len(encoded) + 16) // 8) * 8 - 16)
+    snapshot = tmp_path / "index.bin"
+    snapshot.write_bytes(b"SMIDX001" + struct.pack("<Q", len(encoded)) + encoded + data)
+
+    loaded = MemoryDataStore.load(str(snapshot))
+    assert loaded.check_file_exists(FileRecord("1", "", 1000, "", digest, hash_algo="md5")) == "/other/c.jpg"
+    assert loaded.check_file_exists(FileRecord("1", "", 10, "", "UNDER THRESHOLD", hash_algo="md5")) == "/src/b.text"
+    # saved again in the current format
+    assert loaded.save(str(snapshot)) == 2
+    assert MemoryDataStore.load(str(snapshot)).file_name(0) == "/src/b.text"
@@ -0,0 +1,278 @@
+import os
+from pathlib import Path
+
+import pytest
+
+import delete_duplicates
+from config import ScanConfig
+from data_store import DataStore, FileRecord, MemoryDataStore
+
+SIZE = 70_000  # over ScanConfig.SIZE_THRESHOLD, so the content gets read
+
+
+def content(i: int) -> bytes:
+    return bytes([i]) * SIZE
+
+
+@pytest.fixture
+def source_tree(tmp_path, monkeypatch):
+    # script.sh and the audit log are written to the working directory
+    monkeypatch.chdir(tmp_path)
+    src = tmp_path / "src"
+    for name, data in [
+        ("a/1.jpg", content(1)),
+        ("a/2.jpg", content(2)),
+        ("b/1 copy.jpg", content(1)),
+        ("b/3.jpg", content(3) + b"3"),
+        ("c/2 copy.jpg", content(2)),
+        ("c/1 copy 2.jpg", content(1)),
+        ("c/notes.txt", content(1)),  # not an extension delete_duplicates checks
+    ]:
+        (src / name).parent.mkdir(parents=True, exist_ok=True)
+        (src / name).write_bytes(data)
+    yield src
+
+
+def scan(roots, ds=None, checkpoint_ds=None, resume=False, **options) -> list:
+    """Runs tree_walk on roots, returns the files script.sh removes after it.
+
+    With a checkpoint_ds the run is checkpointed to it, and resume continues it.
+    """
+    config = ScanConfig()
+    config.SESSION_ID = "test"
+    config.PREFLIGHT = False
+    config.RESUME = resume
+    config.CHECKPOINT = checkpoint_ds is not None
+    for name, value in options.items():
+        setattr(config, name, value)
+    delete_duplicates.set_config(config)
+    delete_duplicates.reset_stats()
+    delete_duplicates.ds = ds if ds is not None else MemoryDataStore()
+    delete_duplicates.checkpoint_ds = checkpoint_ds
+    delete_duplicates.writer = None
+    delete_duplicates.walk_progress = None
+    delete_duplicates.completed_dirs = set()
+    delete_duplicates.recorded_files = set()
+    if resume:
+        delete_duplicates.load_checkpoint(config.SESSION_ID)
+    elif os.path.exists("script.sh"):
+        # script.sh is only opened on the first rm, a run without duplicates leaves the last one
+        os.remove("script.sh")
+    try:
+        delete_duplicates.tree_walk([str(root) for root in roots])
+    finally:
+        if delete_duplicates.script_file is not None:
+            delete_duplicates.script_file.close()
+            delete_duplicates.script_file = None
+    return removed()
+
+
+def removed() -> list:
+    if not os.path.exists("script.sh"):
+        return []
+    with open("script.sh") as f:
+        return [line[len("rm ") :].partition(" #")[0] for line in f.read().splitlines()]
+
+
+def kept_copies(src: Path, removed_files) -> dict:
+    """Inodes left of every content once removed_files are gone."""
+    kept = {}
+    for path in src.rglob("*.jpg"):
+        if str(path) not in removed_files:
+            file_stat = path.stat()
+            kept.setdefault(path.read_bytes(), set()).add((file_stat.st_dev, file_stat.st_ino))
+    return kept
+
+
+def test_one_copy_of_every_content_is_kept(source_tree):
+    files = scan([source_tree])
+    assert len(files) == len(set(files)) == 3
+    kept = kept_copies(source_tree, files)
+    assert len(kept) == 3 and all(len(inodes) == 1 for inodes in kept.values())
+
+
+class Stop(Exception):
+    pass
+
+
+def stop_in(monkeypatch, directory: Path):
+    """Stops the walk on the first file of directory, until the monkeypatch is undone."""
+    pending_record = delete_duplicates.pending_record
+
+    def stop_or_record(file_entry):
+        if file_entry.path.startswith(str(directory)):
+            raise Stop()
+        return pending_record(file_entry)
+
+    monkeypatch.setattr(delete_duplicates, "pending_record", stop_or_record)
+
+
+def test_resume_appends_to_the_script(source_tree, monkeypatch):
+    expected = scan([source_tree])
+    ds = DataStore(str(source_tree.parent / "datastore.db"))
+
+    delete_file = delete_duplicates.delete_file
+
+    # the directory of the first duplicate can't be complete when it stops
+    def stop_after_first_rm(source_file, duplicated_file):
+        delete_file(source_file, duplicated_file)
+        raise Stop()
+
+    monkeypatch.setattr(delete_duplicates, "delete_file", stop_after_first_rm)
+    with pytest.raises(Stop):
+        scan([source_tree], checkpoint_ds=ds)
+    first_run = removed()
+    assert len(first_run) == 1
+    monkeypatch.setattr(delete_duplicates, "delete_file", delete_file)
+
+    # the files indexed before the stop are neither checked again nor duplicates of themselves
+    files = scan([source_tree], checkpoint_ds=DataStore(str(source_tree.parent / "datastore.db")), resume=True)
+    assert files[: len(first_run)] == first_run
+    assert sorted(files) == sorted(expected)
+
+
+def test_checkpoint_commits_once_per_directory(source_tree, monkeypatch):
+    expected = scan([source_tree])
+    commits = []
+    insert_files = DataStore.insert_files
+    monkeypatch.setattr(DataStore, "insert_files", lambda self, files: commits.append(len(files)) or insert_files(self, files))
+    monkeypatch.setattr(DataStore, "insert_file", None)
+    ds = DataStore(str(source_tree.parent / "datastore.db"))
+    assert scan([source_tree], checkpoint_ds=ds) == expected
+    # the 3 copies kept, never a transaction per file, at most one for each directory completed
+    assert sum(commits) == 3 and len(commits) <= 4
+    assert len(list(ds.get_records("walk_progress", "test"))) == 4
+
+
+def test_resume_checks_against_the_files_of_the_stopped_run(source_tree, monkeypatch):
+    roots = [source_tree / "a", source_tree / "b"]
+    expected = scan(roots)
+    ds = DataStore(str(source_tree.parent / "datastore.db"))
+    with monkeypatch.context() as m:
+        stop_in(m, source_tree / "b")
+        with pytest.raises(Stop):
+            scan(roots, checkpoint_ds=ds)
+    # a/ was committed before the stop, the copies in b/ are duplicates of its files
+    files = scan(roots, checkpoint_ds=DataStore(str(source_tree.parent / "datastore.db")), resume=True)
+    assert files == expected == [str(source_tree / "b" / "1 copy.jpg")]
+
+
+def test_indexed_file_is_not_a_duplicate_of_itself(source_tree):
+    files = scan([source_tree])
+    indexed = next(str(path) for path in source_tree.rglob("*.jpg") if str(path) not in files)
+    config = delete_duplicates.config
+    file_record = FileRecord(config.SESSION_ID, indexed, Path(indexed).stat().st_size, config.TIMESTAMP, None, hash_algo=config.HASH_ALGO)
+    assert delete_duplicates.check_duplicated(delete_duplicates.hash_record(file_record)) is None
+
+
+@pytest.mark.parametrize(
+    "split_roots, options",
+    [
+        pytest.param(False, {"WORKERS": 2, "HASH_BACKEND": "thread"}, id="thread-pool"),
+        pytest.param(False, {"WORKERS": 2, "HASH_BACKEND": "process"}, id="process-pool"),
+        pytest.param(False, {"SIZE_PREPASS": True}, id="size-prepass"),
+        pytest.param(False, {"PARTIAL_HASH": True}, id="partial-hash"),
+        pytest.param(False, {"PHYSICAL_ORDER": True, "WORKERS": 1}, id="physical-order"),
+        pytest.param(False, {"PHYSICAL_ORDER": True, "WORKERS": 2}, id="physical-order-pool"),
+        pytest.param(True, {}, id="roots"),
+    ],
+)
+def test_options_find_the_same_duplicates(source_tree, split_roots, options):
+    # the head and the tail of 1.jpg, another middle: only the full hash tells them apart
+    middle = bytearray(content(1))
+    middle[SIZE // 2] = 0
+    (source_tree / "c" / "1 almost.jpg").write_bytes(middle)
+    expected = scan([source_tree])
+    assert str(source_tree / "c" / "1 almost.jpg") not in expected
+    # split, walked in the order a single root walks them
+    roots = [source_tree / entry.name for entry in os.scandir(source_tree)] if split_roots else [source_tree]
+    files = scan(roots, **options)
+    if not options.get("PHYSICAL_ORDER"):
+        assert files == expected
+        return
+    # the on-disk order may keep another copy of a content, never more or fewer of them
+    assert len(files) == len(expected)
+    assert kept_copies(source_tree, files).keys() == kept_copies(source_tree, expected).keys()
+    assert all(len(inodes) == 1 for inodes in kept_copies(source_tree, files).values())
+
+
+def test_hardlinks_are_not_duplicates(source_tree):
+    (source_tree / "d").mkdir()
+    (source_tree / "d" / "4.jpg").write_bytes(content(4))
+    (source_tree / "e").mkdir()
+    os.link(source_tree / "d" / "4.jpg", source_tree / "e" / "4 link.jpg")
+    # removing one name of the inode frees nothing, also when the pool reads the primary
+    for workers in (1, 2):
+        files = scan([source_tree], WORKERS=workers)
+        assert not any("4" in Path(file_name).name for file_name in files)
+
+
+def test_index_file_continues_the_snapshot_of_an_earlier_run(source_tree):
+    expected = scan([source_tree])
+    index_file = str(source_tree.parent / "index.bin")
+    first, *rest = [source_tree / entry.name for entry in os.scandir(source_tree)]
+    ds = MemoryDataStore()
+    files = scan([first], ds, INDEX_FILE=index_file)
+    ds.save(index_file)
+    # a later run continues the session of the snapshot, against the files of the first run
+    ds = MemoryDataStore.load(index_file)
+    files += scan(rest, ds, INDEX_FILE=index_file)
+    assert files == expected
+    # the snapshot reports every removed copy, with the copy kept of its content
+    ds.save(index_file)
+    headers, rows = MemoryDataStore.load(index_file).report_duplicated([])
+    kept = [str(path) for path in source_tree.rglob("*.jpg") if str(path) not in files]
+    assert sorted(row[2] for row in rows) == sorted(files + [name for name in kept if not name.endswith("3.jpg")])
+
+
+def test_hardlink_of_a_file_indexed_by_an_earlier_run(source_tree):
+    index_file = str(source_tree.parent / "index.bin")
+    ds = MemoryDataStore()
+    scan([source_tree / "a"], ds, INDEX_FILE=index_file)
+    ds.save(index_file)
+    (source_tree / "d").mkdir()
+    os.link(source_tree / "a" / "1.jpg", source_tree / "d" / "1 link.jpg")
+    assert scan([source_tree / "d"], MemoryDataStore.load(index_file), INDEX_FILE=index_file) == []
+
+
+def test_hardlink_of_a_file_indexed_before_a_resume(source_tree, monkeypatch):
+    (source_tree / "d").mkdir()
+    os.link(source_tree / "a" / "1.jpg", source_tree / "d" / "1 link.jpg")
+    ds = DataStore(str(source_tree.parent / "datastore.db"))
+    expected = scan([source_tree / "a", source_tree / "d"], checkpoint_ds=ds)
+    assert str(source_tree / "d" / "1 link.jpg") not in expected
+
+    # a/ is complete when d/ starts, the resumed run only walks the link
+    ds = DataStore(str(source_tree.parent / "datastore2.db"))
+    with monkeypatch.context() as m:
+        stop_in(m, source_tree / "d")
+        with pytest.raises(Stop):
+            scan([source_tree / "a", source_tree / "d"], checkpoint_ds=ds)
+    files = scan([source_tree / "a", source_tree / "d"], checkpoint_ds=DataStore(str(source_tree.parent / "datastore2.db")), resume=True)
+    assert files == expected
+
+
+def test_file_edited_since_the_snapshot_is_kept(source_tree):
+    index_file = str(source_tree.parent / "index.bin")
+    ds = MemoryDataStore()
+    scan([source_tree / "a"], ds, INDEX_FILE=index_file)
+    ds.save(index_file)
+    # the same size, another content: only the stat in the snapshot tells it changed
+    (source_tree / "a" / "1.jpg").write_bytes(content(9))
+    files = scan([source_tree / "b"], MemoryDataStore.load(index_file), INDEX_FILE=index_file)
+    assert str(source_tree / "b" / "1 copy.jpg") not in files
+
+
+def test_file_touched_since_the_snapshot_is_read_again(source_tree, monkeypatch):
+    index_file = str(source_tree.parent / "index.bin")
+    ds = MemoryDataStore()
+    scan([source_tree / "a"], ds, INDEX_FILE=index_file)
+    ds.save(index_file)
+    indexed = source_tree / "a" / "1.jpg"
+    os.utime(indexed, ns=(indexed.stat().st_atime_ns, indexed.stat().st_mtime_ns + 10**9))
+    hashed = []
+    hash_file = delete_duplicates.hash_file
+    monkeypatch.setattr(delete_duplicates, "hash_file", lambda path: hashed.append(path) or hash_file(path))
+    files = scan([source_tree / "b"], MemoryDataStore.load(index_file), INDEX_FILE=index_file)
+    assert files == [str(source_tree / "b" / "1 copy.jpg")]
+    assert indexed in hashed
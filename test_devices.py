@@ -0,0 +1,119 @@
+import os
+import threading
+import time
+
+import pytest
+
+import devices
+from data_store import FileRecord
+from devices import DeviceScheduler
+
+HDD = 1
+SSD = 2
+NETWORK = 3
+
+
+@pytest.fixture
+def fake_devices(monkeypatch):
+    kinds = {HDD: True, SSD: False, NETWORK: None}
+    monkeypatch.setattr(devices, "is_rotational", kinds.get)
+
+
+def test_is_rotational_of_a_real_device():
+    dev = os.stat(".").st_dev
+    assert devices.is_rotational(dev) in (True, False, None)
+    # not a block device
+    assert devices.is_rotational(os.makedev(0, 0)) is None
+
+
+def test_limits_by_kind_of_device(fake_devices):
+    scheduler = DeviceScheduler(workers=8, rotational_workers=2)
+    assert scheduler.limit(HDD) == 2
+    assert scheduler.limit(SSD) == 8
+    assert scheduler.limit(NETWORK) == 8
+    assert scheduler.limit(None) == 8
+    # never more than workers on a spinning disk either
+    assert DeviceScheduler(workers=1, rotational_workers=2).limit(HDD) == 1
+    assert "device 1 (rotational): 2 workers" in scheduler.describe([HDD, SSD])
+
+
+def test_slots_hold_every_device(fake_devices):
+    scheduler = DeviceScheduler(workers=4, rotational_workers=1)
+    running = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def copy(source_dev):
+        nonlocal running, peak
+        # every copy writes to the spinning disk, one at a time whatever the source
+        with scheduler.slots(source_dev, HDD):
+            with lock:
+                running += 1
+                peak = max(peak, running)
+            time.sleep(0.005)
+            with lock:
+                running -= 1
+
+    threads = [threading.Thread(target=copy, args=(dev,)) for dev in [SSD, HDD] * 5]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert peak == 1
+
+
+def record(name, ino, dev=SSD, file_hash=None):
+    return FileRecord('session', name, 100, '', file_hash, st_ino=ino, st_dev=dev)
+
+
+def test_first_physical_offset_of_a_real_file(tmp_path):
+    file_name = tmp_path / 'data.bin'
+    file_name.write_bytes(b'#' * 65536)
+    offset = devices.first_physical_offset(str(file_name))
+    # filesystems without FIEMAP (tmpfs, overlay...) don't tell
+    assert offset is None or offset >= 0
+    assert devices.first_physical_offset(str(tmp_path / 'missing')) is None
+
+
+@pytest.mark.parametrize('flags, offset', [(0, 4096), (devices.FIEMAP_EXTENT_UNKNOWN, None), (devices.FIEMAP_EXTENT_UNKNOWN | 0x4, None)])  # 0x4 is DELALLOC
+def test_first_physical_offset_of_an_unallocated_extent(tmp_path, monkeypatch, flags, offset):
+    file_name = tmp_path / 'data.bin'
+    file_name.write_bytes(b'#' * 65536)
+
+    class FakeFcntl:
+        # one mapped extent at 4096, delayed allocation reports 0 there
+        @staticmethod
+        def ioctl(fd, request, arg):
+            devices.FIEMAP_HEADER.pack_into(arg, 0, 0, devices.FIEMAP_ALL, 0, 1, 1, 0)
+            devices.FIEMAP_EXTENT.pack_into(
+                arg, devices.FIEMAP_HEADER.size, 0, 4096 if offset else 0, 65536, 0, 0, flags, 0, 0, 0
+            )
+
+    monkeypatch.setattr(devices, 'fcntl', FakeFcntl)
+    assert devices.first_physical_offset(str(file_name)) == offset
+
+
+def test_physical_order_by_extent_then_inode(monkeypatch):
+    offsets = {'c': 10, 'd': 5}
+    monkeypatch.setattr(devices, 'first_physical_offset', offsets.get)
+    records = [record('a', 3), record('b', 1), record('c', 9), record('small', 0, file_hash='x'), record('d', 8)]
+
+    ordered = [r.file_name for r in devices.physical_order(records, batch_size=10)]
+    assert ordered == ['small', 'd', 'c', 'b', 'a']
+    # sorted one batch at a time
+    ordered = [r.file_name for r in devices.physical_order(records, batch_size=2)]
+    assert ordered == ['b', 'a', 'small', 'd', 'c']
+
+
+def test_hashed_in_physical_order_keeps_walk_order(monkeypatch):
+    monkeypatch.setattr(devices, 'first_physical_offset', lambda file_name: None)
+    records = [record('a', 3), record('b', 1), record('small', 0, file_hash='x'), record('c', 2)]
+    read = []
+
+    def hash_records(batch):
+        for r in batch:
+            read.append(r.file_name)
+            yield r.file_name.upper()
+
+    assert list(devices.hashed_in_physical_order(records, hash_records, 10)) == ['A', 'B', 'SMALL', 'C']
+    assert read == ['small', 'b', 'c', 'a']
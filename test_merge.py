@@ -289,6 +289,87 @@ def test_merge_copy_delete_empty_target(create_src_empty_dst: dict[str, Any]):
     assert stats.duplicated_files_count == 0, 'the stats are miscounting the number of operations'
 
 
+def test_merge_copy_delete_with_workers(create_src_empty_dst: dict[str, Any]):
+    data = create_src_empty_dst
+    config = MergeConfig()
+    config.DO_DELETE = True
+    config.DO_COPY = True
+    config.DO_MKDIR = True
+    config.DO_CLEANUP_SOURCE = True
+    config.DO_QUIET = True
+    config.DO_STATS = False
+    config.WORKERS = 4
+    merge.set_config(config)
+    merge.reset_stats()
+
+    merge.tree_walk(data['src'], data['dst'])
+    merge.clean_up(data['src'])
+
+    dir_count_src, file_count_src = analyze_structure(data['src'], {})
+    assert (dir_count_src, file_count_src) == (0, 0)
+    dir_count_dst, file_count_dst = analyze_structure(data['dst'], data['ht'])
+    assert dir_count_dst == NON_EMPTY_DIRECTORIES
+    assert file_count_dst == EXPECTED_FILES
+
+    stats = merge.get_stats()
+    assert stats.processed_files_count == EXPECTED_FILES, 'the stats are miscounting the number of operations'
+    assert stats.copied_files_count == EXPECTED_FILES, 'the stats are miscounting the number of operations'
+    assert stats.deleted_files_count == EXPECTED_FILES, 'the stats are miscounting the number of operations'
+
+
+def test_clean_up_keeps_excluded_directories(tmp_path):
+    src, dst = tmp_path / 'src', tmp_path / 'dst'
+    for f in ['sub/keep/junk', 'a/b/f.txt', 'z/y/g.txt']:
+        (src / f).parent.mkdir(parents=True, exist_ok=True)
+        (src / f).write_text(f)
+    dst.mkdir()
+    config = MergeConfig()
+    config.DO_DELETE = True
+    config.DO_COPY = True
+    config.DO_MKDIR = True
+    config.DO_CLEANUP_SOURCE = True
+    config.DO_QUIET = True
+    config.DO_STATS = False
+    config.EXCLUDE = ['keep/']
+    merge.set_config(config)
+    merge.reset_stats()
+
+    merge.tree_walk(str(src), str(dst))
+    merge.clean_up(str(src))
+
+    # only the excluded directory is left, with its parents
+    assert sorted(p.relative_to(src).as_posix() for p in src.rglob('*')) == ['sub', 'sub/keep', 'sub/keep/junk']
+    assert sorted(p.relative_to(dst).as_posix() for p in dst.rglob('*.txt')) == ['a/b/f.txt', 'z/y/g.txt']
+
+
+def test_ignored_recycle_bin_is_deleted_without_copy(tmp_path):
+    src, dst = tmp_path / 'src', tmp_path / 'dst'
+    for f in ['sub/$RECYCLE.BIN/junk', 'a/f.txt']:
+        (src / f).parent.mkdir(parents=True, exist_ok=True)
+        (src / f).write_text(f)
+    dst.mkdir()
+    config = MergeConfig()
+    config.DO_DELETE = True
+    config.DO_COPY = True
+    config.DO_MKDIR = True
+    config.DO_CLEANUP_SOURCE = True
+    config.DO_QUIET = True
+    config.DO_STATS = False
+    config.DO_IGNORE = True
+    config.IGNORE_PATH = '$RECYCLE.BIN'
+    merge.set_config(config)
+    merge.reset_stats()
+
+    merge.tree_walk(str(src), str(dst))
+    merge.clean_up(str(src))
+
+    # the recycle bin is skipped, then removed from the source with everything else
+    assert list(src.rglob('*')) == []
+    assert sorted(p.relative_to(dst).as_posix() for p in dst.rglob('*') if p.is_file()) == ['a/f.txt']
+    stats = merge.get_stats()
+    assert (stats.ignored_files_count, stats.copied_files_count, stats.deleted_files_count) == (1, 1, 2)
+
+
 # def test_merge_copy_no_delete_empty_dir(create_structure: dict[str, Any]):
 #     data = create_structure
 #     config = MergeConfig()
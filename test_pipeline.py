@@ -0,0 +1,125 @@
+import threading
+import time
+
+import pytest
+
+from pipeline import Pipeline, interleave
+
+
+class ListSink:
+    def __init__(self):
+        self.items = []
+        self.threads = set()
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.closed = True
+        return False
+
+    def write(self, item):
+        self.threads.add(threading.current_thread().name)
+        self.items.append(item)
+
+
+def test_pipeline_applies_work_and_writes_everything():
+    sink = ListSink()
+    with Pipeline(range(1000), lambda i: i * 2, sink, workers=4, queue_size=8) as pipeline:
+        assert pipeline.wait(0.01) == 1000
+    assert sorted(sink.items) == [i * 2 for i in range(1000)]
+    assert sink.closed
+    # a single writer thread, never the caller's
+    assert sink.threads == {"writer"}
+
+
+def test_pipeline_queues_are_bounded():
+    release = threading.Event()
+    sink = ListSink()
+    depths = []
+
+    def slow_write(item):
+        release.wait()
+        ListSink.write(sink, item)
+
+    sink.write = slow_write
+    with Pipeline(range(100), lambda i: i, sink, workers=2, queue_size=4) as pipeline:
+        def on_tick(pipeline):
+            depths.append(pipeline.depths())
+            if len(depths) == 5:
+                release.set()
+        pipeline.wait(0.02, on_tick)
+    assert len(sink.items) == 100
+    assert all(d["hash"] <= 4 and d["write"] <= 4 for d in depths)
+    assert pipeline.max_depths["write"] == 4
+
+
+def test_pipeline_raises_first_error_and_stops():
+    def work(i):
+        if i == 10:
+            raise ValueError("boom")
+        return i
+
+    sink = ListSink()
+    with pytest.raises(ValueError, match="boom"):
+        with Pipeline(range(100000), work, sink, workers=2, queue_size=4) as pipeline:
+            pipeline.wait(0.01)
+    assert len(sink.items) < 100000
+    assert sink.closed
+
+
+def test_pipeline_without_work_passes_items_through():
+    sink = ListSink()
+    with Pipeline(iter("abc"), None, sink) as pipeline:
+        pipeline.wait()
+    assert sink.items == ["a", "b", "c"]
+
+
+def test_pipeline_routes_items_to_a_limited_group_each():
+    running = {}
+    peak = {}
+    lock = threading.Lock()
+
+    def work(i):
+        key = i % 3
+        with lock:
+            running[key] = running.get(key, 0) + 1
+            peak[key] = max(peak.get(key, 0), running[key])
+        time.sleep(0.001)
+        with lock:
+            running[key] -= 1
+        return i
+
+    sink = ListSink()
+    limits = {0: 1, 1: 2, 2: 4}
+    with Pipeline(range(300), work, sink, queue_size=8, route=lambda i: i % 3, limit=limits.get) as pipeline:
+        assert pipeline.wait(0.01) == 300
+    assert sorted(sink.items) == list(range(300))
+    assert {key: workers for key, (queue, workers) in pipeline.queues.items()} == limits
+    assert all(peak[key] <= limits[key] for key in limits)
+    assert peak[0] == 1
+
+
+def test_pipeline_routed_without_items():
+    sink = ListSink()
+    with Pipeline([], lambda i: i, sink, route=lambda i: i) as pipeline:
+        assert pipeline.wait(0.01) == 0
+    assert sink.closed
+
+
+def test_interleave_drains_every_source():
+    sources = [iter(range(0, 100)), iter(range(100, 150)), iter([])]
+    items = list(interleave(sources, queue_size=4))
+    assert sorted(items) == list(range(150))
+    # each source keeps its own order
+    assert [i for i in items if i < 100] == list(range(100))
+
+
+def test_interleave_raises_source_error():
+    def failing():
+        yield 1
+        raise ValueError("walk failed")
+
+    with pytest.raises(ValueError, match="walk failed"):
+        list(interleave([failing(), iter(range(1000))], queue_size=4))
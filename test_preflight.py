@@ -0,0 +1,72 @@
+import os
+import tempfile
+from datetime import timedelta
+from pathlib import Path
+
+import pytest
+
+import preflight
+
+DEBUG = False # if true, tempdirectories aren't cleaned up for further investigation.
+
+
+@pytest.fixture
+def source_tree():
+    src = tempfile.TemporaryDirectory(delete=not DEBUG)
+    root = Path(src.name).resolve()
+    for d in ['dir1', 'dir1/sub1', 'dir2']:
+        (root / d).mkdir()
+    for f, size in [('file0.txt', 10), ('dir1/file1.txt', 100), ('dir1/sub1/file2.txt', 2000), ('dir2/file3.txt', 3000)]:
+        with (root / f).open(mode="x") as fp:
+            fp.write('#' * size)
+    os.symlink(root / 'dir1', root / 'link_to_dir1')
+    yield root
+    src.cleanup()
+
+
+def test_size_job_groups_by_top_level_directory(source_tree):
+    job = preflight.size_job(source_tree, min_size=1000)
+
+    assert (job.files, job.bytes) == (4, 5110)
+    assert {name: (d.files, d.bytes) for name, d in job.dirs.items()} == {
+        preflight.ROOT_FILES: (1, 10),
+        'dir1': (2, 2100),
+        'dir2': (1, 3000),
+    }
+    # only what is over min_size gets read
+    dev = source_tree.stat().st_dev
+    assert (job.devices[dev].files, job.devices[dev].bytes) == (2, 5000)
+    assert sorted(size for size, path in job.samples[dev]) == [2000, 3000]
+
+
+def test_eta_from_device_throughput(source_tree):
+    job = preflight.size_job(source_tree, min_size=1000)
+    assert job.eta() is None
+    job.throughput[source_tree.stat().st_dev] = 1000
+    assert job.eta() == timedelta(seconds=5)
+    assert 'Estimated time: 0:00:05' in job.report()
+
+
+def test_eta_of_devices_read_in_parallel():
+    job = preflight.JobSize()
+    for dev, size, throughput in [(1, 5000, 1000), (2, 9000, 1000), (3, 2000, 2000)]:
+        job.devices[dev] = preflight.DirSize()
+        job.devices[dev].add(size)
+        job.throughput[dev] = throughput
+    # each device has hashers of its own, the job takes as long as the slowest
+    assert job.eta() == timedelta(seconds=9)
+
+
+def test_preflight_runs_in_background(source_tree):
+    job = preflight.Preflight(source_tree, 1000).start().result()
+    assert job.files == 4
+    assert job.throughput[source_tree.stat().st_dev] > 0
+
+
+def test_size_job_of_several_roots(source_tree):
+    job = preflight.size_job([source_tree / 'dir1', source_tree / 'dir2'])
+    assert {name: (d.files, d.bytes) for name, d in job.dirs.items()} == {
+        str(source_tree / 'dir1'): (1, 100),
+        str(source_tree / 'dir1' / 'sub1'): (1, 2000),
+        str(source_tree / 'dir2'): (1, 3000),
+    }
@@ -0,0 +1,104 @@
+import pytest
+
+import reports
+from data_store import DataStore, MemoryDataStore, FileRecord, DataQuery
+
+TIMESTAMP = "20240101120000.00000"
+A = bytes.fromhex("ccca4d28d9b929c1a429eadad7ab0d6d")
+B = bytes.fromhex("0f343b0931126a20f133d67c2b018a3b")
+
+
+def records():
+    return [
+        FileRecord("1", "/src/a.jpg", 1000, TIMESTAMP, A, hash_algo="md5"),
+        FileRecord("1", "/src/dir/a copy.jpg", 1000, TIMESTAMP, A, hash_algo="md5"),
+        FileRecord("1", "/src/dir/a link.jpg", 1000, TIMESTAMP, A, hash_algo="md5", link_of="/src/a.jpg"),
+        FileRecord("1", "/src/b.jpg", 2000, TIMESTAMP, B, hash_algo="md5"),
+        FileRecord("1", "/src/b other algo.jpg", 2000, TIMESTAMP, B, hash_algo="blake2s-128"),
+        FileRecord("1", "/src/small.txt", 10, TIMESTAMP, "UNDER THRESHOLD", hash_algo="md5"),
+        FileRecord("1", "/src/small copy.txt", 10, TIMESTAMP, "UNDER THRESHOLD", hash_algo="md5"),
+        FileRecord("2", "/dst/b.jpg", 2000, TIMESTAMP, B, hash_algo="md5"),
+        FileRecord("2", "/dst/c.jpg", 1000, TIMESTAMP, A, hash_algo="md5"),
+    ]
+
+
+@pytest.fixture(params=["memory", "snapshot"])
+def stores(request, tmp_path):
+    sql = DataStore(":memory:")
+    sql.insert_files(records())
+    memory = MemoryDataStore()
+    memory.insert_files(records())
+    if request.param == "snapshot":
+        memory.save(str(tmp_path / "index.bin"))
+        memory = MemoryDataStore.load(str(tmp_path / "index.bin"))
+    return sql, memory
+
+
+def run(ds, build, session_ids=None):
+    # list_sessions and count_sessions take no session_ids
+    query = build(DataQuery()) if session_ids is None else build(DataQuery(), session_ids)
+    return ds.exec_query(query), ds.headers()
+
+
+@pytest.mark.parametrize("build, session_ids", [
+    (reports.list_sessions, None),
+    (reports.count_sessions, None),
+    (reports.list_files, []),
+    (reports.list_files, ["2"]),
+    (reports.count_files, ["1"]),
+    (reports.list_hardlinks, []),
+    (reports.list_duplicated, []),
+    (reports.list_duplicated, ["1"]),
+])
+def test_memory_reports_match_sql(stores, build, session_ids):
+    sql, memory = stores
+    sql_rows, sql_headers = run(sql, build, session_ids)
+    memory_rows, memory_headers = run(memory, build, session_ids)
+    assert memory_headers == sql_headers
+    assert sorted(memory_rows, key=repr) == sorted(sql_rows, key=repr)
+    # list_duplicated orders by file_hash and file_size, list_hardlinks by link_of and file_name
+    assert [row[:2] for row in memory_rows] == [row[:2] for row in sql_rows]
+
+
+def test_memory_duplicated_report(stores):
+    sql, memory = stores
+    rows, headers = run(memory, reports.list_duplicated, [])
+    # the hardlink and the files that weren't read aren't duplicates, sizes and algorithms never mix
+    assert sorted(row[2] for row in rows) == ["/dst/b.jpg", "/dst/c.jpg", "/src/a.jpg", "/src/b.jpg", "/src/dir/a copy.jpg"]
+    # copies in other sessions are listed along with the duplicates of session 1
+    rows, headers = run(memory, reports.list_duplicated, ["1"])
+    assert sorted(row[2] for row in rows) == ["/dst/c.jpg", "/src/a.jpg", "/src/dir/a copy.jpg"]
+    assert run(memory, reports.list_duplicated, ["2"])[0] == []
+
+
+def test_memory_duplicatedpaths_report(stores):
+    sql, memory = stores
+    # SQLite picks any file_name of a group, only the counts compare
+    sql_rows, sql_headers = run(sql, reports.list_duplicatedpaths, [])
+    memory_rows, memory_headers = run(memory, reports.list_duplicatedpaths, [])
+    assert memory_headers == sql_headers
+    assert sorted(cnt for name, cnt in memory_rows) == sorted(cnt for name, cnt in sql_rows) == [2, 2, 4]
+
+
+def test_memory_records_by_session_and_name(stores):
+    sql, memory = stores
+    assert list(memory.get_records("files", file_name="/src/b.jpg")) == list(sql.get_records("files", file_name="/src/b.jpg"))
+    assert len(list(memory.get_records("files", session_id="2"))) == 2
+    assert list(memory.get_records("files", session_id="2", file_name="/src/b.jpg")) == []
+    assert len(list(memory.format_content_table("files"))) == len(records())
+
+
+def test_memory_indexes_follow_inserts(stores):
+    sql, memory = stores
+    assert run(memory, reports.count_sessions)[0] == [(2,)]
+    memory.insert_file(FileRecord("3", "/new/a.jpg", 1000, TIMESTAMP, A, hash_algo="md5"))
+    assert run(memory, reports.count_sessions)[0] == [(3,)]
+    assert [row[1] for row in memory.get_records("files", file_name="/new/a.jpg")] == ["/new/a.jpg"]
+
+
+def test_memory_query_without_report():
+    query = DataQuery()
+    query.select_clause = "*"
+    query.from_clause = "files"
+    with pytest.raises(Exception):
+        MemoryDataStore().exec_query(query)
@@ -0,0 +1,71 @@
+import pytest
+
+from rules import Rules, glob_to_regex, substring_patterns
+
+
+@pytest.mark.parametrize('pattern, path, is_dir, excluded', [
+    ('*.tmp', 'a.tmp', False, True),
+    ('*.tmp', 'dir/sub/a.tmp', False, True),
+    ('*.tmp', 'dir/a.tmpx', False, False),
+    ('node_modules/', 'web/node_modules', True, True),
+    ('node_modules/', 'web/node_modules', False, False),
+    ('$RECYCLE.BIN/', '$RECYCLE.BIN', True, True),
+    ('/build', 'build', True, True),
+    ('/build', 'src/build', True, False),
+    ('docs/*.md', 'docs/a.md', False, True),
+    ('docs/*.md', 'docs/sub/a.md', False, False),
+    ('docs/**/*.md', 'docs/sub/deep/a.md', False, True),
+    ('**/cache', 'a/b/cache', True, True),
+    ('file?.txt', 'file1.txt', False, True),
+    ('file[!0-4].txt', 'file3.txt', False, False),
+    ('file[!0-4].txt', 'file7.txt', False, True),
+    ('re:\\.(bak|orig)$', 'dir/x.orig', False, True),
+    ('re:^photos/20(1|2)', 'photos/2015/a.jpg', False, True),
+])
+def test_rule_patterns(pattern, path, is_dir, excluded):
+    assert Rules([pattern]).excluded(path, is_dir) == excluded, glob_to_regex(pattern)
+
+
+def test_last_matching_rule_wins():
+    rules = Rules(['*.log', '!keep.log', '# comment', '', 'tmp/'])
+    assert rules.excluded('a/debug.log')
+    assert not rules.excluded('a/keep.log')
+    assert rules.excluded('x/tmp', is_dir=True)
+    assert not rules.excluded('x/tmp')
+
+
+def test_regex_rules_are_searched_one_by_one():
+    # flags at the start of a later rule and backreferences still work next to other rules
+    rules = Rules(['*.tmp', 're:(?i)\\.bak$', 're:(\\w)\\1\\.txt$', 'cache/'])
+    assert rules.excluded('dir/OLD.BAK')
+    assert rules.excluded('dir/aa.txt')
+    assert not rules.excluded('dir/ab.txt')
+    assert rules.excluded('a.tmp')
+    assert rules.excluded('x/cache', is_dir=True)
+    assert not rules.excluded('x/cache')
+
+
+def test_excluded_path_checks_the_directories():
+    rules = Rules(['.git/'])
+    assert rules.excluded_path('/home/me/repo/.git/config')
+    assert not rules.excluded_path('/home/me/repo/.github/workflows/ci.yml')
+    assert not Rules()
+
+
+def test_from_file(tmp_path):
+    rules_file = tmp_path / 'exclude.txt'
+    rules_file.write_text('# junk\nnode_modules/\nre:~$\n')
+    rules = Rules.from_file(rules_file)
+    assert [rule.pattern for rule in rules.rules] == ['node_modules/', 're:~$']
+    with pytest.raises(ValueError):
+        Rules(['re:(unclosed'])
+
+
+def test_substring_patterns():
+    rules = Rules(substring_patterns(['backup\n', '  .tmp ', 're:\\.(bak|orig)$', '# comment', '']))
+    # plain lines match anywhere in the path, no glob or regex syntax in them
+    assert rules.excluded_path('/home/backups/a.jpg')
+    assert rules.excluded_path('/data/a.tmp.jpg')
+    assert not rules.excluded_path('/data/atmp.jpg')
+    assert rules.excluded_path('/data/a.orig')
+    assert not rules.excluded_path('/data/a.jpg')
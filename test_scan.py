@@ -1,4 +1,5 @@
 import hashlib
+import os
 import tempfile
 from pathlib import Path
 from typing import Any
@@ -7,6 +8,8 @@ import pytest
 
 import scan
 from config import ScanConfig
+from data_store import DataStore
+from hashing import HASH_ALGORITHMS, bench_hash_algorithms
 
 DEBUG = False # if true, tempdirectories aren't cleaned up for further investigation.
 
@@ -38,6 +41,249 @@ def test_hash_file(create_source_file):
 
     hash = scan.hash_file(file_name)
     assert file_name != None, file_name
-    assert hash == 'ccca4d28d9b929c1a429eadad7ab0d6d', hash
+    assert hash.hex() == 'ccca4d28d9b929c1a429eadad7ab0d6d', hash
 
 
+
+@pytest.fixture
+def create_source_tree(initialise_directories):
+    target_directory = Path(initialise_directories.name).resolve()
+    for d in range(3):
+        directory = target_directory / f'dir{d}'
+        directory.mkdir()
+        for f in range(5):
+            with (directory / f'file{f}.txt').open(mode="x") as fp:
+                fp.write(str(f) * (1024 * (f + 1)))
+    return target_directory
+
+
+def scanned_files(source_directory, workers, backend='thread'):
+    config = ScanConfig()
+    config.SIZE_THRESHOLD = 1000
+    config.SESSION_ID = f'workers-{workers}'
+    config.WORKERS = workers
+    config.HASH_BACKEND = backend
+    config.HASH_BATCH_SIZE = 4
+    scan.set_config(config)
+    scan.ds = DataStore(':memory:')
+    scan.tree_walk(str(source_directory))
+    return sorted((r[1], r[2], r[4]) for r in scan.ds.get_records('files', config.SESSION_ID))
+
+
+@pytest.mark.parametrize('backend', ['thread', 'process'])
+def test_tree_walk_workers_match_serial(create_source_tree, backend):
+    serial = scanned_files(create_source_tree, 1)
+    parallel = scanned_files(create_source_tree, 4, backend)
+    assert len(serial) == 15
+    assert parallel == serial
+
+
+def test_tree_walk_physical_order_matches_serial(create_source_tree):
+    serial = scanned_files(create_source_tree, 1)
+    config = ScanConfig()
+    config.SIZE_THRESHOLD = 1000
+    config.SESSION_ID = 'physical-order'
+    config.PHYSICAL_ORDER = True
+    config.ORDER_BATCH = 4
+    scan.set_config(config)
+    scan.tree_walk(str(create_source_tree))
+    assert sorted((r[1], r[2], r[4]) for r in scan.ds.get_records('files', config.SESSION_ID)) == serial
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_hardlinks_hashed_once_per_inode(create_source_tree, monkeypatch, workers):
+    primary = create_source_tree / 'dir0' / 'file4.txt'
+    for d in ['dir1', 'dir2']:
+        os.link(primary, create_source_tree / d / 'link.txt')
+
+    hashed = []
+    hash_file = scan.hash_file
+    monkeypatch.setattr(scan, 'hash_file', lambda file_name: hashed.append(file_name) or hash_file(file_name))
+    config = ScanConfig()
+    config.SIZE_THRESHOLD = 1000
+    config.SESSION_ID = f'links-{workers}'
+    config.WORKERS = workers
+    scan.set_config(config)
+    scan.ds = DataStore(':memory:')
+    scan.tree_walk(str(create_source_tree))
+
+    assert len(hashed) == 15
+    records = {r[1]: r for r in scan.ds.get_records('files', config.SESSION_ID)}
+    names = [str(primary)] + [str(create_source_tree / d / 'link.txt') for d in ['dir1', 'dir2']]
+    # the first of the names walked is the one the others are links of
+    first = [name for name in names if records[name][10] is None]
+    assert len(first) == 1
+    assert [records[name][10] for name in names if name not in first] == first * 2
+    assert len({records[name][4] for name in names}) == 1
+    assert all(r[10] is None for name, r in records.items() if name not in names)
+
+
+def test_tree_walk_several_roots_into_one_session(create_source_tree):
+    serial = scanned_files(create_source_tree, 1)
+    config = ScanConfig()
+    config.SIZE_THRESHOLD = 1000
+    config.SESSION_ID = 'several-roots'
+    scan.set_config(config)
+    scan.tree_walk([str(create_source_tree / d) for d in ['dir0', 'dir1', 'dir2']])
+    assert sorted((r[1], r[2], r[4]) for r in scan.ds.get_records('files', config.SESSION_ID)) == serial
+    with pytest.raises(ValueError):
+        scan.tree_walk([str(create_source_tree), str(create_source_tree / 'dir0')])
+
+
+def test_incremental_scan_only_rehashes_changed_files(create_source_tree, monkeypatch):
+    first = scanned_files(create_source_tree, 1)
+    changed_file = create_source_tree / 'dir1' / 'file4.txt'
+    with changed_file.open(mode="a") as fp:
+        fp.write('changed')
+
+    hashed = []
+    hash_file = scan.hash_file
+    monkeypatch.setattr(scan, 'hash_file', lambda file_name: hashed.append(file_name) or hash_file(file_name))
+    config = ScanConfig()
+    config.SIZE_THRESHOLD = 1000
+    config.SESSION_ID = 'incremental'
+    config.INCREMENTAL_FROM = 'workers-1'
+    scan.set_config(config)
+    scan.load_previous_session(config.INCREMENTAL_FROM)
+    scan.tree_walk(str(create_source_tree))
+    second = sorted((r[1], r[2], r[4]) for r in scan.ds.get_records('files', config.SESSION_ID))
+
+    assert hashed == [changed_file]
+    assert len(second) == len(first)
+    assert [r for r in second if r[0] != str(changed_file)] == [r for r in first if r[0] != str(changed_file)]
+
+
+def test_resume_continues_a_stopped_session(create_source_tree, monkeypatch):
+    config = ScanConfig()
+    config.SIZE_THRESHOLD = 1000
+    config.SESSION_ID = 'resumed'
+    config.COMMIT_ROWS = 2
+    scan.set_config(config)
+    scan.ds = DataStore(':memory:')
+    hash_record = scan.hash_record
+    hashed = []
+
+    def crash_after_8_files(file_record):
+        if len(hashed) == 8:
+            raise RuntimeError("crash")
+        hashed.append(file_record.file_name)
+        return hash_record(file_record)
+
+    monkeypatch.setattr(scan, 'hash_record', crash_after_8_files)
+    with pytest.raises(RuntimeError, match="crash"):
+        scan.tree_walk(str(create_source_tree))
+    first = [r[1] for r in scan.ds.get_records('files', config.SESSION_ID)]
+    assert 0 < len(first) < 15
+
+    monkeypatch.setattr(scan, 'hash_record', hash_record)
+    monkeypatch.setattr(scan, 'completed_dirs', set())
+    monkeypatch.setattr(scan, 'recorded_files', set())
+    config.RESUME = True
+    dir_count, file_count = scan.load_checkpoint(config.SESSION_ID)
+    # at least the root, it has no files of its own
+    assert dir_count >= 1
+    assert dir_count + file_count > 1
+    scan.tree_walk(str(create_source_tree))
+    files = [r[1] for r in scan.ds.get_records('files', config.SESSION_ID)]
+
+    assert len(files) == len(set(files)) == 15
+    assert set(first) <= set(files)
+
+
+def test_size_prepass_skips_unique_sizes(create_source_tree, monkeypatch):
+    unique_file = create_source_tree / 'dir0' / 'unique.txt'
+    with unique_file.open(mode="x") as fp:
+        fp.write('u' * 9999)
+
+    hashed = []
+    hash_file = scan.hash_file
+    monkeypatch.setattr(scan, 'hash_file', lambda file_name: hashed.append(file_name) or hash_file(file_name))
+    config = ScanConfig()
+    config.SIZE_THRESHOLD = 1000
+    config.SESSION_ID = 'prepass'
+    config.SIZE_PREPASS = True
+    scan.set_config(config)
+    scan.ds = DataStore(':memory:')
+    scan.tree_walk(str(create_source_tree))
+    records = {r[1]: (r[4], r[11]) for r in scan.ds.get_records('files', config.SESSION_ID)}
+
+    assert len(records) == 16
+    assert records[str(unique_file)] == (None, config.UNIQUE_SIZE_TEXT)
+    assert unique_file not in hashed
+    assert len(hashed) == 15
+
+
+def test_partial_hash_only_fully_hashes_matching_head_and_tail(create_source_tree, monkeypatch):
+    # same size as dir0/file4.txt, different head, so only the partial digest is needed
+    different_file = create_source_tree / 'dir0' / 'different.txt'
+    with different_file.open(mode="x") as fp:
+        fp.write('d' * 1024 * 5)
+
+    hashed = []
+    hash_file = scan.hash_file
+    monkeypatch.setattr(scan, 'hash_file', lambda file_name: hashed.append(file_name) or hash_file(file_name))
+    config = ScanConfig()
+    config.SIZE_THRESHOLD = 1000
+    config.PARTIAL_HASH_SIZE = 512
+    config.SESSION_ID = 'partial'
+    config.PARTIAL_HASH = True
+    scan.set_config(config)
+    scan.ds = DataStore(':memory:')
+    scan.tree_walk(str(create_source_tree))
+    records = {r[1]: (r[4], r[8], r[11]) for r in scan.ds.get_records('files', config.SESSION_ID)}
+
+    assert records[str(different_file)][0] is None
+    assert records[str(different_file)][2] == config.UNIQUE_PARTIAL_TEXT
+    assert records[str(different_file)][1] is not None
+    assert different_file not in hashed
+    # the 1KiB files are fully covered by head + tail, their partial digest is the full one
+    assert len(hashed) == 12
+    assert records[str(create_source_tree / 'dir0' / 'file0.txt')][0] == hashlib.md5(b'0' * 1024).digest()
+    assert records[str(create_source_tree / 'dir0' / 'file4.txt')][0] == hashlib.md5(b'4' * 1024 * 5).digest()
+
+
+def test_incremental_partial_hash_compares_with_reused_digests(create_source_tree):
+    first = scanned_files(create_source_tree, 1)
+    # a copy of a file whose digest the incremental run reuses
+    copy = create_source_tree / 'dir0' / 'file4 copy.txt'
+    copy.write_bytes((create_source_tree / 'dir0' / 'file4.txt').read_bytes())
+    config = ScanConfig()
+    config.SIZE_THRESHOLD = 1000
+    config.PARTIAL_HASH_SIZE = 512
+    config.SESSION_ID = 'incremental-partial'
+    config.INCREMENTAL_FROM = 'workers-1'
+    config.PARTIAL_HASH = True
+    scan.set_config(config)
+    scan.load_previous_session(config.INCREMENTAL_FROM)
+    scan.tree_walk(str(create_source_tree))
+    records = {r[1]: (r[4], r[11]) for r in scan.ds.get_records('files', config.SESSION_ID)}
+
+    assert records[str(copy)] == (hashlib.md5(b'4' * 1024 * 5).digest(), None)
+    assert {name: records[name][0] for name, size, digest in first} == {name: digest for name, size, digest in first}
+
+
+def test_hash_file_with_registered_algorithm(create_source_file):
+    config = ScanConfig()
+    config.HASH_ALGO = 'blake2b-128'
+    scan.set_config(config)
+
+    hash = scan.hash_file(create_source_file)
+    assert hash == hashlib.blake2b(b'#' * 1024, digest_size=16).digest(), hash
+
+
+def test_bench_hash_algorithms_covers_registry():
+    results = dict(bench_hash_algorithms(1024 * 1024, 65536))
+    assert list(results) == list(HASH_ALGORITHMS)
+    assert all(throughput > 0 for throughput in results.values())
+
+
+@pytest.mark.parametrize('read_strategy', ['read', 'readinto', 'mmap'])
+def test_hash_file_read_strategies(create_source_file, read_strategy):
+    config = ScanConfig()
+    config.READ_STRATEGY = read_strategy
+    config.MMAP_MIN_SIZE = 1
+    config.BUF_SIZE = 100  # several chunks, the last one partial
+    scan.set_config(config)
+
+    hash = scan.hash_file(create_source_file)
+    assert hash.hex() == 'ccca4d28d9b929c1a429eadad7ab0d6d', hash
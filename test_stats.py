@@ -1,4 +1,4 @@
-from stats import ProcessStats
+from stats import ProcessStats, PhaseRate
 
 
 def test_create():
@@ -141,4 +141,28 @@ def test_copied():
     assert stats.processed_files_size == 0
     assert stats.ignored_files_size == 0
     assert stats.duplicated_files_size == 0
-    assert stats.ignored_files_size == 0
\ No newline at end of file
+    assert stats.ignored_files_size == 0
+def test_phase_rates():
+    stats = ProcessStats()
+    stats.phase("hash", 1, 1000, 0.5)
+    stats.phase("hash", 1, 3000, 1.5)
+    with stats.timed("db", files=10):
+        pass
+    assert list(stats.phases) == ["hash", "db"]
+    assert stats.phases["hash"].files == 2
+    assert stats.phases["hash"].bytes == 4000
+    assert stats.phases["hash"].busy == 2.0
+    assert stats.phases["db"].files == 10
+    assert "hash" in stats.rate_text() and "db" in stats.rate_text()
+    report = stats.throughput_report()
+    assert "2.0KiB/s while busy" in report
+    assert "most busy time: hash" in report
+
+
+def test_phase_window_drops_old_buckets():
+    phase = PhaseRate(window=10)
+    phase.add(5, 500, 0, 100.5)
+    phase.add(1, 100, 0, 115.5)
+    assert [b[0] for b in phase.buckets] == [115]
+    files, size = phase.window_rate(115.5, 0)
+    assert (files, size) == (1 / 9.5, 100 / 9.5)
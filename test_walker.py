@@ -0,0 +1,88 @@
+import os
+import tempfile
+from pathlib import Path
+
+import pytest
+
+import walker
+from rules import Rules
+
+DEBUG = False # if true, tempdirectories aren't cleaned up for further investigation.
+
+
+@pytest.fixture
+def source_tree():
+    src = tempfile.TemporaryDirectory(delete=not DEBUG)
+    root = Path(src.name).resolve()
+    for d in ['dir1', 'dir1/sub1', 'dir2', '.git']:
+        (root / d).mkdir()
+    for f in ['file0.txt', 'dir1/file1.txt', 'dir1/sub1/file2.txt', 'dir2/file3.txt', '.git/config']:
+        with (root / f).open(mode="x") as fp:
+            fp.write('#' * len(f))
+    os.symlink(root / 'dir1', root / 'link_to_dir1')
+    yield root
+    src.cleanup()
+
+
+def test_walk_matches_path_walk(source_tree):
+    expected = [
+        (root, sorted(dirs), sorted(files))
+        for root, dirs, files in source_tree.walk(top_down=True)
+    ]
+    result = [
+        (root, sorted(dirs), sorted(f.name for f in files))
+        for root, dirs, files in walker.walk(source_tree)
+    ]
+    assert sorted(result) == sorted(expected)
+
+
+def test_walk_entries_carry_stat(source_tree):
+    entries = {f.name: f for root, dirs, files in walker.walk(source_tree) for f in files}
+    file_stat = (source_tree / 'dir1' / 'file1.txt').stat()
+    entry = entries['file1.txt']
+    assert entry.is_file
+    assert entry.path == str(source_tree / 'dir1' / 'file1.txt')
+    assert (entry.size, entry.mtime_ns, entry.ino, entry.dev) == (
+        file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino, file_stat.st_dev
+    )
+    # symlinks to directories are listed but not followed, like Path.walk
+    assert not entries['link_to_dir1'].is_file
+    assert entries['link_to_dir1'].size == 0
+
+
+def test_walk_prunes_dirs_in_place(source_tree):
+    names = []
+    for root, dirs, files in walker.walk(source_tree):
+        dirs[:] = [d for d in dirs if d != '.git']
+        names.extend(f.name for f in files)
+    assert 'config' not in names
+    assert 'file2.txt' in names
+
+
+def test_walk_bottom_up_yields_children_first(source_tree):
+    roots = [root for root, dirs, files in walker.walk(source_tree, top_down=False)]
+    assert roots.index(source_tree / 'dir1' / 'sub1') < roots.index(source_tree / 'dir1')
+    assert roots[-1] == source_tree
+
+
+def test_walk_with_rules_never_lists_excluded(source_tree, monkeypatch):
+    listed = []
+    scan_dir = walker.scan_dir
+    monkeypatch.setattr(walker, 'scan_dir', lambda root, *args: listed.append(root) or scan_dir(root, *args))
+    rules = Rules(['.git/', 'sub1/', '/file0.txt'])
+
+    names = [f.name for root, dirs, files in walker.walk(source_tree, rules=rules) for f in files]
+    assert sorted(names) == ['file1.txt', 'file3.txt', 'link_to_dir1']
+    assert source_tree / '.git' not in listed
+    assert source_tree / 'dir1' / 'sub1' not in listed
+    # bottom up too
+    roots = [root for root, dirs, files in walker.walk(source_tree, top_down=False, rules=rules)]
+    assert sorted(roots) == sorted([source_tree, source_tree / 'dir1', source_tree / 'dir2'])
+
+
+def test_check_roots_rejects_nested_roots(source_tree):
+    roots = walker.check_roots([source_tree / 'dir1', str(source_tree / 'dir2')])
+    assert roots == [source_tree / 'dir1', source_tree / 'dir2']
+    assert walker.roots_by_device(roots) == [roots]
+    with pytest.raises(ValueError, match='inside'):
+        walker.check_roots([source_tree, source_tree / 'dir1' / 'sub1'])
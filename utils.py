@@ -3,7 +3,7 @@ from contextlib import contextmanager
 
 @contextmanager
 def __alive_bar():
-    def noop_func():
+    def noop_func(*args, **kwargs):
         pass
     def bar():  # for definite progress mode.
         return 
@@ -0,0 +1,130 @@
+import os
+import logging
+from pathlib import Path
+from typing import List
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv("MERGELOGGING", "INFO"))
+
+
+class FileEntry:
+    """What the tools need to know about a file, taken from a single stat call.
+
+    Only regular files (following symlinks, like Path.is_file) get their stat
+    fields filled; anything else is listed with is_file False and size 0.
+    """
+
+    __slots__ = ("name", "path", "is_file", "size", "mtime_ns", "ino", "dev", "nlink")
+
+    name: str
+    path: str
+    is_file: bool
+    size: int
+    mtime_ns: int
+    ino: int
+    dev: int
+    nlink: int
+
+    def __init__(self, name: str, path: str, file_stat: os.stat_result = None):
+        self.name = name
+        self.path = path
+        self.is_file = file_stat is not None
+        if file_stat is not None:
+            self.size = file_stat.st_size
+            self.mtime_ns = file_stat.st_mtime_ns
+            self.ino = file_stat.st_ino
+            self.dev = file_stat.st_dev
+            self.nlink = file_stat.st_nlink
+        else:
+            self.size = 0
+            self.mtime_ns = None
+            self.ino = None
+            self.dev = None
+            self.nlink = 0
+
+    def __repr__(self):
+        return f"FileEntry({self.path!r}, size={self.size})"
+
+
+def path_entry(file_name: str | Path) -> FileEntry:
+    """FileEntry for a single path outside of a walk. Raises like os.stat."""
+    file_name = str(file_name)
+    if os.path.isfile(file_name):
+        return FileEntry(os.path.basename(file_name), file_name, os.stat(file_name))
+    return FileEntry(os.path.basename(file_name), file_name)
+
+
+def scan_dir(root: Path, on_error=None, rules=None, rel: str = ""):
+    """Lists root, leaving out what rules exclude at rel (root relative to the walk) before any stat."""
+    dirs: List[str] = []
+    files: List[FileEntry] = []
+    with os.scandir(root) as it:
+        for entry in it:
+            try:
+                # the type comes from the directory listing itself on most filesystems
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if rules and rules.excluded(f"{rel}{entry.name}", is_dir):
+                    continue
+                if is_dir:
+                    dirs.append(entry.name)
+                elif entry.is_file():
+                    files.append(FileEntry(entry.name, entry.path, entry.stat()))
+                else:
+                    files.append(FileEntry(entry.name, entry.path))
+            except OSError as e:
+                if on_error is not None:
+                    on_error(e)
+    return dirs, files
+
+
+def check_roots(roots: List[str | Path]) -> List[Path]:
+    """Resolved roots, raising ValueError when one is inside another (it would be walked twice)."""
+    resolved = [Path(root).resolve() for root in roots]
+    for root in resolved:
+        for other in resolved:
+            if root is not other and root.is_relative_to(other):
+                raise ValueError(f"{root} is inside {other}, it would be walked twice")
+    return resolved
+
+
+def roots_by_device(roots: List[Path]) -> List[List[Path]]:
+    """roots grouped by st_dev, in the order each device first shows up."""
+    devices = {}
+    for root in roots:
+        devices.setdefault(os.stat(root).st_dev, []).append(root)
+    return list(devices.values())
+
+
+def walk(top: str | Path, top_down: bool = True, on_error=None, rules=None):
+    """Same contract as Path.walk, built on os.scandir and yielding FileEntry files.
+
+    Yields (root, dirs, files) with root a Path, dirs the names of the
+    subdirectories and files the FileEntry of everything else. Symlinks to
+    directories aren't followed. With top_down, dirs can be changed in place
+    to prune what gets walked. Errors listing a directory or stat'ing a file
+    go to on_error and the walk continues.
+
+    With rules (a rules.Rules), what they exclude is left out of dirs and
+    files and excluded directories are never listed, in both directions.
+    """
+    top = Path(top)
+    stack = [top]
+    while stack:
+        root = stack.pop()
+        if isinstance(root, tuple):
+            yield root
+            continue
+        rel = ""
+        if rules and root != top:
+            rel = f"{root.relative_to(top).as_posix()}/"
+        try:
+            dirs, files = scan_dir(root, on_error, rules, rel)
+        except OSError as e:
+            if on_error is not None:
+                on_error(e)
+            continue
+        if top_down:
+            yield root, dirs, files
+        else:
+            stack.append((root, dirs, files))
+        stack.extend(root / d for d in reversed(dirs))